@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script benchmarks the pipeline on synthetic diamond tables and
+fasta files of several sizes: the feature extraction engines and the functions
+query_selector, feature_avg_calculator, value_inside_interval, query_coverage_calculator,
+seq_selector, line_query_selector and run_the_models.main. The timings can be saved
+as a baseline json file and later runs compared to it, to find regressions. The
+committed benchmark_baseline.json is a run with the default settings.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+from time import perf_counter
+import numpy as np
+from os.path import exists
+from general_functions import dir_maker
+from fasta_index import fasta_lengths
+from feature_table import table_writer
+from orphan_selector import query_selector, seq_selector, line_query_selector
+from stage_cache import manifest_path
+import run_the_models
+from diamond_feature_extractor import (
+    fasta_parser, feature_avg_calculator, feature_stream_calculator, feature_columnar_calculator,
+    feature_parallel_calculator, feature_stage_applier, value_inside_interval, query_coverage_calculator
+)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+def synthetic_id_maker(n_queries, prefix_collisions = False):
+    """This function makes the query ids of a synthetic table
+
+    Args:
+        n_queries (int): the number of queries
+        prefix_collisions (bool): whether the ids should be numbered without zero padding,
+        so that ids are the prefix of other ids ('sim_1' of 'sim_10'), as in the
+        simulated data. Defaults to False.
+
+    Returns:
+        list: the query ids
+    """
+    if prefix_collisions:
+        return [f'sim_{i}' for i in range(n_queries)]
+    #zero padded ids, so no query id is the prefix of another one
+    return [f'sim_{i:09d}' for i in range(n_queries)]
+
+def synthetic_table_maker(out_table, n_rows, hits_per_query, query_length = 300, seed = 1, prefix_collisions = False):
+    """This function writes a diamond table in the default table format
+    with random alignments
+
+    Args:
+        out_table (str): path to the output table
+        n_rows (int): the number of lines of the table
+        hits_per_query (int): the number of lines per query
+        query_length (int): the length of every query sequence. Defaults to 300.
+        seed (int): the seed of the random generator. Defaults to 1.
+        prefix_collisions (bool): whether query ids can be the prefix of other ids,
+        see synthetic_id_maker. Defaults to False.
+
+    Returns:
+        list: the query ids in the table
+    """
+    rng = random.Random(seed)
+    n_queries = -(-n_rows // hits_per_query)
+    query_ids = synthetic_id_maker(n_queries, prefix_collisions)
+    with open(out_table, 'w') as f:
+        for row in range(n_rows):
+            query = query_ids[row // hits_per_query]
+            qstart = rng.randint(1, query_length - 10)
+            qend = rng.randint(qstart + 5, query_length)
+            length = qend - qstart + 1
+            mismatch = rng.randint(0, length // 2)
+            sstart = rng.randint(1, 1000)
+            line = [
+                query, f'UHGP_{rng.randint(0, 10 ** 6):07d}', f'{rng.uniform(15, 60):.1f}', length, mismatch,
+                rng.randint(0, 10), qstart, qend, sstart, sstart + length - 1,
+                f'{rng.uniform(0.001, 10):.2e}', f'{rng.uniform(15, 40):.1f}'
+            ]
+            f.write('\t'.join(map(str, line)) + '\n')
+    return query_ids
+
+def synthetic_fasta_maker(out_fasta, query_ids, query_length = 300, seed = 1):
+    """This function writes a fasta file with a random protein sequence for each query id
+
+    Args:
+        out_fasta (str): path to the output fasta file
+        query_ids (list): the ids of the sequences
+        query_length (int): the length of every sequence. Defaults to 300.
+        seed (int): the seed of the random generator. Defaults to 1.
+    """
+    rng = random.Random(seed)
+    with open(out_fasta, 'w') as f:
+        for query in query_ids:
+            seq = ''.join(rng.choices('ACDEFGHIKLMNPQRSTVWY', k = query_length))
+            f.write(f'>{query}\n{seq}\n')
+
+def engine_benchmarker(table, fasta, legacy = True, prefix_collisions = False):
+    """This function times the feature extraction of the old, the single pass and the
+    columnar engine and checks that they all give the same features
+
+    Args:
+        table (str): path to a diamond table
+        fasta (str): path to the fasta file containing the query sequences
+        legacy (bool): whether the old engine should be timed as well. Defaults to True.
+        prefix_collisions (bool): whether query ids are the prefix of other ids, the old
+        engine then also counts the lines of those other queries, so its features are
+        not compared. Defaults to False.
+
+    Returns:
+        dict: the seconds taken per engine
+    """
+    lengths = fasta_lengths(fasta)
+    timings = {}
+    start = perf_counter()
+    features = feature_stream_calculator(table, lengths)
+    timings['single_pass'] = perf_counter() - start
+    start = perf_counter()
+    columnar_features = feature_columnar_calculator(table, lengths)
+    timings['columnar'] = perf_counter() - start
+    if columnar_features != features:
+        raise ValueError(f'The engines give different features for "{table}"')
+    if legacy:
+        start = perf_counter()
+        legacy_features = feature_avg_calculator(table, query_selector(table), fasta_parser(fasta))
+        timings['legacy'] = perf_counter() - start
+        if legacy_features != features and not prefix_collisions:
+            raise ValueError(f'The engines give different features for "{table}"')
+    return timings
+
+def scaling_benchmarker(table, fasta, processes):
+    """This function times the parallel feature extraction for several numbers
+    of processes and checks that they give the same features as the single pass engine
+
+    Args:
+        table (str): path to a diamond table
+        fasta (str): path to the fasta file containing the query sequences
+        processes (list): the numbers of processes to time
+
+    Returns:
+        dict: the seconds taken per number of processes
+    """
+    lengths = fasta_lengths(fasta)
+    features = feature_stream_calculator(table, lengths)
+    timings = {}
+    for n in processes:
+        start = perf_counter()
+        parallel_features = feature_parallel_calculator(table, lengths, n)
+        timings[n] = perf_counter() - start
+        if parallel_features != features:
+            raise ValueError(f'The parallel engine gives different features with {n} processes')
+    return timings
+
+def best_timer(function, args, repeats = 1, setup = None):
+    """This function times a function and keeps the fastest of several runs
+
+    Args:
+        function (function): the function to time
+        args (list): the arguments of the function
+        repeats (int): the number of runs. Defaults to 1.
+        setup (function): called without arguments before every run and not timed,
+        e.g. to remove the output of the previous run. Defaults to None.
+
+    Returns:
+        tuple: the fastest time in seconds and what the function returned
+    """
+    best = None
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        result = function(*args)
+        seconds = perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+def output_remover(*outs):
+    """This function makes a function that removes outputs and their cache manifests,
+    so cached stages are really run again
+
+    Args:
+        outs (str): paths to the outputs
+
+    Returns:
+        function: removes the outputs
+    """
+    def remover():
+        for out in outs:
+            for path in (out, manifest_path(out)):
+                if exists(path):
+                    os.remove(path)
+    return remover
+
+def interval_collector(table):
+    """This function collects the query intervals [qstart, qend] of the lines of every query
+
+    Args:
+        table (str): path to a diamond table
+
+    Returns:
+        dict: key: query id; value: list of intervals
+    """
+    intervals = {}
+    with open(table) as f:
+        for line in f:
+            columns = line.split('\t')
+            intervals.setdefault(columns[0], []).append([int(columns[6]), int(columns[7])])
+    return intervals
+
+def interval_coverer(intervals):
+    """This function counts the number inside the intervals of every query with
+    query_coverage_calculator, the vectorized version of value_inside_interval
+
+    Args:
+        intervals (list): the list of intervals of every query
+
+    Returns:
+        list: the counted number inside the intervals of every query
+    """
+    codes = np.repeat(np.arange(len(intervals)), [len(interval) for interval in intervals])
+    bounds = np.array([bound for interval in intervals for bound in interval], dtype = np.int64).reshape(-1, 2)
+    return query_coverage_calculator(codes, bounds[:, 0], bounds[:, 1], len(intervals)).tolist()
+
+def coverage_checker(n_queries = 1000, seed = 1):
+    """This function checks that query_coverage_calculator counts the same as the
+    original value_inside_interval on random intervals that overlap, touch, are
+    nested, repeated or empty, which the synthetic tables rarely have
+
+    Args:
+        n_queries (int): the number of queries with random intervals. Defaults to 1000.
+        seed (int): the seed of the random intervals. Defaults to 1.
+
+    Raises:
+        ValueError: when the counts differ
+    """
+    rng = random.Random(seed)
+    intervals = []
+    for i in range(n_queries):
+        interval = []
+        for j in range(rng.randint(1, 12)):
+            lower = rng.randint(-5, 60)
+            interval.append([lower, lower + rng.randint(-3, 25)])
+        intervals.append(interval)
+    if interval_coverer(intervals) != [value_inside_interval(interval) for interval in intervals]:
+        raise ValueError('query_coverage_calculator and value_inside_interval count differently on random intervals')
+
+def function_benchmarker(table, fasta, work_dir, legacy = True, ml_models = None, repeats = 1,
+                         prefix_collisions = False):
+    """This function times the functions of the pipeline on a synthetic table
+
+    Args:
+        table (str): path to a diamond table
+        fasta (str): path to the fasta file containing the query sequences
+        work_dir (str): path to the directory to write the outputs to
+        legacy (bool): whether feature_avg_calculator should be timed, its features are
+        checked against the single pass engine. Defaults to True.
+        ml_models (list): paths to models to time run_the_models.main with. Defaults to None.
+        repeats (int): the number of runs per function, the fastest is kept. Defaults to 1.
+        prefix_collisions (bool): whether query ids are the prefix of other ids, see
+        engine_benchmarker. Defaults to False.
+
+    Returns:
+        dict: the seconds taken per function
+    """
+    timings = {}
+    timings['query_selector'], query_ids = best_timer(query_selector, [table], repeats)
+    if legacy:
+        timings['feature_avg_calculator'], features = best_timer(
+            feature_avg_calculator, [table, query_ids, fasta_parser(fasta)], repeats)
+        if features != feature_stream_calculator(table, fasta_lengths(fasta)) and not prefix_collisions:
+            raise ValueError(f'The engines give different features for "{table}"')
+    intervals = list(interval_collector(table).values())
+    timings['value_inside_interval'], coverage = best_timer(
+        lambda: [value_inside_interval(interval) for interval in intervals], [], repeats)
+    timings['query_coverage_calculator'], result = best_timer(interval_coverer, [intervals], repeats)
+    if result != coverage:
+        raise ValueError(f'query_coverage_calculator and value_inside_interval count differently on "{table}"')
+    #select half of the queries, as the orphans of a table
+    ids = {id: None for id in query_ids[::2]}
+    out_seq = f'{work_dir}/selected.fa'
+    timings['seq_selector'], result = best_timer(seq_selector, [fasta, out_seq, ids], repeats, output_remover(out_seq))
+    out_table = f'{work_dir}/selected.m8'
+    timings['line_query_selector'], result = best_timer(
+        line_query_selector, [table, ids, out_table], repeats, output_remover(out_table))
+    if ml_models:
+        #predict the table the models are trained on, without the queries without a hit
+        lengths = fasta_lengths(fasta)
+        features = feature_stage_applier(feature_columnar_calculator(table, lengths), lengths,
+                                         {'normalize_length': True, 'drop_no_hits': True})
+        feature_table = f'{work_dir}/features.tsv'
+        table_writer(features, feature_table)
+        predictions = f'{work_dir}/predictions.tsv'
+        #the models are loaded again in every run, as in a new process
+        timings['run_the_models.main'], result = best_timer(
+            run_the_models.main, [feature_table, ml_models, predictions], repeats, run_the_models.MODEL_CACHE.clear)
+    return timings
+
+def baseline_loader(baseline_file):
+    """This function loads a baseline saved by baseline_writer
+
+    Args:
+        baseline_file (str): path to the baseline json file
+
+    Returns:
+        dict: the 'settings' of the benchmark and the 'timings', key: '{rows}/{benchmark}';
+        value: seconds
+    """
+    with open(baseline_file) as f:
+        return json.load(f)
+
+def baseline_writer(settings, timings, baseline_file):
+    """This function saves the timings of a benchmark as a baseline
+
+    Args:
+        settings (dict): the settings of the benchmark
+        timings (dict): key: '{rows}/{benchmark}'; value: seconds
+        baseline_file (str): path to the baseline json file
+    """
+    with open(baseline_file, 'w') as f:
+        json.dump({'settings': settings, 'timings': timings}, f, indent = 1)
+
+def baseline_comparer(timings, baseline, tolerance, min_seconds = 0.05):
+    """This function compares timings to a baseline
+
+    Args:
+        timings (dict): key: '{rows}/{benchmark}'; value: seconds
+        baseline (dict): the baseline, see baseline_loader
+        tolerance (float): the fraction a benchmark can be slower than the baseline,
+        e.g. 0.2 for 20 percent
+        min_seconds (float): differences smaller than this are timing noise and are
+        not regressions. Defaults to 0.05.
+
+    Returns:
+        dict: key: '{rows}/{benchmark}'; value: the ratio of the time to the baseline time,
+        for the benchmarks that are slower than the tolerance allows
+    """
+    regressions = {}
+    for name, seconds in timings.items():
+        base = baseline['timings'].get(name)
+        if base is not None and base > 0 and seconds > base * (1 + tolerance) and seconds - base > min_seconds:
+            regressions[name] = seconds / base
+    return regressions
+
+def main(out_dir, sizes, hits_per_query, legacy_max_rows, processes = None, prefix_collisions = False,
+         ml_models = None, repeats = 1, save_baseline = None, baseline = None, tolerance = 0.2):
+    """This function makes the synthetic tables and prints the timings per table size
+
+    Args:
+        out_dir (str): path to the directory to write the synthetic data to
+        sizes (list): the number of table lines of each benchmark
+        hits_per_query (int): the number of lines per query
+        legacy_max_rows (int): the largest table on which the old engine is timed
+        processes (list): if given, the parallel engine is timed with these numbers of
+        processes as well, with the speedup compared to 1 process. Defaults to None.
+        prefix_collisions (bool): whether query ids can be the prefix of other ids,
+        see synthetic_id_maker. Defaults to False.
+        ml_models (list): paths to models to time run_the_models.main with. Defaults to None.
+        repeats (int): the number of runs per function, the fastest is kept. Defaults to 1.
+        save_baseline (str): path to save the timings to as a baseline. Defaults to None.
+        baseline (str): path to a baseline to compare the timings to. Defaults to None.
+        tolerance (float): the fraction a benchmark can be slower than the baseline. Defaults to 0.2.
+
+    Returns:
+        dict: the benchmarks that are slower than the baseline allows, see baseline_comparer
+    """
+    dir_maker(out_dir)
+    coverage_checker()
+    settings = {'hits_per_query': hits_per_query, 'prefix_collisions': prefix_collisions,
+                'legacy_max_rows': legacy_max_rows, 'repeats': repeats}
+    timings = {}
+    print('rows\tbenchmark\tseconds')
+    for n_rows in sizes:
+        name = f'synthetic_{n_rows}' + ('_collisions' if prefix_collisions else '')
+        table = f'{out_dir}/{name}.m8'
+        fasta = f'{out_dir}/{name}.fa'
+        if not exists(table) or not exists(fasta):
+            query_ids = synthetic_table_maker(table, n_rows, hits_per_query, prefix_collisions = prefix_collisions)
+            synthetic_fasta_maker(fasta, query_ids)
+        legacy = n_rows <= legacy_max_rows
+        #the old engine is timed as feature_avg_calculator with the other functions
+        size_timings = engine_benchmarker(table, fasta, False)
+        work_dir = dir_maker(f'{out_dir}/{name}_outputs')
+        size_timings.update(function_benchmarker(table, fasta, work_dir, legacy, ml_models, repeats, prefix_collisions))
+        if processes:
+            scaling = scaling_benchmarker(table, fasta, processes)
+            for n, seconds in scaling.items():
+                size_timings[f'parallel_{n}'] = seconds
+        for benchmark, seconds in size_timings.items():
+            print(f'{n_rows}\t{benchmark}\t{seconds:.3f}')
+            timings[f'{n_rows}/{benchmark}'] = seconds
+    if save_baseline is not None:
+        baseline_writer(settings, timings, save_baseline)
+        print(f'The baseline has been saved to "{save_baseline}"')
+    regressions = {}
+    if baseline is not None:
+        previous = baseline_loader(baseline)
+        if previous['settings'] != settings:
+            print(f'The settings differ from those of the baseline: {previous["settings"]}')
+        regressions = baseline_comparer(timings, previous, tolerance)
+        for benchmark, ratio in regressions.items():
+            print(f'Regression: {benchmark} takes {ratio:.2f} times the baseline')
+        if not regressions:
+            print(f'No benchmark is more than {tolerance:.0%} slower than the baseline')
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the pipeline on synthetic diamond tables')
+    parser.add_argument('out_dir', help = 'directory to write the synthetic tables to')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10 ** 5, 10 ** 6, 10 ** 7])
+    parser.add_argument('--hits-per-query', type = int, default = 100)
+    parser.add_argument('--legacy-max-rows', type = int, default = 10 ** 5,
+                        help = 'the old engine rescans the table per query, so only time it on small tables')
+    parser.add_argument('--processes', type = int, nargs = '+', default = None,
+                        help = 'numbers of processes to time the parallel engine with, e.g. 1 2 4 8 18')
+    parser.add_argument('--prefix-collisions', action = 'store_true',
+                        help = "number the query ids without zero padding, so 'sim_1' is a prefix of 'sim_10'")
+    parser.add_argument('--models', nargs = '+', default = None, help = 'models to time run_the_models.py with')
+    parser.add_argument('--repeats', type = int, default = 1, help = 'runs per function, the fastest is kept')
+    parser.add_argument('--save-baseline', default = None, help = 'json file to save the timings to')
+    parser.add_argument('--baseline', nargs = '?', default = None, const = BASELINE,
+                        help = 'json file with timings to compare to. Without a file benchmark_baseline.json is used')
+    parser.add_argument('--tolerance', type = float, default = 0.2,
+                        help = 'fraction a benchmark can be slower than the baseline. Defaults to 0.2')
+    args = parser.parse_args()
+    regressions = main(args.out_dir, args.sizes, args.hits_per_query, args.legacy_max_rows, args.processes,
+                       args.prefix_collisions, args.models, args.repeats, args.save_baseline, args.baseline,
+                       args.tolerance)
+    if regressions:
+        sys.exit(1)
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-import sys
+import argparse
+from feature_table import table_loader, table_writer
+from decoy_maker import decoy_labeler
 
-df = pd.read_csv(sys.argv[1],sep = '\t')
+parser = argparse.ArgumentParser(description = 'Add the CLASS column to a feature table')
+parser.add_argument('table', help = 'feature table, the CLASS column is added to it in place')
+parser.add_argument('class_col', nargs = '?', default = None, help = "the class of every query, 'pos' or 'neg'")
+parser.add_argument('--manifest', default = None,
+                    help = "manifest of decoy_maker.py, its decoys are labelled 'neg' and the other queries 'pos'")
+args = parser.parse_args()
+if (args.class_col is None) == (args.manifest is None):
+    parser.error('give either the class or --manifest')
 
-class_col = sys.argv[2]
+df = table_loader(args.table)
 
-df['CLASS'] = [class_col] * len(df)
+if args.manifest is not None:
+    df['CLASS'] = decoy_labeler(df.index, args.manifest)
+else:
+    df['CLASS'] = args.class_col
 
-df.to_csv(sys.argv[1], index=False, sep = '\t')
+table_writer(df, args.table)
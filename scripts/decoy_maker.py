@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script makes the decoys of the negative class from a fasta file.
+Every sequence is reversed, or shuffled with a seed, after its gaps and whitespace
+are removed, as result_parser.sh did with sed. The fasta file is read as a stream
+in chunks of records, which are made into decoys by a pool of processes and written
+in the order of the input, so files with millions of sequences are never loaded.
+
+Next to the decoys a manifest is written, a tsv table with the id of every decoy,
+the id of the sequence it was made from, the method and the length. class.py
+(--manifest) and diamond_feature_extractor.py (--decoy-manifest) label the queries
+in the manifest 'neg' and all the other queries 'pos'.
+"""
+
+import argparse
+import random
+from general_functions import file_opener, ordered_process_mapper
+from stage_cache import stage_cache_checker, stage_cache_writer, atomic_writer
+from stage_profiler import stage_timer
+from os.path import exists
+
+#key: method; value: the prefix of the decoy ids
+DECOY_PREFIXES = {'reverse': 'rev_', 'shuffle': 'shuf_'}
+#the characters removed from the sequences, gaps of the alignments and whitespace
+GAP_CHARACTERS = b'-. \t\r\n'
+#the number of residues of the records that are sent to a process at once
+CHUNK_RESIDUES = 2 ** 22
+FASTA_LINE_WIDTH = 60
+MANIFEST_HEADER = 'decoy\tsource\tmethod\tlength\n'
+
+def manifest_namer(out_seq):
+    """This function gets the default path of the manifest of a decoy fasta file
+
+    Args:
+        out_seq (str): path to the decoy fasta file
+
+    Returns:
+        str: path to the manifest
+    """
+    return f'{out_seq}.manifest.tsv'
+
+def fasta_chunk_reader(fasta, chunk_residues = CHUNK_RESIDUES):
+    """This function reads a fasta file in chunks of whole records
+
+    Args:
+        fasta (str): path to the fasta file, can be compressed
+        chunk_residues (int): the number of bytes of sequence per chunk, a chunk
+        always ends at the end of a record. Defaults to CHUNK_RESIDUES.
+
+    Yields:
+        list: tuples of the header line, without '>' and the line end, and the sequence lines
+    """
+    chunk = []
+    size = 0
+    record = None
+    with file_opener(fasta, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if size >= chunk_residues:
+                    yield chunk
+                    chunk = []
+                    size = 0
+                record = (line[1:].rstrip(b'\r\n'), [])
+                chunk.append(record)
+            elif record is not None:
+                record[1].append(line)
+                size += len(line)
+    if chunk:
+        yield chunk
+
+def decoy_chunk_maker(args):
+    """This function makes the decoys of a chunk of records
+
+    Args:
+        args (tuple): containing 4 elements
+            element 1 (list): the records, see fasta_chunk_reader
+            element 2 (str): the method, 'reverse' or 'shuffle'
+            element 3 (int): the seed of the shuffle, every sequence is shuffled with
+            a seed made from it and its id, so the decoys do not depend on the chunks
+            element 4 (str): the prefix of the decoy ids
+
+    Returns:
+        tuple: the decoy fasta records, the manifest lines and the number of sequences
+        that were empty after removing the gaps and were skipped
+    """
+    records, method, seed, prefix = args
+    fasta_lines = []
+    manifest_lines = []
+    n_empty = 0
+    for header, lines in records:
+        seq = b''.join(lines).translate(None, GAP_CHARACTERS)
+        #the id is the first word of the header, as Biopython uses it
+        title = header.split(None, 1)
+        id = title[0].decode() if title else ''
+        if not seq:
+            n_empty += 1
+            continue
+        if method == 'reverse':
+            decoy = seq[::-1]
+        else:
+            residues = bytearray(seq)
+            random.Random(f'{seed}\t{id}').shuffle(residues)
+            decoy = bytes(residues)
+        fasta_lines.append(b'>' + prefix.encode() + header + b'\n')
+        fasta_lines.extend(decoy[i:i + FASTA_LINE_WIDTH] + b'\n' for i in range(0, len(decoy), FASTA_LINE_WIDTH))
+        manifest_lines.append(f'{prefix}{id}\t{id}\t{method}\t{len(decoy)}\n')
+    return b''.join(fasta_lines), ''.join(manifest_lines), n_empty
+
+def decoy_maker(in_seq, out_seq, method = 'reverse', seed = 1, processes = 1, prefix = None, manifest = None):
+    """This function makes the decoys of all the sequences of a fasta file and their manifest.
+    The output is only made again when the input or parameters changed since it was made.
+
+    Args:
+        in_seq (str): path to the fasta file, can be compressed
+        out_seq (str): path to the decoy fasta file, compressed when it ends in '.gz' or '.zst'
+        method (str): 'reverse' or 'shuffle'. Defaults to 'reverse'.
+        seed (int): the seed of the shuffle. Defaults to 1.
+        processes (int): the number of processes that make the decoys. Defaults to 1.
+        prefix (str): the prefix of the decoy ids. Defaults to None, then that of the method in DECOY_PREFIXES.
+        manifest (str): path to the manifest. Defaults to None, then it is saved next to out_seq.
+
+    Returns:
+        int: the number of decoys, None when the output was up to date
+    """
+    prefix = DECOY_PREFIXES[method] if prefix is None else prefix
+    manifest = manifest_namer(out_seq) if manifest is None else manifest
+    params = {'stage': 'decoy_maker', 'method': method, 'seed': seed if method == 'shuffle' else None,
+              'prefix': prefix, 'manifest': manifest}
+    up_to_date, cache_manifest = stage_cache_checker(out_seq, [in_seq], params)
+    if up_to_date and exists(manifest):
+        print(f'{out_seq} is up to date, moving on...')
+        return None
+    n_decoys = 0
+    n_empty = 0
+    chunks = ((records, method, seed, prefix) for records in fasta_chunk_reader(in_seq))
+    with stage_timer('decoy making') as counts, atomic_writer(out_seq, 'wb') as f, \
+            atomic_writer(manifest) as f_manifest:
+        f_manifest.write(MANIFEST_HEADER)
+        for fasta_bytes, manifest_lines, chunk_empty in ordered_process_mapper(decoy_chunk_maker, chunks, processes):
+            f.write(fasta_bytes)
+            f_manifest.write(manifest_lines)
+            n_decoys += manifest_lines.count('\n')
+            n_empty += chunk_empty
+        counts['rows'] = n_decoys
+    stage_cache_writer(out_seq, cache_manifest)
+    if n_empty:
+        print(f'{n_empty} sequences were empty after removing the gaps and have no decoy')
+    print(f'{out_seq} has been made with {n_decoys} decoys')
+    return n_decoys
+
+def decoy_manifest_loader(manifest):
+    """This function loads a decoy manifest
+
+    Args:
+        manifest (str): path to the manifest made by decoy_maker
+
+    Returns:
+        dict: key: decoy id; value: the id of the sequence it was made from
+    """
+    decoys = {}
+    with file_opener(manifest) as f:
+        next(f)
+        for line in f:
+            decoy, source = line.split('\t', 2)[:2]
+            decoys[decoy] = source
+    return decoys
+
+def decoy_labeler(ids, manifest):
+    """This function gets the class of queries, 'neg' for the decoys in a manifest
+    and 'pos' for the other queries
+
+    Args:
+        ids (iterable): the query ids
+        manifest (str): path to the manifest made by decoy_maker
+
+    Returns:
+        list: the class of every query
+    """
+    decoys = decoy_manifest_loader(manifest)
+    return ['neg' if id in decoys else 'pos' for id in ids]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Make reversed or shuffled decoys of the sequences of a fasta file')
+    parser.add_argument('in_seq', help = 'fasta file of the sequences, can be compressed')
+    parser.add_argument('out_seq', help = "fasta file to write the decoys to, compressed when it ends in '.gz' or '.zst'")
+    parser.add_argument('--shuffle', action = 'store_true', help = 'shuffle the sequences instead of reversing them')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the shuffle')
+    parser.add_argument('-p', '--processes', type = int, default = 1, help = 'number of processes that make the decoys')
+    parser.add_argument('--prefix', default = None,
+                        help = "prefix of the decoy ids. Defaults to 'rev_', or 'shuf_' with --shuffle")
+    parser.add_argument('--manifest', default = None, help = 'path to the manifest. Defaults to $out_seq.manifest.tsv')
+    args = parser.parse_args()
+    decoy_maker(args.in_seq, args.out_seq, 'shuffle' if args.shuffle else 'reverse', args.seed, args.processes,
+                args.prefix, args.manifest)
@@ -5,14 +5,47 @@ Name = Jori de Leuw
 Description = this script extract features from diamond tables
 """
 
-from orphan_selector import query_selector
-from Bio.SeqIO.FastaIO import FastaIterator
-import subprocess as sp
+import sys
+import argparse
+import shutil
+from bisect import bisect_left
+from contextlib import ExitStack
 from os.path import exists
-import portion as P
 import numpy as np
-from general_functions import dir_maker
-from concurrent.futures import ThreadPoolExecutor
+from general_functions import dir_maker, file_opener, compression_detector
+from fasta_index import fasta_lengths, fasta_ids
+from preprocessing import length_normalizer
+from feature_table import binary_table_checker, table_writer, table_loader, BINARY_SUFFIX
+from stage_cache import stage_cache_checker, stage_cache_writer, manifest_loader, atomic_writer
+from stage_profiler import stage_timer, timed_iterator
+import pandas as pd
+from diamond_table import (
+    diamond_table_reader, query_group_reader, table_shard_maker, shard_line_reader, array_grower, CHUNKSIZE
+)
+from orphan_selector import orphan_group_selector
+from decoy_maker import decoy_labeler
+from hit_sketches import (
+    p2_maker, p2_adder, p2_quantile, p2_merger, hll_maker, hll_adder, hll_counter, hll_merger, top_k_adder,
+    top_k_merger, TOP_K
+)
+from concurrent.futures import ProcessPoolExecutor
+
+FEATURE_COLUMNS = [
+    'alignment_count', 'avg_identity', 'avg_eval', 'avg_bit_score', 'avg_coverage', 'min_eval', 'highest_pident',
+    'avg_alignment_length', 'highest_bit_score', 'highest_alignment_length', 'query_coverage'
+]
+#the features added by version 2, calculated in constant memory per query with the sketches of hit_sketches.py
+#the quantiles of the evalue and bit score of the hits of a query in version 2
+QUANTILES = (0.1, 0.5, 0.9)
+EXTENDED_FEATURE_COLUMNS = [
+    'p10_eval', 'median_eval', 'p90_eval', 'p10_bit_score', 'median_bit_score', 'p90_bit_score', 'distinct_subjects', f'top{TOP_K}_avg_bit_score', f'top{TOP_K}_avg_identity',
+    'mismatch_rate', 'gap_open_rate', 'avg_subject_span'
+]
+#key: version of the features; value: the columns of the feature table
+FEATURE_VERSIONS = {1: FEATURE_COLUMNS, 2: FEATURE_COLUMNS + EXTENDED_FEATURE_COLUMNS}
+FEATURE_HEADERS = {version: 'query\t' + '\t'.join(columns) + '\n' for version, columns in FEATURE_VERSIONS.items()}
+#the default version, cached feature tables of another version are made again
+FEATURE_VERSION = 1
 
 def fasta_parser(fasta):
     """This function parses a fasta file
@@ -23,13 +56,59 @@ def fasta_parser(fasta):
     Returns:
         dict: key: record id; value: record sequence
     """
+    #Biopython is only imported by the old engine that uses it
+    from Bio.SeqIO.FastaIO import FastaIterator
     #get the query sequence
     records = {}
-    with open(fasta) as handle:
+    with file_opener(fasta) as handle:
         for record in FastaIterator(handle):
             records[record.id] = record.seq
     return records
 
+def interval_merger(interval):
+    """This function merges overlapping and touching intervals by sorting
+    them and sweeping over them once
+
+    Args:
+        interval (list): a list of lists containing the intervals
+
+    Returns:
+        list: the sorted, disjoint intervals that cover the same values
+    """
+    merged = []
+    #intervals with the lower bound above the upper bound are empty
+    for lower, upper in sorted((x, y) for x, y in interval if x <= y):
+        if merged and lower <= merged[-1][1]:
+            if upper > merged[-1][1]:
+                merged[-1][1] = upper
+        else:
+            merged.append([lower, upper])
+    return merged
+
+def interval_adder(merged, lower, upper):
+    """This function adds an interval to sorted, disjoint intervals, as interval_merger
+    would merge them. The number of intervals is at most half the length of the query,
+    however many intervals are added.
+
+    Args:
+        merged (list): the sorted, disjoint intervals, is updated
+        lower (float): the lower bound of the interval
+        upper (float): the upper bound of the interval
+    """
+    #intervals with the lower bound above the upper bound are empty
+    if lower > upper:
+        return
+    #the first interval that starts at or after the lower bound, or the one before it when it reaches the lower bound
+    start = bisect_left(merged, [lower])
+    if start > 0 and merged[start - 1][1] >= lower:
+        start -= 1
+    end = start
+    while end < len(merged) and merged[end][0] <= upper:
+        lower = min(lower, merged[end][0])
+        upper = max(upper, merged[end][1])
+        end += 1
+    merged[start:end] = [[lower, upper]]
+
 def value_inside_interval(interval):
     """This function counts the number that is inside the interval
 
@@ -39,17 +118,75 @@ def value_inside_interval(interval):
     Returns:
         int: the counted number inside the interval
     """
-    #make empty interval
-    I = P.empty()
-    #append the list of lists into the interval
-    for x,y in interval:
-        I = I | P.closed(x,y) 
-    #count the value inside the interval
+    #count the value inside the merged interval
     n = 0
-    for interval in I:
-        n += (interval.upper - interval.lower)
+    for lower, upper in interval_merger(interval):
+        n += (upper - lower)
     return n
 
+def query_coverage_calculator(codes, qstart, qend, n_queries, lengths = None):
+    """This function counts the number inside the union of the intervals of
+    every query at once. The intervals are sorted per query and the highest
+    upper bound seen so far is carried along, so every interval only adds the
+    part that lies beyond it.
+
+    Args:
+        codes (np array): the query code of every interval
+        qstart (np array): the lower bound of every interval
+        qend (np array): the upper bound of every interval
+        n_queries (int): the number of queries
+        lengths (np array): the length of every query, if given the per residue
+        depth of the alignments is calculated as well. Defaults to None.
+
+    Returns:
+        np array: the counted number inside the interval per query, and if lengths
+        is given also a list with the alignment depth of every residue per query
+    """
+    #intervals with the lower bound above the upper bound are empty
+    keep = qstart <= qend
+    codes, qstart, qend = codes[keep], qstart[keep], qend[keep]
+    order = np.lexsort((qstart, codes))
+    codes, qstart, qend = codes[order], qstart[order], qend[order]
+    coverage = np.zeros(n_queries)
+    if len(codes) != 0:
+        #shift every query beyond the previous one, so one running maximum covers all queries
+        offset = codes * (qend.max() - min(qstart.min(), 0) + 1)
+        highest_end = np.maximum.accumulate(qend + offset) - offset
+        previous_end = np.empty_like(highest_end)
+        previous_end[1:] = highest_end[:-1]
+        first = np.ones(len(codes), dtype = bool)
+        first[1:] = codes[1:] != codes[:-1]
+        previous_end[first] = qstart[first]
+        added = np.maximum(qend - np.maximum(qstart, previous_end), 0)
+        coverage = np.bincount(codes, weights = added, minlength = n_queries)
+    if lengths is None:
+        return coverage
+    return coverage, depth_profile_calculator(codes, qstart, qend, lengths)
+
+def depth_profile_calculator(codes, qstart, qend, lengths):
+    """This function counts for every residue of every query the number of
+    alignments that cover it
+
+    Args:
+        codes (np array): the query code of every alignment
+        qstart (np array): the first aligned residue (1-based) of every alignment
+        qend (np array): the last aligned residue of every alignment
+        lengths (np array): the length of every query
+
+    Returns:
+        list: np array with the depth of every residue per query
+    """
+    lengths = np.asarray(lengths, dtype = np.int64)
+    #one difference array for all queries, with one extra position per query
+    starts = np.concatenate([[0], np.cumsum(lengths + 1)])
+    diff = np.zeros(starts[-1], dtype = np.int64)
+    first = np.clip(np.asarray(qstart, dtype = np.int64) - 1, 0, lengths[codes])
+    last = np.clip(np.asarray(qend, dtype = np.int64), 0, lengths[codes])
+    np.add.at(diff, starts[:-1][codes] + first, 1)
+    np.add.at(diff, starts[:-1][codes] + last, -1)
+    depth = np.cumsum(diff)
+    return [depth[starts[i]:starts[i] + length] for i, length in enumerate(lengths)]
+
 def feature_avg_calculator(table, query_ids, records):
     """This function calculates the number of alignments and the 
     average percent identity, evalue, bit score and coverage for a given query.
@@ -77,7 +214,7 @@ def feature_avg_calculator(table, query_ids, records):
         bit_score_list = []
         n_matches_list = []
         query_coverage = []
-        with open(table) as f:
+        with file_opener(table) as f:
             for line in f:
                 if line.startswith(query):
                     #sum all the values for each line that starts with the query
@@ -113,6 +250,279 @@ def feature_avg_calculator(table, query_ids, records):
                 ]
     return features
 
+def hit_accumulator(hits, columns, version = FEATURE_VERSION):
+    """This function adds a single alignment of a diamond table to the
+    running sums, minima and maxima of its query. The memory of a query does not
+    grow with its number of alignments: the query coverage keeps the merged
+    intervals and version 2 keeps the sketches of hit_sketches.py.
+
+    Args:
+        hits (dict): the running values of the query, None for the first alignment
+        columns (list): the 12 columns of the diamond table line
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        dict: the updated running values of the query
+    """
+    pident = float(columns[2])
+    length = float(columns[3])
+    evalue = float(columns[10])
+    bit_score = float(columns[11])
+    if hits is None:
+        hits = {
+            'alignment_count': 1, 'percent_identity': pident, 'eval': evalue, 'bit_score': bit_score,
+            'n_matches': length, 'min_eval': evalue, 'top_identity': pident, 'top_bit_score': bit_score,
+            'top_n_matches': length, 'query_coverage': []
+        }
+        if version >= 2:
+            hits.update({
+                'eval_quantiles': [p2_maker(q) for q in QUANTILES],
+                'bit_score_quantiles': [p2_maker(q) for q in QUANTILES], 'subjects': hll_maker(),
+                'top_hits': [], 'mismatch': 0.0, 'gap_open': 0.0, 'subject_span': 0.0
+            })
+    else:
+        #sum the values in the same order as they appear in the table
+        hits['alignment_count'] += 1
+        hits['percent_identity'] += pident
+        hits['eval'] += evalue
+        hits['bit_score'] += bit_score
+        hits['n_matches'] += length
+        hits['min_eval'] = min(hits['min_eval'], evalue)
+        hits['top_identity'] = max(hits['top_identity'], pident)
+        hits['top_bit_score'] = max(hits['top_bit_score'], bit_score)
+        hits['top_n_matches'] = max(hits['top_n_matches'], length)
+    interval_adder(hits['query_coverage'], float(columns[6]), float(columns[7]))
+    if version >= 2:
+        for eval_sketch, bit_score_sketch in zip(hits['eval_quantiles'], hits['bit_score_quantiles']):
+            p2_adder(eval_sketch, evalue)
+            p2_adder(bit_score_sketch, bit_score)
+        hll_adder(hits['subjects'], columns[1])
+        top_k_adder(hits['top_hits'], (bit_score, pident))
+        hits['mismatch'] += float(columns[4])
+        hits['gap_open'] += float(columns[5])
+        hits['subject_span'] += abs(float(columns[9]) - float(columns[8])) + 1
+    return hits
+
+def hit_summarizer(hits, query_length, version = FEATURE_VERSION):
+    """This function converts the running values of a query to its features
+
+    Args:
+        hits (dict): the running values made by hit_accumulator
+        query_length (int): the length of the query sequence
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        list: the alignment count, avg identity, avg evalue, avg bit score, avg coverage,
+        min evalue, highest identity, avg alignment length, highest bit score,
+        highest alignment length and the query coverage, for version 2 followed by
+        the features in EXTENDED_FEATURE_COLUMNS
+    """
+    alignment_count = hits['alignment_count']
+    #Calculate averages
+    avg_identity = hits['percent_identity'] / alignment_count
+    avg_eval = hits['eval'] / alignment_count
+    avg_bit_score = (hits['bit_score'] / alignment_count) / query_length
+    avg_n_matches = hits['n_matches'] / alignment_count
+    avg_coverage = avg_n_matches / query_length
+    #calculate the top scores
+    top_bit_score = hits['top_bit_score'] / query_length
+    top_n_matches = hits['top_n_matches'] / query_length
+    counted_query_coverage = value_inside_interval(hits['query_coverage']) / query_length
+    features = [
+        alignment_count, avg_identity, avg_eval, avg_bit_score, avg_coverage, hits['min_eval'],
+        hits['top_identity'], avg_n_matches, top_bit_score, top_n_matches, counted_query_coverage
+    ]
+    if version >= 2:
+        #the best hits are summed from the best down, so the order of the lines does not matter
+        top_hits = sorted(hits['top_hits'], reverse = True)
+        #the alignments of a query can all have length 0, then there are no rates
+        n_matches = hits['n_matches']
+        features += [p2_quantile(sketch) for sketch in hits['eval_quantiles']]
+        features += [p2_quantile(sketch) / query_length for sketch in hits['bit_score_quantiles']]
+        features += [
+            hll_counter(hits['subjects']), sum(hit[0] for hit in top_hits) / len(top_hits) / query_length,
+            sum(hit[1] for hit in top_hits) / len(top_hits), hits['mismatch'] / n_matches if n_matches else np.nan,
+            hits['gap_open'] / n_matches if n_matches else np.nan, hits['subject_span'] / alignment_count
+        ]
+    return features
+
+def feature_stream_calculator(table, lengths, query_ids = None, version = FEATURE_VERSION):
+    """This function calculates the same features as feature_avg_calculator,
+    but reads the diamond table only once. The lines are grouped by the exact
+    query id of the first column, so ids that share a prefix are kept apart.
+
+    Args:
+        table (str): path to a diamond table
+        lengths (dict): key: record id (that should correspond to a query id)
+        value: the length of the corresponding sequence
+        query_ids (set): if given, only the features of these queries are calculated. Defaults to None.
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        dict: key: query id and value: list containing the features, in the order
+        in which the queries first appear in the table
+    """
+    query_hits = dict()
+    with stage_timer('feature calculation') as counts, file_opener(table) as f:
+        for line in f:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) < 12 or (query_ids is not None and columns[0] not in query_ids):
+                continue
+            query_hits[columns[0]] = hit_accumulator(query_hits.get(columns[0]), columns, version)
+        features = dict()
+        for query, hits in query_hits.items():
+            features[query] = hit_summarizer(hits, lengths[query], version)
+        counts['queries'] = len(features)
+    return features
+
+def feature_columnar_calculator(table, lengths, chunksize = CHUNKSIZE):
+    """This function calculates the same features as feature_stream_calculator,
+    but parses the diamond table in chunks of numpy arrays and calculates the
+    features as grouped reductions over the query codes. Only the features of
+    version 1 are calculated.
+
+    Args:
+        table (str): path to a diamond table
+        lengths (dict): key: record id (that should correspond to a query id)
+        value: the length of the corresponding sequence
+        chunksize (int): the number of lines per chunk. Defaults to CHUNKSIZE.
+
+    Returns:
+        dict: key: query id and value: list containing the features, in the order
+        in which the queries first appear in the table
+    """
+    columns = ['qseqid', 'pident', 'length', 'qstart', 'qend', 'evalue', 'bitscore']
+    count = np.zeros(0, dtype = np.int64)
+    sums = {column: np.zeros(0) for column in ('pident', 'evalue', 'bitscore', 'length')}
+    min_eval = np.zeros(0)
+    maxima = {column: np.zeros(0) for column in ('pident', 'bitscore', 'length')}
+    coverage_chunks = []
+    query_ids = []
+    chunks = timed_iterator('table parse', diamond_table_reader(table, columns, chunksize),
+                            rows = lambda chunk: len(chunk['qseqid']))
+    for chunk in chunks:
+        codes = chunk['qseqid']
+        query_ids = chunk['query_ids']
+        n_queries = len(query_ids)
+        with stage_timer('feature calculation', rows = len(codes)):
+            count = array_grower(count, n_queries, 0)
+            np.add.at(count, codes, 1)
+            #ufunc.at adds the values in table order, so the sums equal the line by line sums
+            for column in sums:
+                sums[column] = array_grower(sums[column], n_queries, 0.0)
+                np.add.at(sums[column], codes, chunk[column])
+            min_eval = array_grower(min_eval, n_queries, np.inf)
+            np.minimum.at(min_eval, codes, chunk['evalue'])
+            for column in maxima:
+                maxima[column] = array_grower(maxima[column], n_queries, -np.inf)
+                np.maximum.at(maxima[column], codes, chunk[column])
+        coverage_chunks.append((codes, chunk['qstart'], chunk['qend']))
+    if not query_ids:
+        return dict()
+    query_lengths = np.array([lengths[query] for query in query_ids], dtype = np.float64)
+    #calculate the query coverage of all queries at once
+    codes, qstart, qend = (np.concatenate(column) for column in zip(*coverage_chunks))
+    with stage_timer('coverage', rows = len(codes), queries = len(query_ids)):
+        query_coverage = query_coverage_calculator(codes, qstart, qend, len(query_ids))
+    avg_n_matches = sums['length'] / count
+    feature_columns = [
+        count, sums['pident'] / count, sums['evalue'] / count, (sums['bitscore'] / count) / query_lengths,
+        avg_n_matches / query_lengths, min_eval, maxima['pident'], avg_n_matches,
+        maxima['bitscore'] / query_lengths, maxima['length'] / query_lengths, query_coverage / query_lengths
+    ]
+    rows = zip(*[column.tolist() for column in feature_columns])
+    return {query: list(row) for query, row in zip(query_ids, rows)}
+
+def shard_hit_calculator(args):
+    """This function collects the running values of all queries in a byte range
+    of a diamond table. It is run in a worker process by feature_parallel_calculator.
+
+    Args:
+        args (tuple): containing 4 elements
+            element 1 (str): path to the diamond table
+            element 2 (int): the first byte of the range
+            element 3 (int): the last + 1 byte of the range
+            element 4 (int): the version of the features
+
+    Returns:
+        dict: key: query id; value: the running values made by hit_accumulator,
+        with the query coverage intervals already merged
+    """
+    table, start, end, version = args
+    query_hits = dict()
+    for line in shard_line_reader(table, start, end):
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) < 12:
+            continue
+        query_hits[columns[0]] = hit_accumulator(query_hits.get(columns[0]), columns, version)
+    #merging the intervals in the worker keeps the result small to send back
+    for hits in query_hits.values():
+        hits['query_coverage'] = interval_merger(hits['query_coverage'])
+    return query_hits
+
+def hit_merger(hits, other_hits):
+    """This function combines the running values of the same query from two
+    parts of a table, which only happens when the table is not grouped by query
+
+    Args:
+        hits (dict): the running values of the first part
+        other_hits (dict): the running values of the second part
+
+    Returns:
+        dict: the combined running values
+    """
+    for key in ('alignment_count', 'percent_identity', 'eval', 'bit_score', 'n_matches'):
+        hits[key] += other_hits[key]
+    hits['min_eval'] = min(hits['min_eval'], other_hits['min_eval'])
+    for key in ('top_identity', 'top_bit_score', 'top_n_matches'):
+        hits[key] = max(hits[key], other_hits[key])
+    hits['query_coverage'] = interval_merger(hits['query_coverage'] + other_hits['query_coverage'])
+    if 'eval_quantiles' in hits:
+        #the quantiles of the combined hits are approximated, see hit_sketches.p2_merger
+        for key in ('eval_quantiles', 'bit_score_quantiles'):
+            hits[key] = [p2_merger(sketch, other) for sketch, other in zip(hits[key], other_hits[key])]
+        hits['subjects'] = hll_merger(hits['subjects'], other_hits['subjects'])
+        hits['top_hits'] = top_k_merger(hits['top_hits'], other_hits['top_hits'])
+        for key in ('mismatch', 'gap_open', 'subject_span'):
+            hits[key] += other_hits[key]
+    return hits
+
+def feature_parallel_calculator(table, lengths, processes, n_shards = None, version = FEATURE_VERSION):
+    """This function calculates the same features as feature_stream_calculator with
+    a pool of processes. The table is split into byte ranges at query boundaries and
+    the results are merged in the order of the ranges, so for a table grouped by
+    query the output is the same for any number of processes.
+
+    Args:
+        table (str): path to a diamond table
+        lengths (dict): key: record id (that should correspond to a query id)
+        value: the length of the corresponding sequence
+        processes (int): the number of worker processes
+        n_shards (int): the number of byte ranges. Defaults to 4 ranges per process.
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        dict: key: query id and value: list containing the features, in the order
+        in which the queries first appear in the table
+    """
+    if n_shards is None:
+        n_shards = 4 * processes
+    shards = [(table, start, end, version) for start, end in table_shard_maker(table, n_shards)]
+    query_hits = dict()
+    with stage_timer('feature calculation') as counts:
+        with ProcessPoolExecutor(processes) as pool:
+            for shard_hits in pool.map(shard_hit_calculator, shards):
+                for query, hits in shard_hits.items():
+                    if query in query_hits:
+                        query_hits[query] = hit_merger(query_hits[query], hits)
+                    else:
+                        query_hits[query] = hits
+        features = dict()
+        for query, hits in query_hits.items():
+            features[query] = hit_summarizer(hits, lengths[query], version)
+        counts['queries'] = len(features)
+    return features
+
 def no_hit_adder(sim_fa, feature_dict):
     """This function appends keys to a dict that are not present.
     The value will be a list of NaN values of the length of the first
@@ -131,9 +541,8 @@ def no_hit_adder(sim_fa, feature_dict):
         break
     row = [np.nan for i in range(value_len)]
     row.insert(0, 0)
-    #get all the records from the simulated sequences
-    records = fasta_parser(sim_fa)
-    for id, seq in records.items():
+    #get all the ids from the simulated sequences
+    for id in fasta_ids(sim_fa):
         feature_dict.setdefault(id, row)
     return feature_dict         
 
@@ -154,48 +563,229 @@ def tsv_format_maker(header, features):
     tsv_format.extend(values)
     return tsv_format
 
+def feature_stage_applier(features, lengths, stages, version = FEATURE_VERSION):
+    """This function applies the optional post-processing stages to the features
+    at once, in this order: normalizing the alignment count by the query length,
+    dropping the queries without a hit, adding the class and randomly selecting rows
+
+    Args:
+        features (dict): key: query id; value: the features of the query
+        lengths (dict): key: query id; value: the length of the query sequence
+        stages (dict): the stages to apply, with the keys
+            'normalize_length' (bool): divide the alignment count by the query length
+            'drop_no_hits' (bool): drop the queries with an alignment count of 0
+            'class_label' (str): the value of the added CLASS column, e.g. 'pos' or 'neg'
+            'decoy_manifest' (str): path to a manifest of decoy_maker.py, the CLASS column
+            is 'neg' for the queries in it and 'pos' for the others
+            'sample_size' (int): the number of randomly selected rows, e.g. the number
+            of positive queries when making a balanced negative set
+            'seed' (int): the seed of the random selection
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        pd df: the features after the stages, indexed by query
+    """
+    df = pd.DataFrame.from_dict(features, orient = 'index', columns = FEATURE_VERSIONS[version])
+    if stages.get('drop_no_hits'):
+        df = df[df['alignment_count'] != 0]
+    if stages.get('normalize_length'):
+        df = length_normalizer(df, lengths)
+    if stages.get('class_label') is not None:
+        df['CLASS'] = stages['class_label']
+    if stages.get('decoy_manifest') is not None:
+        df['CLASS'] = decoy_labeler(df.index, stages['decoy_manifest'])
+    sample_size = stages.get('sample_size')
+    if sample_size is not None and sample_size < len(df):
+        rng = np.random.default_rng(stages.get('seed'))
+        #keep the selected rows in the order of the table
+        df = df.iloc[np.sort(rng.choice(len(df), sample_size, replace = False))]
+    return df
+
+def feature_increment_adder(table, fasta, sim_fa, out, version = FEATURE_VERSION):
+    """This function adds the features of new sequences to an existing feature table.
+    Only the lines of the queries that are not in the table yet are used, the rows
+    that are already in the table are kept as they are. This relies on the hits of a
+    query not depending on the other queries, as for diamond against the same database.
+
+    Args:
+        table (str): path to the diamond table
+        fasta (str): path to the fasta file containing the query sequences
+        sim_fa (str): path to simulated fasta file
+        out (str): path to the existing feature table
+        version (int): the version of the features in the table. Defaults to FEATURE_VERSION.
+
+    Returns:
+        int: the number of added queries
+    """
+    if binary_table_checker(out):
+        old_ids = set(table_loader(out).index.astype(str))
+    else:
+        with file_opener(out) as f:
+            next(f, None)
+            old_ids = {line.split('\t', 1)[0] for line in f}
+    new_ids = [id for id in fasta_ids(sim_fa) if id not in old_ids]
+    if not new_ids:
+        return 0
+    features = feature_stream_calculator(table, fasta_lengths(fasta), set(new_ids), version)
+    #append new sequences that did not get a hit
+    row = [0] + [np.nan] * (len(FEATURE_VERSIONS[version]) - 1)
+    for id in new_ids:
+        features.setdefault(id, row)
+    if binary_table_checker(out):
+        new_df = feature_stage_applier(features, None, {}, version)
+        table_writer(pd.concat([table_loader(out), new_df]), out)
+    else:
+        with file_opener(out) as old, atomic_writer(out) as f:
+            shutil.copyfileobj(old, f)
+            f.writelines(tsv_format_maker([], features))
+    return len(new_ids)
+
 def diamond_feature_extractor(args):
     """This function extracts features from a diamond table for each
     given query id. For each query it calculates the number of alignments, 
-    the average identity, average evalue, average bit score and the query coverage
+    the average identity, average evalue, average bit score and the query coverage.
+    The output is only made again when the inputs or parameters changed since it was made.
 
     Args:
         args (list): containg 5 elements
             element 1 (str): path to the diamond table
             element 2 (str): path to the fasta file containing the query sequences
             element 3 (str): path to simulated fasta file
-            element 4 (str): path to the output file
+            element 4 (str): path to the output file, the table is written in the
+            binary format of feature_table.py when it ends in '.ftab'
+            element 5 (int, optional): the number of processes, the features are
+            calculated in parallel when more than 1. Defaults to 1.
+            element 6 (dict, optional): the post-processing stages applied before
+            writing, see feature_stage_applier. Defaults to no stages.
+            element 7 (bool, optional): whether to only add the features of new sequences to
+            an existing table made with the same parameters, see feature_increment_adder.
+            Defaults to False.
+            element 8 (int, optional): the version of the features, see FEATURE_VERSIONS.
+            Defaults to FEATURE_VERSION.
     """
     table = args[0]
     fasta = args[1]
     sim_fa = args[2]
     out = args[3]
-    if exists(out):
-        print(f'The file "{out}" already exists, moving on...')
+    processes = args[4] if len(args) > 4 else 1
+    stages = args[5] if len(args) > 5 else None
+    incremental = args[6] if len(args) > 6 else False
+    version = args[7] if len(args) > 7 else FEATURE_VERSION
+    params = {'stage': 'diamond_feature_extractor', 'feature_version': version, 'stages': stages or {}}
+    inputs = [table, fasta, sim_fa]
+    if stages and stages.get('decoy_manifest') is not None:
+        #the labels change with the content of the manifest
+        inputs.append(stages['decoy_manifest'])
+    up_to_date, manifest = stage_cache_checker(out, inputs, params)
+    previous = manifest_loader(out)
+    if up_to_date:
+        print(f'The file "{out}" is up to date, moving on...')
+    elif incremental and not stages and exists(out) and previous is not None and previous['params'] == params:
+        n_new = feature_increment_adder(table, fasta, sim_fa, out, version)
+        stage_cache_writer(out, manifest)
+        print(f'{n_new} new queries have been added to "{out}", moving on...')
     else:
-        #Get all unique query ids
-        query_ids = query_selector(table)
-        #get sequences
-        sequences = fasta_parser(fasta)
-        #get features
-        features_temp = feature_avg_calculator(table, query_ids, sequences)
+        #get the sequence lengths from the fasta index
+        lengths = fasta_lengths(fasta)
+        #get features as grouped reductions over the columns of the table, a compressed
+        #table can not be split into byte ranges, but is decompressed in parallel
+        if processes > 1 and compression_detector(table) is None:
+            features_temp = feature_parallel_calculator(table, lengths, processes, version = version)
+        elif version == 1:
+            features_temp = feature_columnar_calculator(table, lengths)
+        else:
+            #the sketches of the extended features are updated line by line
+            features_temp = feature_stream_calculator(table, lengths, version = version)
         #append sequences that did not get a hit
         features = no_hit_adder(sim_fa, features_temp)
-        #convert features to tsv format
-        header1 = 'query\talignment_count\tavg_identity\tavg_eval\tavg_bit_score\tavg_coverage\tmin_eval\thighest_pident\t'
-        header2 = 'avg_alignment_length\thighest_bit_score\thighest_alignment_length\tquery_coverage\n'
-        header = [header1 + header2]
-        tsv_format = tsv_format_maker(header, features)
         #make dir to put the table into
         dir = '/'.join(out.split('/')[:-1])
         dir_maker(dir)
-        #write the list to a file
-        with open(out, 'a') as f:
-            for line in tsv_format:
-                f.write(line)
+        if stages or binary_table_checker(out):
+            #the stages need the length of all the sequences, including those without a hit
+            lengths = fasta_lengths(sim_fa) if stages and stages.get('normalize_length') else None
+            df = feature_stage_applier(features, lengths, stages or {}, version)
+            table_writer(df, out)
+        else:
+            #convert features to tsv format
+            header = [FEATURE_HEADERS[version]]
+            tsv_format = tsv_format_maker(header, features)
+            #write the list to a temporary file that replaces the output when it is complete
+            with stage_timer('tsv writing', rows = len(features)), atomic_writer(out) as f:
+                for line in tsv_format:
+                    f.write(line)
+        stage_cache_writer(out, manifest)
         print(f'The file "{out}" has been made, moving on...')
 
-def main(orphan_seq, diamond_table, diamond_seq, out_dir):
+def feature_stream_writer(query_groups, lengths, out_handle, version = FEATURE_VERSION):
+    """This function calculates the features of each query group as soon as
+    the group is read and writes the feature row directly
+
+    Args:
+        query_groups (iterable): tuples of a query id and the columns of its lines
+        lengths (dict): key: query id; value: length of the query sequence
+        out_handle (file): the opened output table
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        set: the query ids that have been written
+    """
+    written = set()
+    for query, lines in query_groups:
+        hits = None
+        for columns in lines:
+            hits = hit_accumulator(hits, columns, version)
+        features = hit_summarizer(hits, lengths[query], version)
+        out_handle.write('{}\t{}\n'.format(query, '\t'.join(map(str, features))))
+        written.add(query)
+    return written
+
+def stream_feature_extractor(table, orphan_seq, diamond_seq, out, eval_cutoff = None, version = FEATURE_VERSION):
+    """This function extracts the features from a diamond table that is read as a stream,
+    for example directly from the output of diamond. The lines of a query should be
+    grouped together, as diamond writes them. Only the lines of one query are kept in memory.
+
+    Args:
+        table (str): path to the diamond table, '-' to read from stdin
+        orphan_seq (str): path to the fasta file of all the sequences, the ones
+        without a feature row get a row without hits
+        diamond_seq (str): path to the fasta file with the query sequences of the table
+        out (str): path to the output file
+        eval_cutoff (float): if given, only the queries without a hit below this
+        evalue get features, as the orphans selected by orphan_selector. Defaults to None.
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+    """
+    #a table read from stdin can not be hashed, so only tables on disk are cached
+    if table != '-':
+        params = {'stage': 'stream_feature_extractor', 'feature_version': version, 'eval_cutoff': eval_cutoff}
+        up_to_date, manifest = stage_cache_checker(out, [table, orphan_seq, diamond_seq], params)
+        if up_to_date:
+            print(f'The file "{out}" is up to date, moving on...')
+            return
+    lengths = fasta_lengths(diamond_seq)
+    dir = '/'.join(out.split('/')[:-1])
+    dir_maker(dir)
+    with ExitStack() as stack:
+        handle = sys.stdin if table == '-' else stack.enter_context(file_opener(table))
+        with atomic_writer(out) as f:
+            f.write(FEATURE_HEADERS[version])
+            query_groups = query_group_reader(handle)
+            if eval_cutoff is not None:
+                query_groups = orphan_group_selector(query_groups, eval_cutoff)
+            with stage_timer('feature calculation') as counts:
+                written = feature_stream_writer(query_groups, lengths, f, version)
+                counts['queries'] = len(written)
+            #append sequences that did not get a hit
+            row = '\t'.join(map(str, [0] + [np.nan] * (len(FEATURE_VERSIONS[version]) - 1)))
+            for id in fasta_ids(orphan_seq):
+                if id not in written:
+                    f.write(f'{id}\t{row}\n')
+    if table != '-':
+        stage_cache_writer(out, manifest)
+    print(f'The file "{out}" has been made, moving on...')
+
+def main(orphan_seq, diamond_table, diamond_seq, out_dir, stream = False, eval_cutoff = None, processes = 1,
+         stages = None, binary = False, incremental = False, compression = None, feature_version = FEATURE_VERSION):
     """This function extracts features from a diamond table.
     Note that the diamond table should have the default table format:
     qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore
@@ -205,19 +795,83 @@ def main(orphan_seq, diamond_table, diamond_seq, out_dir):
         diamond_table (str): path to the file containing the diamond table
         diamond_seq (str): path to the file containing the sequences corresponding to the diamond table
         out_dir (str): path to where the output directory should be written
+        stream (bool): whether to read the table as a stream grouped by query. Defaults to False.
+        eval_cutoff (float): in stream mode, only extract the features of queries without
+        a hit below this evalue. Defaults to None.
+        processes (int): the number of processes used to calculate the features. Defaults to 1.
+        stages (dict): the post-processing stages applied before writing, see
+        feature_stage_applier. Not available in stream mode. Defaults to None.
+        binary (bool): whether to write the table in the binary format of feature_table.py,
+        as diamond_features.ftab. Not available in stream mode. Defaults to False.
+        incremental (bool): whether to only add the features of new sequences to an existing
+        table. Defaults to False.
+        compression (str): the extension of the compressed tsv table, 'gz' or 'zst'.
+        Defaults to None, then the table is not compressed.
+        feature_version (int): the version of the features, see FEATURE_VERSIONS. Version 2
+        adds the features in EXTENDED_FEATURE_COLUMNS. Defaults to FEATURE_VERSION.
     Returns:
         str: path to the output directory of the features tables
     """
     out_features = f'{out_dir}/diamond_features'
 
     #get input for the "diamond_feature_extractor" function
-    out = f'{out_features}/diamond_features.tsv'
+    out = f'{out_features}/diamond_features' + (BINARY_SUFFIX if binary else '.tsv')
+    if compression is not None and not binary:
+        out = f'{out}.{compression}'
     #add the paths to the list
-    feature_extraction_args = [diamond_table, diamond_seq, orphan_seq, out]
+    feature_extraction_args = [diamond_table, diamond_seq, orphan_seq, out, processes, stages, incremental,
+                               feature_version]
     #extract features for each query id
-    diamond_feature_extractor(feature_extraction_args)
+    if stream:
+        stream_feature_extractor(diamond_table, orphan_seq, diamond_seq, out, eval_cutoff, feature_version)
+    else:
+        diamond_feature_extractor(feature_extraction_args)
     #Get the table with the least amount of rows and select this number of rows for all tables
     return out
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Extract features from a diamond table')
+    parser.add_argument('orphan_seq', help = 'fasta file of all the sequences')
+    parser.add_argument('diamond_table', help = "diamond table in the default table format, '-' to read stdin")
+    parser.add_argument('diamond_seq', help = 'fasta file of the query sequences of the diamond table')
+    parser.add_argument('out_dir', help = 'directory to write diamond_features/diamond_features.tsv to')
+    parser.add_argument('--stream', action = 'store_true',
+                        help = 'read the table as a stream of lines grouped by query, with constant memory')
+    parser.add_argument('--eval-cutoff', type = float, default = None,
+                        help = 'in stream mode, only use the queries without a hit below this evalue')
+    parser.add_argument('-p', '--processes', type = int, default = 1,
+                        help = 'number of processes to calculate the features with')
+    parser.add_argument('--normalize-length', action = 'store_true',
+                        help = 'divide the alignment count by the query length, as normalization_a_count.py')
+    parser.add_argument('--drop-no-hits', action = 'store_true', help = 'drop the queries without a hit')
+    labels = parser.add_mutually_exclusive_group()
+    labels.add_argument('--class-label', default = None, help = "add a CLASS column with this value, e.g. 'pos' or 'neg'")
+    labels.add_argument('--decoy-manifest', default = None,
+                        help = "add a CLASS column, 'neg' for the decoys in this manifest of decoy_maker.py and 'pos' for the others")
+    parser.add_argument('--sample-size', type = int, default = None,
+                        help = 'randomly select this number of queries, e.g. the number of positives for the negative set')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the random selection')
+    parser.add_argument('--binary', action = 'store_true',
+                        help = 'write the table in the binary format (diamond_features.ftab) instead of tsv')
+    parser.add_argument('--incremental', action = 'store_true',
+                        help = 'only add the features of new sequences to an existing table made with the same settings')
+    parser.add_argument('--compress', default = None, choices = ['gz', 'zst'],
+                        help = 'compress the tsv table, as diamond_features.tsv.gz (bgzf) or diamond_features.tsv.zst')
+    parser.add_argument('--feature-version', type = int, default = FEATURE_VERSION, choices = sorted(FEATURE_VERSIONS),
+                        help = 'version of the features, 2 adds quantiles, distinct subjects, the best hits and '
+                               'the mismatch and gap rates to the 11 features of version 1')
+    args = parser.parse_args()
+    if args.diamond_table == '-' and not args.stream:
+        parser.error("reading the diamond table from stdin requires --stream")
+    stages = {
+        'normalize_length': args.normalize_length, 'drop_no_hits': args.drop_no_hits,
+        'class_label': args.class_label, 'decoy_manifest': args.decoy_manifest, 'sample_size': args.sample_size
+    }
+    #only keep the stages that are asked for
+    stages = {stage: value for stage, value in stages.items() if value not in (None, False)}
+    if args.sample_size is not None:
+        stages['seed'] = args.seed
+    if args.stream and (stages or args.binary):
+        parser.error('the post-processing stages and --binary are not available with --stream')
+    main(args.orphan_seq, args.diamond_table, args.diamond_seq, args.out_dir, args.stream, args.eval_cutoff,
+         args.processes, stages, args.binary, args.incremental, args.compress, args.feature_version)
\ No newline at end of file
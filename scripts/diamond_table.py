@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains the functions that read diamond tables
+in the default table format into numpy arrays, one chunk at the time.
+
+This file should not be run on its own as a script
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from general_functions import file_opener
+
+DIAMOND_COLUMNS = [
+    'qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',
+    'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore'
+]
+DIAMOND_DTYPES = {
+    'qseqid': str, 'sseqid': str, 'pident': np.float64, 'length': np.int64, 'mismatch': np.int64,
+    'gapopen': np.int64, 'qstart': np.int64, 'qend': np.int64, 'sstart': np.int64, 'send': np.int64,
+    'evalue': np.float64, 'bitscore': np.float64
+}
+CHUNKSIZE = 10 ** 6
+
+def id_encoder(ids, index, id_list):
+    """This function converts ids to integer codes that stay the same
+    over all the chunks of a table
+
+    Args:
+        ids (array): the ids of one chunk
+        index (dict): key: id; value: code, is updated with the new ids
+        id_list (list): the ids ordered by code, is updated with the new ids
+
+    Returns:
+        np array: the code of every id
+    """
+    #only the unique ids of the chunk are looked up in python
+    codes, uniques = pd.factorize(ids)
+    unique_codes = np.empty(len(uniques), dtype = np.int64)
+    for i, id in enumerate(uniques):
+        code = index.get(id)
+        if code is None:
+            code = index[id] = len(id_list)
+            id_list.append(id)
+        unique_codes[i] = code
+    return unique_codes[codes]
+
+def diamond_table_reader(table, columns = DIAMOND_COLUMNS, chunksize = CHUNKSIZE):
+    """This function reads a diamond table in chunks of typed numpy arrays.
+    The query and subject ids are encoded as integer codes, the ids belonging
+    to the codes are kept in the 'query_ids' and 'subject_ids' lists, which are
+    shared by all the chunks and grow in order of first appearance.
+
+    Args:
+        table (str): path to a diamond table
+        columns (list): the columns that should be read. Defaults to all 12 columns.
+        chunksize (int): the number of lines per chunk. Defaults to CHUNKSIZE.
+
+    Yields:
+        dict: key: column name; value: np array of the column, plus the
+        'query_ids' and 'subject_ids' lists
+    """
+    query_index, query_ids = {}, []
+    subject_index, subject_ids = {}, []
+    with file_opener(table) as f:
+        try:
+            reader = pd.read_csv(
+                f, sep = '\t', header = None, names = DIAMOND_COLUMNS, usecols = columns,
+                dtype = {column: DIAMOND_DTYPES[column] for column in columns}, chunksize = chunksize,
+                na_filter = False, float_precision = 'round_trip'
+            )
+        except pd.errors.EmptyDataError:
+            #a diamond run without any hit writes an empty table
+            return
+        for df in reader:
+            chunk = {'query_ids': query_ids, 'subject_ids': subject_ids}
+            for column in columns:
+                if column == 'qseqid':
+                    chunk[column] = id_encoder(df[column].to_numpy(), query_index, query_ids)
+                elif column == 'sseqid':
+                    chunk[column] = id_encoder(df[column].to_numpy(), subject_index, subject_ids)
+                else:
+                    chunk[column] = df[column].to_numpy()
+            yield chunk
+
+def array_grower(array, size, fill_value):
+    """This function enlarges an array of grouped values when new groups appear
+
+    Args:
+        array (np array): the grouped values
+        size (int): the new number of groups
+        fill_value (float): the value of the new groups
+
+    Returns:
+        np array: the array with the new groups appended
+    """
+    if len(array) >= size:
+        return array
+    return np.concatenate([array, np.full(size - len(array), fill_value, dtype = array.dtype)])
+
+def query_group_reader(handle, check_grouped = True):
+    """This function reads a diamond table line by line and collects the lines
+    of one query at the time, as diamond writes all hits of a query together.
+    Only the lines of the current query are kept in memory.
+
+    Args:
+        handle (file): an opened diamond table, for example sys.stdin
+        check_grouped (bool): whether to raise an error when a query appears again after
+        the lines of another query. This keeps the finished query ids in memory. Defaults to True.
+
+    Raises:
+        ValueError: when check_grouped is True and the table is not grouped by query
+
+    Yields:
+        tuple: the query id and a list with the columns of each of its lines
+    """
+    finished = set()
+    query = None
+    lines = []
+    for line in handle:
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) < 12:
+            continue
+        if columns[0] != query:
+            if query is not None:
+                yield query, lines
+                if check_grouped:
+                    finished.add(query)
+            query = columns[0]
+            lines = []
+            if query in finished:
+                raise ValueError(f'The lines of query "{query}" are not grouped together in the diamond table')
+        lines.append(columns)
+    if query is not None:
+        yield query, lines
+
+def table_shard_maker(table, n_shards):
+    """This function splits a diamond table into byte ranges of about the same size.
+    Every range starts at the first line of a query, so when the table is grouped
+    by query all the lines of a query end up in the same range. The table should not
+    be compressed.
+
+    Args:
+        table (str): path to a diamond table
+        n_shards (int): the number of ranges to split the table into
+
+    Returns:
+        list: tuples with the first and the last + 1 byte of every range
+    """
+    size = os.path.getsize(table)
+    bounds = [0]
+    with open(table, 'rb') as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards, bounds[-1]))
+            #skip the rest of the line the offset falls in
+            if f.tell() != 0:
+                f.readline()
+            query = None
+            while True:
+                start = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                line_query = line.split(b'\t', 1)[0]
+                if query is not None and line_query != query:
+                    break
+                query = line_query
+            if start > bounds[-1]:
+                bounds.append(start)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def shard_line_reader(table, start, end):
+    """This function reads the lines of a byte range of a table
+
+    Args:
+        table (str): path to a diamond table
+        start (int): the first byte of the range, at the start of a line
+        end (int): the last + 1 byte of the range, at the start of a line
+
+    Yields:
+        str: the lines of the range
+    """
+    with open(table, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode()
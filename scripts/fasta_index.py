@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains functions to index fasta files. The index
+has the same format as the samtools faidx '.fai' file and is saved next to the
+fasta file, so it is only made once. The lengths and ids are read from the index
+and the sequences are read on demand from the memory mapped fasta file. For a
+compressed fasta file the offsets in the index are those of the decompressed file,
+as samtools uses them.
+
+This file should not be run on its own as a script
+"""
+
+import mmap
+from stage_profiler import stage_timer
+from os.path import exists, getmtime
+from general_functions import file_opener, compression_detector
+from stage_cache import atomic_writer
+
+def fasta_index_maker(fasta):
+    """This function indexes a fasta file and tries to save the index as '{fasta}.fai'
+
+    Args:
+        fasta (str): path to the fasta file
+
+    Returns:
+        dict: key: record id; value: list with the sequence length, the byte offset of
+        the sequence, the number of residues per line and the number of bytes per line
+    """
+    index = {}
+    entry = None
+    offset = 0
+    with file_opener(fasta, 'rb') as f:
+        for line in f:
+            offset += len(line)
+            if line.startswith(b'>'):
+                #the id is the first word of the header, as Biopython uses it
+                title = line[1:].decode().split(None, 1)
+                entry = [0, offset, 0, 0]
+                index[title[0] if title else ''] = entry
+            elif entry is not None:
+                residues = len(line.strip().replace(b' ', b''))
+                if entry[2] == 0:
+                    entry[2] = residues
+                    entry[3] = len(line)
+                entry[0] += residues
+    try:
+        #written to a temporary file first, so other processes never load a half written index
+        with atomic_writer(f'{fasta}.fai') as f:
+            for id, (length, offset, line_bases, line_width) in index.items():
+                f.write(f'{id}\t{length}\t{offset}\t{line_bases}\t{line_width}\n')
+    except OSError:
+        #the index is still usable without saving it, e.g. in a read only directory
+        pass
+    return index
+
+def fasta_index_loader(fasta):
+    """This function loads the index of a fasta file, the index is made first
+    when it does not exist or is older than the fasta file
+
+    Args:
+        fasta (str): path to the fasta file
+
+    Returns:
+        dict: key: record id; value: list with the sequence length, the byte offset of
+        the sequence, the number of residues per line and the number of bytes per line
+    """
+    fai = f'{fasta}.fai'
+    with stage_timer('fasta parsing') as counts:
+        if not exists(fai) or getmtime(fai) < getmtime(fasta):
+            index = fasta_index_maker(fasta)
+        else:
+            index = {}
+            with open(fai) as f:
+                for line in f:
+                    columns = line.rstrip('\n').split('\t')
+                    index[columns[0]] = [int(value) for value in columns[1:5]]
+        counts['rows'] = len(index)
+    return index
+
+def fasta_lengths(fasta):
+    """This function gets the length of every sequence in a fasta file
+
+    Args:
+        fasta (str): path to the fasta file
+
+    Returns:
+        dict: key: record id; value: the length of the sequence
+    """
+    return {id: entry[0] for id, entry in fasta_index_loader(fasta).items()}
+
+def fasta_ids(fasta):
+    """This function gets the ids of all the sequences in a fasta file
+
+    Args:
+        fasta (str): path to the fasta file
+
+    Returns:
+        list: the record ids in the order of the fasta file
+    """
+    return list(fasta_index_loader(fasta))
+
+def sequence_fetcher(fasta, ids, index = None):
+    """This function reads the sequences of the given ids from the memory mapped
+    fasta file, without reading the other sequences
+
+    Args:
+        fasta (str): path to the fasta file
+        ids (list): the record ids of the sequences
+        index (dict): the index of the fasta file. Defaults to None, then it is loaded.
+
+    Returns:
+        dict: key: record id; value: the sequence
+    """
+    if index is None:
+        index = fasta_index_loader(fasta)
+    sequences = {}
+    if not ids:
+        return sequences
+    if compression_detector(fasta) is not None:
+        #a compressed file can not be memory mapped, it is read until the last sequence is found
+        offsets = {index[id][1]: id for id in ids}
+        with file_opener(fasta, 'rb') as f:
+            offset = 0
+            id = None
+            for line in f:
+                offset += len(line)
+                if line.startswith(b'>'):
+                    if id is not None and len(sequences) == len(offsets):
+                        break
+                    id = offsets.get(offset)
+                    if id is not None:
+                        sequences[id] = []
+                elif id is not None:
+                    sequences[id].append(line.decode().strip().replace(' ', ''))
+        return {id: ''.join(sequences[id]) for id in ids}
+    with open(fasta, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+        for id in ids:
+            offset = index[id][1]
+            end = mm.find(b'\n>', offset - 1)
+            seq = mm[offset:end if end != -1 else len(mm)]
+            sequences[id] = seq.decode().replace('\n', '').replace('\r', '').replace(' ', '')
+    return sequences
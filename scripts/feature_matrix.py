@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script makes one wide feature table from several diamond tables
+of the same queries, e.g. searches of different databases, sensitivity modes or
+evalues. Every table gets its own features, with the name of the table as prefix of
+the columns ('uhgp_avg_identity', 'nr_avg_identity', ...).
+
+The tables are read at the same time as streams of query groups, so only the lines
+of the current query of every table are kept in memory and no table is loaded or
+joined with pandas. This is not a k-way merge of the query ids of the tables: the
+queries of the fasta file are walked in order and every table is advanced when its
+current query is the next one, because every query of the fasta file gets a row,
+also when it has no hit in any table. So the hits of a query should be grouped
+together, the queries should be in the order of the fasta file, as diamond writes
+them, or sorted by id (LC_ALL=C sort -k1,1) with --sorted, and every query of a
+table should be in the fasta file, otherwise an error names the table and the query.
+"""
+
+import argparse
+from contextlib import ExitStack
+from general_functions import dir_maker, file_opener, sample_namer
+from fasta_index import fasta_lengths
+from diamond_table import query_group_reader
+from diamond_feature_extractor import hit_accumulator, hit_summarizer, FEATURE_VERSIONS, FEATURE_VERSION
+from stage_cache import stage_cache_checker, stage_cache_writer, atomic_writer
+from stage_profiler import stage_timer
+
+def matrix_header_maker(names, version = FEATURE_VERSION):
+    """This function makes the header of the wide feature table
+
+    Args:
+        names (list): the names of the tables, the prefixes of their columns
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        str: the header line
+    """
+    columns = [f'{name}_{column}' for name in names for column in FEATURE_VERSIONS[version]]
+    return 'query\t' + '\t'.join(columns) + '\n'
+
+def ordered_group_reader(handle, rank, table, fasta):
+    """This function reads the query groups of a diamond table and checks that the
+    queries are in the order of the merge
+
+    Args:
+        handle (file): the opened diamond table
+        rank (dict): key: query id; value: the position of the query in the merge
+        table (str): the name and path of the table, for the error messages
+        fasta (str): the path to the fasta file, for the error messages
+
+    Raises:
+        ValueError: when a query is not in the fasta file or is not in the order of the merge
+
+    Yields:
+        tuple: the position of the query, the query id and a list with the columns of each of its lines
+    """
+    previous = -1
+    #the order is checked here, so the finished queries do not have to be kept
+    for query, lines in query_group_reader(handle, check_grouped = False):
+        position = rank.get(query)
+        if position is None:
+            raise ValueError(f'The query "{query}" of the table {table} is not in the fasta file "{fasta}"')
+        if position <= previous:
+            raise ValueError(f'The query "{query}" of the table {table} is out of place, the queries should be '
+                             f'grouped in the order of "{fasta}" (or sorted by id with --sorted)')
+        previous = position
+        yield position, query, lines
+
+def feature_matrix_maker(tables, fasta, out, sorted_ids = False, version = FEATURE_VERSION):
+    """This function calculates the features of every query in every diamond table and
+    writes them as one row per query. The output is only made again when the inputs
+    or parameters changed since it was made.
+
+    Args:
+        tables (dict): key: name of the table, the prefix of its columns; value: path to the diamond table
+        fasta (str): path to the fasta file of the queries, every query gets a row,
+        those without a hit in a table get the features of no hit for that table
+        out (str): path to the output table, compressed when it ends in '.gz' or '.zst'
+        sorted_ids (bool): whether the tables are sorted by query id instead of in
+        the order of the fasta file, then the rows are sorted by id as well. Defaults to False.
+        version (int): the version of the features, see FEATURE_VERSIONS. Defaults to FEATURE_VERSION.
+
+    Returns:
+        int: the number of rows, None when the output was up to date
+    """
+    params = {'stage': 'feature_matrix_maker', 'tables': list(tables), 'sorted_ids': sorted_ids,
+              'feature_version': version}
+    up_to_date, manifest = stage_cache_checker(out, list(tables.values()) + [fasta], params)
+    if up_to_date:
+        print(f'The file "{out}" is up to date, moving on...')
+        return None
+    lengths = fasta_lengths(fasta)
+    order = sorted(lengths) if sorted_ids else list(lengths)
+    rank = {query: position for position, query in enumerate(order)}
+    no_hit = '\t'.join(map(str, [0] + [float('nan')] * (len(FEATURE_VERSIONS[version]) - 1)))
+    dir = '/'.join(out.split('/')[:-1])
+    if dir:
+        dir_maker(dir)
+    with ExitStack() as stack, stage_timer('feature calculation', queries = len(order)) as counts:
+        readers = [ordered_group_reader(stack.enter_context(file_opener(table)), rank, f'{name} ("{table}")', fasta)
+                   for name, table in tables.items()]
+        #the current query group of every table, None when the table is finished
+        heads = [next(reader, None) for reader in readers]
+        f = stack.enter_context(atomic_writer(out))
+        f.write(matrix_header_maker(list(tables), version))
+        n_lines = 0
+        for position, query in enumerate(order):
+            row = [query]
+            for i, reader in enumerate(readers):
+                if heads[i] is None or heads[i][0] != position:
+                    row.append(no_hit)
+                    continue
+                hits = None
+                for columns in heads[i][2]:
+                    hits = hit_accumulator(hits, columns, version)
+                n_lines += len(heads[i][2])
+                row.append('\t'.join(map(str, hit_summarizer(hits, lengths[query], version))))
+                heads[i] = next(reader, None)
+            f.write('\t'.join(row) + '\n')
+        counts['rows'] = n_lines
+    stage_cache_writer(out, manifest)
+    print(f'The file "{out}" has been made, moving on...')
+    return len(order)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Make one feature table with the features of several diamond tables')
+    parser.add_argument('fasta', help = 'fasta file of the queries of the tables')
+    parser.add_argument('out', help = "path to the feature table, compressed when it ends in '.gz' or '.zst'")
+    parser.add_argument('tables', nargs = '+',
+                        help = "diamond tables as 'name=path', the name is the prefix of the columns of the table. "
+                               "Defaults to the file name without extension")
+    parser.add_argument('--sorted', action = 'store_true',
+                        help = 'the tables are sorted by query id instead of in the order of the fasta file')
+    parser.add_argument('--feature-version', type = int, default = FEATURE_VERSION, choices = sorted(FEATURE_VERSIONS),
+                        help = 'version of the features, see diamond_feature_extractor.py')
+    args = parser.parse_args()
+    tables = {}
+    for table in args.tables:
+        name, path = sample_namer(table)
+        if name in tables:
+            parser.error(f"two tables are named '{name}', name them as 'name=path'")
+        tables[name] = path
+    feature_matrix_maker(tables, args.fasta, args.out, args.sorted, args.feature_version)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains the functions to read and write feature tables
+as tsv or in a compact binary format. The binary format is a directory ending in
+'.ftab' that contains the numeric columns as one float32 matrix in a '.npy' file,
+which is memory mapped when it is read, and the text columns, such as the query ids,
+dictionary encoded as integer codes and a list of their values.
+
+Run as a script to convert a table between the two formats.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from os.path import isdir, exists
+import numpy as np
+import pandas as pd
+from stage_cache import atomic_writer
+from general_functions import file_opener
+from stage_profiler import stage_timer
+
+BINARY_SUFFIX = '.ftab'
+CHUNKSIZE = 100000
+
+def binary_table_checker(path):
+    """This function checks whether a feature table is in the binary format
+
+    Args:
+        path (str): path to the feature table
+
+    Returns:
+        bool: True for the binary format, False for tsv
+    """
+    return path.rstrip('/').endswith(BINARY_SUFFIX) or isdir(path)
+
+def text_column_encoder(values):
+    """This function dictionary encodes a text column
+
+    Args:
+        values (array): the values of the column
+
+    Returns:
+        tuple: the int32 code of every row and the list of values belonging to the codes
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype = object))
+    return codes.astype(np.int32), [str(value) for value in uniques]
+
+def binary_table_writer(df, out, dtype = np.float32):
+    """This function writes a feature table in the binary format
+
+    Args:
+        df (pd df): the features, indexed by query
+        out (str): path to the output directory, should end in '.ftab'
+        dtype (np dtype): the type of the numeric columns. Defaults to np.float32.
+    """
+    out = out.rstrip('/')
+    #the table is written next to the output first, as df can be memory mapped from the output
+    temp = f'{out}.tmp'
+    if exists(temp):
+        shutil.rmtree(temp)
+    os.makedirs(temp)
+    numeric = [column for column in df.columns if pd.api.types.is_numeric_dtype(df[column])]
+    text = [column for column in df.columns if column not in numeric]
+    np.save(f'{temp}/features.npy', np.ascontiguousarray(df[numeric].to_numpy(dtype = dtype)))
+    for column, values in [(df.index.name or 'query', df.index)] + [(column, df[column]) for column in text]:
+        codes, uniques = text_column_encoder(values)
+        np.save(f'{temp}/{column}.codes.npy', codes)
+        with open(f'{temp}/{column}.values.txt', 'w') as f:
+            f.writelines(f'{value}\n' for value in uniques)
+    meta = {'index': df.index.name or 'query', 'numeric': numeric, 'text': text, 'columns': list(df.columns)}
+    with open(f'{temp}/meta.json', 'w') as f:
+        json.dump(meta, f, indent = 1)
+    if exists(out):
+        shutil.rmtree(out)
+    os.rename(temp, out)
+
+def text_column_loader(path, column):
+    """This function loads the codes and values of a dictionary encoded column
+
+    Args:
+        path (str): path to the binary feature table
+        column (str): the name of the column
+
+    Returns:
+        tuple: the memory mapped codes and the np array of values
+    """
+    codes = np.load(f'{path}/{column}.codes.npy', mmap_mode = 'r')
+    with open(f'{path}/{column}.values.txt') as f:
+        values = np.array([line.rstrip('\n') for line in f], dtype = object)
+    return codes, values
+
+def binary_chunk_reader(path, chunksize = CHUNKSIZE):
+    """This function reads a binary feature table in chunks of rows. The numeric
+    columns are slices of the memory mapped matrix, so only the rows of a chunk are read.
+
+    Args:
+        path (str): path to the binary feature table
+        chunksize (int): the number of rows per chunk. Defaults to CHUNKSIZE.
+
+    Yields:
+        pd df: the features of the chunk, indexed by query
+    """
+    with open(f'{path}/meta.json') as f:
+        meta = json.load(f)
+    matrix = np.load(f'{path}/features.npy', mmap_mode = 'r')
+    index_codes, index_values = text_column_loader(path, meta['index'])
+    text = {column: text_column_loader(path, column) for column in meta['text']}
+    for start in range(0, len(matrix), chunksize):
+        end = start + chunksize
+        index = pd.Index(index_values[index_codes[start:end]], name = meta['index'])
+        df = pd.DataFrame(matrix[start:end], index = index, columns = meta['numeric'], copy = False)
+        for column, (codes, values) in text.items():
+            df[column] = values[codes[start:end]]
+        yield df[meta['columns']]
+
+def table_chunk_reader(path, chunksize = CHUNKSIZE):
+    """This function reads a tsv or binary feature table in chunks of rows
+
+    Args:
+        path (str): path to the feature table
+        chunksize (int): the number of rows per chunk. Defaults to CHUNKSIZE.
+
+    Yields:
+        pd df: the features of the chunk, indexed by query
+    """
+    if binary_table_checker(path):
+        yield from binary_chunk_reader(path, chunksize)
+    else:
+        with file_opener(path) as f:
+            yield from pd.read_table(f, index_col = 0, chunksize = chunksize)
+
+def table_loader(path):
+    """This function loads a whole tsv or binary feature table
+
+    Args:
+        path (str): path to the feature table
+
+    Returns:
+        pd df: the features, indexed by query
+    """
+    if binary_table_checker(path):
+        chunks = list(binary_chunk_reader(path, chunksize = 2 ** 62))
+        if chunks:
+            return chunks[0]
+        with open(f'{path}/meta.json') as f:
+            meta = json.load(f)
+        return pd.DataFrame(columns = meta['columns'], index = pd.Index([], name = meta['index']))
+    with file_opener(path) as f:
+        return pd.read_table(f, index_col = 0)
+
+def table_writer(df, out):
+    """This function writes a feature table, in the binary format when the path
+    ends in '.ftab' and else as tsv
+
+    Args:
+        df (pd df): the features, indexed by query
+        out (str): path to the output table
+    """
+    if out.rstrip('/').endswith(BINARY_SUFFIX):
+        with stage_timer('binary writing', rows = len(df)):
+            binary_table_writer(df, out)
+    else:
+        with stage_timer('tsv writing', rows = len(df)), atomic_writer(out) as f:
+            df.to_csv(f, sep = '\t', index_label = df.index.name or 'query', na_rep = 'nan')
+
+def main(in_table, out_table):
+    """This function converts a feature table between tsv and the binary format
+
+    Args:
+        in_table (str): path to the input table
+        out_table (str): path to the output table, ending in '.ftab' for the binary format
+    """
+    table_writer(table_loader(in_table), out_table)
+    print(f'The table "{out_table}" has been made')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Convert a feature table between tsv and the binary format')
+    parser.add_argument('in_table', help = 'input feature table')
+    parser.add_argument('out_table', help = "output feature table, ending in '.ftab' for the binary format")
+    args = parser.parse_args()
+    main(args.in_table, args.out_table)
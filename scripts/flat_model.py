@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script exports the sklearn models to a flat format and predicts
+with the exported models using only numpy. A model is exported as a directory
+next to it ('diamond_random_forest.sav' gets 'diamond_random_forest.npmodel') with
+the parameters in 'meta.json' and the arrays as '.npy' files, which are memory mapped
+when the model is loaded. The nodes of all the trees of an ensemble are stored in
+one set of arrays.
+
+Supported are random forests, gradient boosted trees, logistic regression and
+gaussian naive bayes, also as the best estimator of a grid search. The predicted
+classes are the same as those of sklearn. The probabilities of the boosted trees and
+logistic regression can differ in the last digit (around 1e-16), as numpy calculates
+exp slightly differently than the C library scipy uses.
+
+Run as a script to export models.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from os.path import exists, isdir
+import numpy as np
+
+FLAT_MODEL_SUFFIX = '.npmodel'
+FLAT_MODEL_VERSION = 1
+#the rows of which the trees are descended at the same time, to bound the memory
+ROW_BLOCK = 10000
+
+def flat_model_path(ml_model):
+    """This function gets the path of the flat export of a model
+
+    Args:
+        ml_model (str): path to the pickled model
+
+    Returns:
+        str: path to the flat model directory
+    """
+    return ml_model.rstrip('/').rsplit('.', 1)[0] + FLAT_MODEL_SUFFIX
+
+def flat_model_checker(ml_model):
+    """This function checks whether a path is a flat model
+
+    Args:
+        ml_model (str): path to the model
+
+    Returns:
+        bool: True for a flat model
+    """
+    return ml_model.rstrip('/').endswith(FLAT_MODEL_SUFFIX) and isdir(ml_model)
+
+def tree_flattener(trees):
+    """This function puts the nodes of several trees in one set of arrays, the
+    children point to the position of the node in the arrays
+
+    Args:
+        trees (list): the sklearn tree_ objects
+
+    Returns:
+        dict: the left and right 'children' of every node, the split 'feature' and
+        'threshold', the 'value' of every node and the 'roots' of the trees. The children
+        of a leaf are the leaf itself, so a descent stays in the leaf it reached.
+    """
+    children, feature, threshold, value, roots = [], [], [], [], []
+    offset = 0
+    for tree in trees:
+        roots.append(offset)
+        nodes = np.arange(tree.node_count) + offset
+        is_leaf = tree.children_left == -1
+        left = np.where(is_leaf, nodes, tree.children_left + offset)
+        right = np.where(is_leaf, nodes, tree.children_right + offset)
+        children.append(np.column_stack([left, right]))
+        #leaves get feature 0, so they can be looked up without a check
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        value.append(tree.value[:, 0, :])
+        offset += tree.node_count
+    return {
+        'children': np.concatenate(children).astype(np.int32), 'feature': np.concatenate(feature).astype(np.int32),
+        'threshold': np.concatenate(threshold), 'value': np.concatenate(value),
+        'roots': np.array(roots, dtype = np.int32), 'max_depth': max(tree.max_depth for tree in trees)
+    }
+
+def gradient_boosting_init_maker(model):
+    """This function calculates the raw prediction that the trees of a gradient boosting
+    model start from, from the class probabilities of its initial estimator, as sklearn does
+
+    Args:
+        model: the fitted GradientBoostingClassifier
+
+    Returns:
+        np array: the raw prediction, one value per tree of a stage
+    """
+    n_trees_per_stage = model.estimators_.shape[1]
+    if isinstance(model.init_, str) and model.init_ == 'zero':
+        return np.zeros(n_trees_per_stage)
+    proba = model.init_.predict_proba(np.zeros((1, model.n_features_in_), dtype = np.float32))[0]
+    eps = np.finfo(np.float32).eps
+    proba = np.clip(proba, eps, 1 - eps)
+    if n_trees_per_stage > 1:
+        return np.log(proba)
+    log_odds = np.log(proba[1] / (1 - proba[1]))
+    #the exponential loss is half the log odds
+    return np.array([log_odds / 2 if model.loss == 'exponential' else log_odds])
+
+def model_flattener(model):
+    """This function gets the parameters and arrays of a sklearn model
+
+    Args:
+        model: the sklearn model
+
+    Raises:
+        ValueError: when the type of model is not supported
+
+    Returns:
+        tuple: a dict with the parameters and a dict with the arrays of the model
+    """
+    model = getattr(model, 'best_estimator_', model)
+    kind = type(model).__name__
+    meta = {'version': FLAT_MODEL_VERSION, 'kind': kind, 'classes': model.classes_.tolist(),
+            'features': [str(name) for name in getattr(model, 'feature_names_in_', [])]}
+    if kind == 'RandomForestClassifier':
+        flat = tree_flattener([estimator.tree_ for estimator in model.estimators_])
+        #a tree predicts the fraction of every class in its leaf
+        normalizer = flat['value'].sum(axis = 1, keepdims = True)
+        normalizer[normalizer == 0.0] = 1.0
+        flat['value'] = flat['value'] / normalizer
+        meta['max_depth'] = flat.pop('max_depth')
+    elif kind == 'GradientBoostingClassifier':
+        #the trees of a stage are stored after each other, one per class
+        flat = tree_flattener([estimator.tree_ for estimator in model.estimators_.ravel()])
+        flat['value'] = flat['value'][:, 0]
+        meta['max_depth'] = flat.pop('max_depth')
+        meta['n_trees_per_stage'] = model.estimators_.shape[1]
+        meta['learning_rate'] = model.learning_rate
+        meta['loss'] = 'exponential' if model.loss == 'exponential' else 'log_loss'
+        flat['init'] = gradient_boosting_init_maker(model)
+    elif kind in ('LogisticRegression', 'LogisticRegressionCV'):
+        flat = {'coef': model.coef_, 'intercept': model.intercept_}
+        #sklearn 1.8 removed multi_class, a binary model is then always one versus rest
+        multi_class = getattr(model, 'multi_class', 'auto')
+        if multi_class == 'auto':
+            multi_class = 'ovr' if len(model.classes_) == 2 or model.solver == 'liblinear' else 'multinomial'
+        meta['multi_class'] = multi_class
+    elif kind == 'GaussianNB':
+        flat = {'theta': model.theta_, 'var': model.var_, 'prior': model.class_prior_}
+    else:
+        raise ValueError(f'The model type "{kind}" can not be exported')
+    return meta, flat
+
+def model_exporter(ml_model, out = None):
+    """This function exports a pickled sklearn model to the flat format
+
+    Args:
+        ml_model (str): path to the pickled model
+        out (str): path to the flat model directory. Defaults to None, then it is
+        saved next to the pickled model.
+
+    Returns:
+        str: path to the flat model directory
+    """
+    import joblib
+    if out is None:
+        out = flat_model_path(ml_model)
+    meta, flat = model_flattener(joblib.load(ml_model))
+    meta['arrays'] = sorted(flat)
+    #the model is written next to the output first, as the output can be memory mapped
+    temp = f'{out}.tmp'
+    if exists(temp):
+        shutil.rmtree(temp)
+    os.makedirs(temp)
+    for name, array in flat.items():
+        np.save(f'{temp}/{name}.npy', np.ascontiguousarray(array))
+    with open(f'{temp}/meta.json', 'w') as f:
+        json.dump(meta, f, indent = 1)
+    if exists(out):
+        shutil.rmtree(out)
+    os.rename(temp, out)
+    return out
+
+def flat_model_loader(path):
+    """This function loads a flat model, the arrays are memory mapped
+
+    Args:
+        path (str): path to the flat model directory
+
+    Returns:
+        dict: the parameters of the model, with the arrays under 'arrays'
+    """
+    with open(f'{path}/meta.json') as f:
+        model = json.load(f)
+    model['arrays'] = {name: np.load(f'{path}/{name}.npy', mmap_mode = 'r') for name in model['arrays']}
+    return model
+
+def leaf_finder(arrays, max_depth, X):
+    """This function finds the leaf every row ends in for every tree, all the
+    trees are descended at the same time, one level per step
+
+    Args:
+        arrays (dict): the flattened trees, see tree_flattener
+        max_depth (int): the depth of the deepest tree
+        X (np array): the features, as float32 like sklearn trees use them
+
+    Returns:
+        np array: the node index of the leaf, with a row per row of X and a column per tree
+    """
+    children = np.asarray(arrays['children']).ravel()
+    feature, threshold = np.asarray(arrays['feature']), np.asarray(arrays['threshold'])
+    nodes = np.repeat(np.asarray(arrays['roots'])[None, :], len(X), axis = 0)
+    #the position of the first feature of every row in the flattened features
+    row_starts = (np.arange(len(X), dtype = np.int64) * X.shape[1])[:, None]
+    X = np.ascontiguousarray(X).ravel()
+    for depth in range(max_depth):
+        values = X.take(row_starts + feature.take(nodes))
+        #missing values go right, as in sklearn
+        go_right = ~(values <= threshold.take(nodes))
+        next_nodes = children.take(2 * nodes + go_right)
+        if np.array_equal(next_nodes, nodes):
+            break
+        nodes = next_nodes
+    return nodes
+
+def tree_ensemble_scorer(model, X):
+    """This function adds the leaf values of the trees of an ensemble, in blocks of rows
+
+    Args:
+        model (dict): the flat random forest or gradient boosted trees
+        X (np array): the features
+
+    Returns:
+        np array: for a random forest the summed class fractions, for gradient boosted
+        trees the raw score of every class, with a row per row of X
+    """
+    arrays = model['arrays']
+    value = np.asarray(arrays['value'])
+    if model['kind'] == 'RandomForestClassifier':
+        n_outputs = len(model['classes'])
+        scale = 1.0
+        init = np.zeros(n_outputs)
+    else:
+        n_outputs = model['n_trees_per_stage']
+        scale = model['learning_rate']
+        init = np.asarray(arrays['init'])
+    scores = np.tile(init, (len(X), 1))
+    #sklearn trees compare float32 features to the thresholds
+    X = X.astype(np.float32)
+    for start in range(0, len(X), ROW_BLOCK):
+        nodes = leaf_finder(arrays, model['max_depth'], X[start:start + ROW_BLOCK])
+        block = scores[start:start + ROW_BLOCK]
+        #the trees are added in order, as sklearn does
+        for tree in range(nodes.shape[1]):
+            if model['kind'] == 'RandomForestClassifier':
+                block += value.take(nodes[:, tree], axis = 0)
+            else:
+                block[:, tree % n_outputs] += scale * value.take(nodes[:, tree])
+    return scores
+
+def flat_model_predictor(model, data):
+    """This function makes the predictions of a flat model
+
+    Args:
+        model (dict): the flat model, see flat_model_loader
+        data (pd df or np array): the features, a dataframe is ordered by the features
+        the model was trained on
+
+    Returns:
+        tuple: the predicted classes and the probability of every class
+    """
+    if model['features'] and hasattr(data, 'columns'):
+        data = data[model['features']]
+    X = np.asarray(data, dtype = np.float64)
+    arrays = model['arrays']
+    classes = np.array(model['classes'])
+    kind = model['kind']
+    if kind == 'RandomForestClassifier':
+        proba = tree_ensemble_scorer(model, X) / len(arrays['roots'])
+        return classes[np.argmax(proba, axis = 1)], proba
+    if kind == 'GradientBoostingClassifier':
+        raw = tree_ensemble_scorer(model, X)
+        n_trees_per_stage = model['n_trees_per_stage']
+        if model['loss'] == 'exponential':
+            proba = expit(2.0 * raw[:, 0])
+            proba = np.column_stack([1 - proba, proba])
+            return classes[(raw[:, 0] >= 0).astype(int)], proba
+        if n_trees_per_stage == 1:
+            proba = expit(raw[:, 0])
+            proba = np.column_stack([1 - proba, proba])
+        else:
+            proba = softmax(raw)
+        return classes[np.argmax(proba, axis = 1)], proba
+    if kind in ('LogisticRegression', 'LogisticRegressionCV'):
+        decision = X @ np.asarray(arrays['coef']).T + np.asarray(arrays['intercept'])
+        if model['multi_class'] == 'multinomial':
+            if decision.shape[1] == 1:
+                decision = np.column_stack([-decision, decision])
+            proba = softmax(decision)
+            return classes[np.argmax(proba, axis = 1)], proba
+        proba = expit(decision)
+        if proba.shape[1] == 1:
+            return classes[(decision[:, 0] > 0).astype(int)], np.column_stack([1 - proba[:, 0], proba[:, 0]])
+        proba /= proba.sum(axis = 1, keepdims = True)
+        return classes[np.argmax(decision, axis = 1)], proba
+    if kind == 'GaussianNB':
+        theta, var, prior = np.asarray(arrays['theta']), np.asarray(arrays['var']), np.asarray(arrays['prior'])
+        joint_log_likelihood = []
+        for i in range(len(classes)):
+            n_ij = -0.5 * np.sum(np.log(2.0 * np.pi * var[i, :]))
+            n_ij -= 0.5 * np.sum(((X - theta[i, :]) ** 2) / (var[i, :]), 1)
+            joint_log_likelihood.append(np.log(prior[i]) + n_ij)
+        joint_log_likelihood = np.array(joint_log_likelihood).T
+        maximum = np.max(joint_log_likelihood, axis = 1, keepdims = True)
+        log_prob_x = np.log(np.sum(np.exp(joint_log_likelihood - maximum), axis = 1)) + maximum[:, 0]
+        proba = np.exp(joint_log_likelihood - log_prob_x[:, None])
+        return classes[np.argmax(joint_log_likelihood, axis = 1)], proba
+    raise ValueError(f'The model type "{kind}" is not supported')
+
+def expit(x):
+    """This function calculates the logistic function, as scipy.special.expit without importing scipy
+
+    Args:
+        x (np array): the values
+
+    Returns:
+        np array: 1 / (1 + exp(-x))
+    """
+    #a very negative x overflows to 1 / inf = 0, which is the right value
+    with np.errstate(over = 'ignore'):
+        return 1 / (1 + np.exp(-x))
+
+def softmax(raw):
+    """This function converts raw scores to probabilities
+
+    Args:
+        raw (np array): the score of every class, a row per sample
+
+    Returns:
+        np array: the probabilities
+    """
+    exp = np.exp(raw - np.max(raw, axis = 1, keepdims = True))
+    return exp / np.sum(exp, axis = 1, keepdims = True)
+
+def main(ml_models):
+    """This function exports models to the flat format, next to the pickled models
+
+    Args:
+        ml_models (list): paths to the pickled models
+    """
+    for ml_model in ml_models:
+        out = model_exporter(ml_model)
+        print(f'The model "{ml_model}" has been exported to "{out}"')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export sklearn models to a flat format that is predicted with numpy')
+    parser.add_argument('ml_models', nargs = '+', help = 'pickled models, e.g. models/diamond_random_forest.sav')
+    args = parser.parse_args()
+    main(args.ml_models)
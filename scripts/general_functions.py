@@ -5,12 +5,38 @@ Name = Jori de Leuw
 Description = this script contains general functions used in several scripts
 within the pipeline. 
 
+Files compressed with gzip, bgzip or zstd are opened with file_opener, which detects
+the compression from the first bytes of the file. bgzip files (bgzf) consist of
+independent blocks of 64 kB, which are decompressed and compressed in parallel in a
+pool of threads, as zlib releases the GIL. Gzip and zstd files are decompressed by pigz
+and zstd in a separate process, when they are installed. Files ending in '.gz' or '.bgz'
+are written as bgzf, which every gzip reader can read, and files ending in '.zst' as zstd.
+
 This file should not be run on its own as a script
 """
+import gzip
+import io
+import os
+import shutil
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 from os import listdir
 from os.path import exists
 import subprocess as sp
 
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+#key: file extension; value: the compression of the files written with that extension
+COMPRESSION_SUFFIXES = {'.gz': 'bgzf', '.bgz': 'bgzf', '.zst': 'zstd'}
+#the largest number of uncompressed bytes in a bgzf block, as bgzip writes them
+BGZF_BLOCK_SIZE = 0xff00
+#the empty block that marks the end of a bgzf file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+IO_BUFFER = 1 << 20
+
 def file_path_getter(dir, extension = None):
     """This function get the paths to all files located
     in sub directories
@@ -42,4 +68,303 @@ def dir_maker(dir_path):
     """
     if exists(dir_path) == False:
         sp.run(f'mkdir -p {dir_path}', shell = True)
-    return dir_path
\ No newline at end of file
+    return dir_path
+
+def sample_namer(sample):
+    """This function gets the name and file of a sample, or of a table, given as
+    'name=path' or as 'path', then the name is the file name without extension
+
+    Args:
+        sample (str): the sample
+
+    Returns:
+        tuple: the name and the path to the file
+    """
+    if '=' in sample:
+        name, fasta = sample.split('=', 1)
+    else:
+        fasta = sample
+        name = os.path.basename(fasta).split('.')[0]
+    return name, fasta
+
+def compression_detector(path):
+    """This function detects the compression of a file from its first bytes
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        str: 'bgzf', 'gzip' or 'zstd', None when the file is not compressed
+    """
+    #pipes can not be read twice
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    if header.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if header.startswith(GZIP_MAGIC):
+        #bgzf is gzip with the size of the block in the 'BC' extra field
+        if len(header) == 16 and header[3] & 4 and header[12:14] == b'BC':
+            return 'bgzf'
+        return 'gzip'
+    return None
+
+def compression_namer(path):
+    """This function gets the compression a file is written with from its extension
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        str: 'bgzf' or 'zstd', None when the file is not compressed
+    """
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1])
+
+def bgzf_block_reader(f):
+    """This function reads the compressed blocks of a bgzf file
+
+    Args:
+        f (file): the bgzf file opened in binary mode
+
+    Raises:
+        ValueError: when the file is not bgzf
+
+    Yields:
+        tuple: the raw deflate data, the crc32 and the uncompressed size of a block
+    """
+    while True:
+        header = f.read(12)
+        if not header:
+            return
+        if len(header) < 12 or not header.startswith(GZIP_MAGIC) or not header[3] & 4:
+            raise ValueError(f'"{f.name}" is not a bgzf file')
+        extra = f.read(struct.unpack('<H', header[10:12])[0])
+        block_size = None
+        i = 0
+        while i + 4 <= len(extra):
+            length = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b'BC':
+                block_size = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + length
+        if block_size is None:
+            raise ValueError(f'"{f.name}" is not a bgzf file')
+        data = f.read(block_size - len(extra) - 20)
+        crc, size = struct.unpack('<II', f.read(8))
+        yield data, crc, size
+
+def bgzf_block_inflater(block):
+    """This function decompresses a bgzf block
+
+    Args:
+        block (tuple): the raw deflate data, the crc32 and the uncompressed size
+
+    Raises:
+        ValueError: when the decompressed data does not match the crc32 or size
+
+    Returns:
+        bytes: the decompressed data
+    """
+    data, crc, size = block
+    raw = zlib.decompress(data, -15)
+    if len(raw) != size or zlib.crc32(raw) != crc:
+        raise ValueError('A bgzf block is corrupt')
+    return raw
+
+def bgzf_block_deflater(raw, level = 6):
+    """This function compresses data of at most BGZF_BLOCK_SIZE bytes into a bgzf block
+
+    Args:
+        raw (bytes): the uncompressed data
+        level (int): the zlib compression level. Defaults to 6.
+
+    Returns:
+        bytes: the bgzf block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(raw) + compressor.flush()
+    if len(data) > 65536 - 26:
+        #data that does not compress is stored, so the block fits in 64 kB
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        data = compressor.compress(raw) + compressor.flush()
+    header = GZIP_MAGIC + b'\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', len(data) + 25)
+    return header + data + struct.pack('<II', zlib.crc32(raw), len(raw))
+
+def ordered_thread_mapper(function, items, threads):
+    """This function applies a function to items in a pool of threads and yields the
+    results in the order of the items. Only a few items per thread are read ahead.
+
+    Args:
+        function (function): the function
+        items (iterable): the items
+        threads (int): the number of threads
+
+    Yields:
+        the result of every item
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= 4 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def ordered_process_mapper(function, items, processes):
+    """This function applies a function to items in a pool of processes and yields the
+    results in the order of the items. Only a few items per process are read ahead.
+
+    Args:
+        function (function): the function, defined at the top level of a module
+        items (iterable): the items
+        processes (int): the number of processes, with 1 the items are mapped in this process
+
+    Yields:
+        the result of every item
+    """
+    if processes <= 1:
+        yield from map(function, items)
+        return
+    with ProcessPoolExecutor(processes) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class ChunkReader(io.RawIOBase):
+    """This class makes a readable binary file of an iterator of bytes"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.chunk):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+        n = min(len(buffer), len(self.chunk))
+        buffer[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+class BgzfWriter(io.RawIOBase):
+    """This class makes a writable binary file that compresses the written data as
+    bgzf blocks in a pool of threads"""
+
+    def __init__(self, f, threads):
+        self.f = f
+        self.buffer = bytearray()
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = deque()
+        self.threads = threads
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.block_submitter(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def block_submitter(self, raw):
+        """This function compresses a block in the pool and writes the finished blocks in order"""
+        self.pending.append(self.pool.submit(bgzf_block_deflater, raw))
+        while len(self.pending) >= 4 * self.threads or (self.pending and self.pending[0].done()):
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.block_submitter(bytes(self.buffer))
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+            self.f.write(BGZF_EOF)
+        finally:
+            self.pool.shutdown()
+            self.f.close()
+            super().close()
+
+@contextmanager
+def file_opener(path, mode = 'r', compression = None, threads = None):
+    """This function opens a file that may be compressed, as open does. When reading,
+    the compression is detected from the content of the file, when writing from its
+    extension, see COMPRESSION_SUFFIXES.
+
+    Args:
+        path (str): path to the file
+        mode (str): 'r', 'rb', 'w' or 'wb'. Defaults to 'r'.
+        compression (str): 'bgzf', 'gzip' or 'zstd', overrides the detected compression.
+        Defaults to None.
+        threads (int): the number of threads that (de)compress. Defaults to None, then all cores.
+
+    Raises:
+        ValueError: when a zstd file is opened while neither the zstd program nor the
+        zstandard module is installed
+
+    Yields:
+        file: the opened file
+    """
+    threads = threads or os.cpu_count()
+    reading = mode.startswith('r')
+    if compression is None:
+        compression = compression_detector(path) if reading else compression_namer(path)
+    if compression is None:
+        with open(path, mode) as f:
+            yield f
+        return
+    process = None
+    closers = []
+    if compression == 'bgzf':
+        f = open(path, 'rb' if reading else 'wb')
+        if reading:
+            blocks = ordered_thread_mapper(bgzf_block_inflater, bgzf_block_reader(f), threads)
+            handle = io.BufferedReader(ChunkReader(blocks), IO_BUFFER)
+            closers = [blocks.close, f.close]
+        else:
+            handle = io.BufferedWriter(BgzfWriter(f, threads), IO_BUFFER)
+    elif shutil.which('pigz' if compression == 'gzip' else 'zstd'):
+        program = ['pigz', '-p', str(threads)] if compression == 'gzip' else ['zstd', '-q', f'-T{threads}']
+        if reading:
+            process = sp.Popen(program + ['-dc', path], stdout = sp.PIPE)
+            handle = process.stdout
+        else:
+            f = open(path, 'wb')
+            process = sp.Popen(program + ['-c'], stdin = sp.PIPE, stdout = f)
+            handle = process.stdin
+            closers = [f.close]
+    elif compression == 'gzip':
+        handle = gzip.open(path, mode[0] + 'b')
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(f'"{path}" is compressed with zstd, install zstd or the zstandard module to read it')
+        if reading:
+            handle = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), IO_BUFFER)
+        else:
+            handle = zstandard.ZstdCompressor(threads = threads).stream_writer(open(path, 'wb'))
+    if 'b' not in mode:
+        handle = io.TextIOWrapper(handle)
+    try:
+        yield handle
+    finally:
+        handle.close()
+        for closer in closers:
+            closer()
+        if process is not None:
+            #a reader that stops early ends the process with SIGPIPE, which is not an error
+            if process.wait() > 0 or (not reading and process.returncode != 0):
+                raise OSError(f'{process.args[0]} failed on "{path}" with exit code {process.returncode}')
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains the sketches that summarize the hits of a query
+in constant memory while the diamond table is read line by line:
+
+    P² (Jain and Chlamtac, 1985) estimates a quantile with 5 markers, the first 5
+    values are kept, so the quantile of up to 5 hits is exact
+    HyperLogLog counts distinct values in 2 ** HLL_PRECISION registers, up to
+    HLL_SPARSE_LIMIT values are kept as hashes, so small counts are exact
+    a bounded heap keeps the k best hits
+
+The sketches are dicts and lists, so they can be sent between processes and merged
+when the hits of a query are split over the parts of a table.
+
+This file should not be run on its own as a script
+"""
+
+import hashlib
+import heapq
+import math
+
+HLL_PRECISION = 8
+HLL_SPARSE_LIMIT = 64
+TOP_K = 3
+
+def p2_maker(p):
+    """This function makes an empty P² sketch of a quantile
+
+    Args:
+        p (float): the quantile, between 0 and 1
+
+    Returns:
+        dict: the sketch
+    """
+    return {'p': p, 'count': 0, 'heights': [], 'positions': None, 'desired': None}
+
+def p2_adder(sketch, x):
+    """This function adds a value to a P² sketch
+
+    Args:
+        sketch (dict): the sketch made by p2_maker
+        x (float): the value
+    """
+    p = sketch['p']
+    sketch['count'] += 1
+    heights = sketch['heights']
+    if sketch['count'] <= 5:
+        heights.append(x)
+        if sketch['count'] == 5:
+            heights.sort()
+            sketch['positions'] = [1, 2, 3, 4, 5]
+            sketch['desired'] = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        return
+    positions = sketch['positions']
+    desired = sketch['desired']
+    #find the cell of the value and move the markers above it
+    if x < heights[0]:
+        heights[0] = x
+        k = 0
+    elif x >= heights[4]:
+        heights[4] = x
+        k = 3
+    else:
+        k = 0
+        while x >= heights[k + 1]:
+            k += 1
+    for i in range(k + 1, 5):
+        positions[i] += 1
+    for i, increment in enumerate((0, p / 2, p, (1 + p) / 2, 1)):
+        desired[i] += increment
+    #move the middle markers towards their desired position
+    for i in (1, 2, 3):
+        d = desired[i] - positions[i]
+        if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+            d = 1 if d > 0 else -1
+            height = heights[i] + d / (positions[i + 1] - positions[i - 1]) * (
+                (positions[i] - positions[i - 1] + d) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i])
+                + (positions[i + 1] - positions[i] - d) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1]))
+            if not heights[i - 1] < height < heights[i + 1]:
+                #the parabola overshoots a neighbour, the height is interpolated linearly
+                height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+            heights[i] = height
+            positions[i] += d
+
+def p2_quantile(sketch):
+    """This function gets the estimated quantile of a P² sketch
+
+    Args:
+        sketch (dict): the sketch made by p2_maker
+
+    Returns:
+        float: the quantile, exact for up to 5 values (with linear interpolation as
+        numpy.quantile), NaN when the sketch is empty
+    """
+    if sketch['count'] == 0:
+        return math.nan
+    if sketch['count'] <= 5:
+        values = sorted(sketch['heights'])
+        position = sketch['p'] * (len(values) - 1)
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+    return sketch['heights'][2]
+
+def p2_merger(sketch, other):
+    """This function combines two P² sketches of the same quantile. When both have
+    more than 5 values the markers are averaged by weight, which is an approximation.
+
+    Args:
+        sketch (dict): the first sketch, is updated
+        other (dict): the second sketch
+
+    Returns:
+        dict: the combined sketch
+    """
+    #up to 5 values the heights are the values themselves
+    if other['count'] <= 5:
+        for x in list(other['heights']):
+            p2_adder(sketch, x)
+        return sketch
+    if sketch['count'] <= 5:
+        merged = {key: (list(value) if isinstance(value, list) else value) for key, value in other.items()}
+        for x in sketch['heights']:
+            p2_adder(merged, x)
+        return merged
+    count = sketch['count'] + other['count']
+    weight = sketch['count'] / count
+    heights = [h * weight + o * (1 - weight) for h, o in zip(sketch['heights'], other['heights'])]
+    heights[0] = min(sketch['heights'][0], other['heights'][0])
+    heights[4] = max(sketch['heights'][4], other['heights'][4])
+    p = sketch['p']
+    desired = [1, 1 + (count - 1) * p / 2, 1 + (count - 1) * p, 1 + (count - 1) * (1 + p) / 2, count]
+    #the markers keep distinct positions, also for the quantiles near 0 or 1
+    positions = [1]
+    for i in (1, 2, 3):
+        positions.append(min(max(round(desired[i]), positions[-1] + 1), count - 4 + i))
+    positions.append(count)
+    return {'p': p, 'count': count, 'heights': heights, 'positions': positions, 'desired': desired}
+
+def hll_maker():
+    """This function makes an empty HyperLogLog sketch
+
+    Returns:
+        dict: the sketch, with the hashes of the values until there are more than HLL_SPARSE_LIMIT
+    """
+    return {'hashes': set(), 'registers': None}
+
+def value_hasher(value):
+    """This function hashes a value to 64 bits, the same in every process
+
+    Args:
+        value (str): the value
+
+    Returns:
+        int: the hash
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size = 8).digest(), 'big')
+
+def hll_register_adder(registers, hash):
+    """This function adds a hash to the registers of a HyperLogLog sketch
+
+    Args:
+        registers (bytearray): the registers
+        hash (int): the 64 bit hash
+    """
+    index = hash >> (64 - HLL_PRECISION)
+    rest = hash & ((1 << (64 - HLL_PRECISION)) - 1)
+    rank = 64 - HLL_PRECISION - rest.bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+def hll_densifier(sketch):
+    """This function moves the hashes of a HyperLogLog sketch to its registers when
+    there are more than HLL_SPARSE_LIMIT
+
+    Args:
+        sketch (dict): the sketch made by hll_maker
+    """
+    if sketch['registers'] is None and len(sketch['hashes']) > HLL_SPARSE_LIMIT:
+        sketch['registers'] = bytearray(1 << HLL_PRECISION)
+        for hash in sketch['hashes']:
+            hll_register_adder(sketch['registers'], hash)
+        sketch['hashes'] = None
+
+def hll_adder(sketch, value):
+    """This function adds a value to a HyperLogLog sketch
+
+    Args:
+        sketch (dict): the sketch made by hll_maker
+        value (str): the value
+    """
+    hash = value_hasher(value)
+    if sketch['registers'] is not None:
+        hll_register_adder(sketch['registers'], hash)
+        return
+    sketch['hashes'].add(hash)
+    hll_densifier(sketch)
+
+def hll_counter(sketch):
+    """This function estimates the number of distinct values of a HyperLogLog sketch
+
+    Args:
+        sketch (dict): the sketch made by hll_maker
+
+    Returns:
+        float: the number of distinct values, exact up to HLL_SPARSE_LIMIT values
+    """
+    if sketch['registers'] is None:
+        return float(len(sketch['hashes']))
+    registers = sketch['registers']
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        #linear counting is more accurate for small counts
+        estimate = m * math.log(m / zeros)
+    return float(round(estimate))
+
+def hll_merger(sketch, other):
+    """This function combines two HyperLogLog sketches
+
+    Args:
+        sketch (dict): the first sketch, is updated
+        other (dict): the second sketch
+
+    Returns:
+        dict: the combined sketch
+    """
+    if other['registers'] is None:
+        for hash in other['hashes']:
+            if sketch['registers'] is None:
+                sketch['hashes'].add(hash)
+            else:
+                hll_register_adder(sketch['registers'], hash)
+        hll_densifier(sketch)
+        return sketch
+    registers = bytearray(other['registers'])
+    if sketch['registers'] is None:
+        for hash in sketch['hashes']:
+            hll_register_adder(registers, hash)
+    else:
+        registers = bytearray(map(max, registers, sketch['registers']))
+    return {'hashes': None, 'registers': registers}
+
+def top_k_adder(heap, item, k = TOP_K):
+    """This function keeps the k largest items in a heap
+
+    Args:
+        heap (list): the heap, the smallest kept item first
+        item (tuple): the item, e.g. the bit score and identity of a hit
+        k (int): the number of kept items. Defaults to TOP_K.
+    """
+    if len(heap) < k:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+def top_k_merger(heap, other, k = TOP_K):
+    """This function combines two heaps of the k largest items
+
+    Args:
+        heap (list): the first heap, is updated
+        other (list): the second heap
+        k (int): the number of kept items. Defaults to TOP_K.
+
+    Returns:
+        list: the combined heap
+    """
+    for item in other:
+        top_k_adder(heap, item, k)
+    return heap
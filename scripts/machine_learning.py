@@ -3,10 +3,47 @@
 """
 Name = Jori de Leuw
 Description = this script learns and test machine learning models
+
+The merged feature table is split once into a training (75%) and a test (25%) part,
+which are normalized and saved as numpy matrices together with the cross-validation
+folds. Every fold of every parameter combination of every model is then fitted in its
+own process of a pool, the processes memory map the same matrices. The best parameters
+of every model are refitted on the whole training part and tested on the test part.
+The matrices, folds and models are only made again when the table or the settings
+changed, so a grid search over many simulation settings can be continued.
 """
+import argparse
+import importlib
+import json
+from os.path import exists
+import numpy as np
 import pandas as pd
-import joblib
-from scipy.stats import zscore
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_the_models import model_loader, model_predictor, column_stats_loader
+from preprocessing import preprocessing_loader, preprocessing_transformer, preprocessing_fitter, preprocessing_writer, \
+    preprocessing_path
+from feature_table import table_loader
+from fasta_index import fasta_lengths
+from general_functions import dir_maker, sample_namer
+from stage_cache import stage_cache_checker, stage_cache_writer, atomic_writer
+
+#key: name of the model; value: the estimator, its fixed parameters and the grid of parameters
+#searched with cross-validation, as the models in ../models were trained
+MODEL_FAMILIES = {
+    'bayesian': ('sklearn.naive_bayes.GaussianNB', {}, {'var_smoothing': [10.0 ** -i for i in range(1, 21)]}),
+    'boosted_trees': ('sklearn.ensemble.GradientBoostingClassifier', {'random_state': 1}, {
+        'n_estimators': list(range(1, 1000, 50)), 'loss': ['log_loss', 'exponential'],
+        'learning_rate': [0.1, 0.3, 0.5], 'max_features': ['sqrt', 'log2']}),
+    #this model chooses its regularization with its own cross-validation
+    'logistic_regression': ('sklearn.linear_model.LogisticRegressionCV',
+                            {'cv': 5, 'max_iter': 100000, 'random_state': 1}, {}),
+    'random_forest': ('sklearn.ensemble.RandomForestClassifier', {'random_state': 1}, {
+        'n_estimators': list(range(1, 1000, 50)), 'max_features': ['sqrt', 'log2'],
+        'criterion': ['gini', 'entropy', 'log_loss']})
+}
+POSITIVE_CLASS = 'pos'
+#the training matrices memory mapped in this process, key: path
+TRAINING_DATA = {}
 
 def feature_table_merger(df1, df2):
     """This function combines two pandas dataframes based on index
@@ -32,28 +69,386 @@ def orphan_classifier(ml_model, data):
     Returns:
         pred: predictions made by the model
     """
-    loaded_model = joblib.load(ml_model)
-    pred = loaded_model.predict(data)
+    loaded_model = model_loader(ml_model)
+    pred, proba = model_predictor(loaded_model, data)
     return pred
 
-def main(diamond_file, sequence_file, model):
-    """This function reads the feature tables, normalizes it and makes predictions
+def main(diamond_file, sequence_file, model, stats_file = None, fasta = None):
+    """This function reads the feature tables, normalizes them and makes predictions.
+    Both tables are normalized per column, as the training data, with the preprocessing
+    saved next to the model or else with the given column statistics.
 
     Args:
         diamond_file (str): path to diamond feature table
         sequence_file (str): path to sequence feature table
         model (str): path to machine learning model
+        stats_file (str): path to the column statistics of the training features, see
+        run_the_models.py, used when the model has no saved preprocessing. Defaults to None.
+        fasta (str): path to the fasta file of the queries, needed for preprocessings that
+        normalize the alignment count by the query length. Defaults to None.
+
+    Raises:
+        ValueError: when the model has no saved preprocessing and no column statistics are given
 
     Returns:
         predictions: predictions made by the model
     """
+    #the features are normalized with the statistics of the training data, not per row
+    preprocessing = preprocessing_loader(model)
+    if preprocessing is None:
+        if stats_file is None:
+            raise ValueError(f'The model "{model}" has no saved preprocessing, give the column statistics '
+                             'of its training features')
+        preprocessing = column_stats_loader(stats_file)
     #load features
-    diamond_features = pd.read_table(diamond_file, index_col=0)
-    sequence_features = pd.read_table(sequence_file, index_col=0)
-    #normalize features (this has to be done manually, to prevent error with nan)
-    diamond_features = diamond_features.apply(zscore, axis = 1)
-    sequence_features = sequence_features.apply(zscore, axis = 1)
+    diamond_features = table_loader(diamond_file)
+    sequence_features = table_loader(sequence_file)
     #merge features
     combined_features = pd.merge(diamond_features, sequence_features, left_index=True, right_index=True)
+    lengths = fasta_lengths(fasta) if fasta is not None else None
+    combined_features = preprocessing_transformer(preprocessing, combined_features, lengths)
     predictions = orphan_classifier(model, combined_features)
-    return predictions
\ No newline at end of file
+    return predictions
+
+def estimator_maker(family, params):
+    """This function makes an unfitted estimator of a model family
+
+    Args:
+        family (str): the name of the model, a key of MODEL_FAMILIES
+        params (dict): the parameters of the grid
+
+    Returns:
+        the sklearn estimator
+    """
+    estimator, fixed, _ = MODEL_FAMILIES[family]
+    module, name = estimator.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)(**fixed, **params)
+
+def training_array_loader(path):
+    """This function memory maps a training matrix once per process
+
+    Args:
+        path (str): path to the .npy file
+
+    Returns:
+        np array: the memory mapped matrix
+    """
+    if path not in TRAINING_DATA:
+        TRAINING_DATA[path] = np.load(path, mmap_mode = 'r')
+    return TRAINING_DATA[path]
+
+def training_data_maker(table, data_dir, test_size = 0.25, seed = 1):
+    """This function splits a merged feature table into a training and a test part,
+    fits the preprocessing on the training part and saves both parts normalized as
+    numpy matrices, unless they are up to date
+
+    Args:
+        table (str): path to the merged feature table with a CLASS column
+        data_dir (str): path to the directory of the matrices
+        test_size (float): the fraction of the queries in the test part. Defaults to 0.25.
+        seed (int): the seed of the split. Defaults to 1.
+
+    Returns:
+        str: path to the directory of the matrices
+    """
+    out = f'{data_dir}/train_features.npy'
+    up_to_date, manifest = stage_cache_checker(out, [table], {'stage': 'training_data', 'test_size': test_size,
+                                                              'seed': seed})
+    if up_to_date:
+        print(f'The training data in "{data_dir}" is up to date, moving on...')
+        return data_dir
+    from sklearn.model_selection import train_test_split
+    dir_maker(data_dir)
+    df = table_loader(table)
+    labels = (df.pop('CLASS') == POSITIVE_CLASS).to_numpy(dtype = np.int8)
+    train, test = train_test_split(np.arange(len(df)), test_size = test_size, stratify = labels, random_state = seed)
+    preprocessing = preprocessing_fitter(df.iloc[train])
+    preprocessing_writer(preprocessing, f'{data_dir}/preprocessing.json')
+    #the training features are written last, their manifest marks the whole directory as done
+    for part, rows in (('test', test), ('train', train)):
+        with atomic_writer(f'{data_dir}/{part}_labels.npy', 'wb') as f:
+            np.save(f, labels[rows])
+        with atomic_writer(f'{data_dir}/{part}_features.npy', 'wb') as f:
+            np.save(f, preprocessing_transformer(preprocessing, df.iloc[rows]).to_numpy(dtype = np.float64))
+    stage_cache_writer(out, manifest)
+    print(f'The training data of "{table}" has been saved to "{data_dir}"')
+    return data_dir
+
+def fold_maker(data_dir, n_folds = 5):
+    """This function assigns the training queries to stratified cross-validation
+    folds, as GridSearchCV does, and saves them unless they are up to date
+
+    Args:
+        data_dir (str): path to the directory of the matrices
+        n_folds (int): the number of folds. Defaults to 5.
+
+    Returns:
+        str: path to the folds, the fold of every training query
+    """
+    out = f'{data_dir}/folds{n_folds}.npy'
+    labels = f'{data_dir}/train_labels.npy'
+    up_to_date, manifest = stage_cache_checker(out, [labels], {'stage': 'folds', 'n_folds': n_folds})
+    if up_to_date:
+        return out
+    from sklearn.model_selection import StratifiedKFold
+    y = np.load(labels)
+    folds = np.empty(len(y), dtype = np.int8)
+    for fold, (_, test) in enumerate(StratifiedKFold(n_folds).split(np.zeros(len(y)), y)):
+        folds[test] = fold
+    with atomic_writer(out, 'wb') as f:
+        np.save(f, folds)
+    stage_cache_writer(out, manifest)
+    return out
+
+def fold_scorer(data_dir, folds, family, params, fold):
+    """This function fits a model on all but one fold of the training data and
+    scores its accuracy on that fold
+
+    Args:
+        data_dir (str): path to the directory of the matrices
+        folds (str): path to the folds
+        family (str): the name of the model
+        params (dict): the parameters of the grid
+        fold (int): the fold that is scored
+
+    Returns:
+        float: the accuracy on the fold
+    """
+    X = training_array_loader(f'{data_dir}/train_features.npy')
+    y = training_array_loader(f'{data_dir}/train_labels.npy')
+    train = training_array_loader(folds) != fold
+    estimator = estimator_maker(family, params).fit(X[train], y[train])
+    return estimator.score(X[~train], y[~train])
+
+def model_fitter(data_dir, family, params, out):
+    """This function fits a model on the whole training data, saves it and tests
+    it on the test data
+
+    Args:
+        data_dir (str): path to the directory of the matrices
+        family (str): the name of the model
+        params (dict): the best parameters of the grid
+        out (str): path to save the model to
+
+    Returns:
+        dict: the test statistics of the model
+    """
+    import joblib
+    from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score, \
+        confusion_matrix
+    with open(f'{data_dir}/preprocessing.json') as f:
+        columns = json.load(f)['columns']
+    #the model is fitted with the names of the features, so they are checked when it predicts
+    estimator = estimator_maker(family, params)
+    estimator.fit(pd.DataFrame(training_array_loader(f'{data_dir}/train_features.npy'), columns = columns),
+                  training_array_loader(f'{data_dir}/train_labels.npy'))
+    with atomic_writer(out, 'wb') as f:
+        joblib.dump(estimator, f)
+    X = pd.DataFrame(training_array_loader(f'{data_dir}/test_features.npy'), columns = columns)
+    y = training_array_loader(f'{data_dir}/test_labels.npy')
+    pred = estimator.predict(X)
+    stats = {
+        'accuracy': accuracy_score(y, pred), 'precision': precision_score(y, pred),
+        'recall': recall_score(y, pred), 'f1': f1_score(y, pred),
+        'confusion_matrix': confusion_matrix(y, pred).tolist(), 'test_queries': len(y)
+    }
+    if hasattr(estimator, 'predict_proba'):
+        stats['roc_auc'] = roc_auc_score(y, estimator.predict_proba(X)[:, -1])
+    if hasattr(estimator, 'feature_importances_'):
+        stats['feature_importances'] = estimator.feature_importances_.tolist()
+    return stats
+
+def figure_maker(stats, columns, out_dir, name):
+    """This function draws the confusion matrix and the importance of the features
+    of a model, when matplotlib is installed
+
+    Args:
+        stats (dict): the test statistics of the model
+        columns (list): the names of the features
+        out_dir (str): path to the directory of the figures
+        name (str): the name of the model
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, the figures are not made')
+        return
+    from sklearn.metrics import ConfusionMatrixDisplay
+    dir_maker(out_dir)
+    display = ConfusionMatrixDisplay(np.array(stats['confusion_matrix']), display_labels = ['neg', 'pos'])
+    display.plot(cmap = 'Blues')
+    display.figure_.savefig(f'{out_dir}/{name}_confusion_matrix.png', bbox_inches = 'tight')
+    plt.close(display.figure_)
+    if 'feature_importances' in stats:
+        fig, ax = plt.subplots()
+        ax.barh(columns, stats['feature_importances'])
+        ax.set_xlabel('importance')
+        fig.savefig(f'{out_dir}/{name}_feature_importance.png', bbox_inches = 'tight')
+        plt.close(fig)
+
+def cv_results_writer(results, out):
+    """This function writes the cross-validation scores of every parameter combination
+
+    Args:
+        results (dict): key: (model, parameters as json); value: the score of every fold
+        out (str): path to the output table
+    """
+    rows = [{'model': family, 'params': params, 'mean_score': np.mean(scores), 'std_score': np.std(scores),
+             **{f'fold{fold}_score': score for fold, score in enumerate(scores)}}
+            for (family, params), scores in results.items()]
+    with atomic_writer(out) as f:
+        pd.DataFrame(rows).to_csv(f, sep = '\t', index = False)
+
+def cv_results_loader(out):
+    """This function loads the cross-validation scores written by cv_results_writer
+
+    Args:
+        out (str): path to the table
+
+    Returns:
+        dict: key: (model, parameters as json); value: the score of every fold, empty
+        when there is no table
+    """
+    if not exists(out):
+        return {}
+    df = pd.read_csv(out, sep = '\t', float_precision = 'round_trip')
+    fold_columns = [column for column in df.columns if column.startswith('fold') and column.endswith('_score')]
+    return {(row['model'], row['params']): [row[column] for column in fold_columns if pd.notna(row[column])]
+            for row in df.to_dict('records')}
+
+def model_trainer(training_tables, out_dir, threads, families = None, grids = None, n_folds = 5,
+                  test_size = 0.25, seed = 1, flat = False):
+    """This function trains, cross-validates and tests the models on one or more merged
+    feature tables. All folds of all parameter combinations of all tables run in one
+    process pool, and a model is refitted as soon as its cross-validation is done.
+
+    Args:
+        training_tables (list): the merged feature tables, as 'name=path' or 'path'
+        out_dir (str): path to the output directory, with several tables every table
+        gets the directory '{out_dir}/{name}'
+        threads (int): the number of processes
+        families (list): the names of the models to train. Defaults to None, then all models.
+        grids (dict): key: name of the model; value: the grid of parameters that replaces
+        the one in MODEL_FAMILIES. Defaults to None.
+        n_folds (int): the number of cross-validation folds. Defaults to 5.
+        test_size (float): the fraction of the queries in the test part. Defaults to 0.25.
+        seed (int): the seed of the split. Defaults to 1.
+        flat (bool): also export the models to the flat format, see flat_model.py. Defaults to False.
+
+    Returns:
+        dict: key: (table name, model); value: path to the trained model
+    """
+    from sklearn.model_selection import ParameterGrid
+    families = families or list(MODEL_FAMILIES)
+    grids = {family: (grids or {}).get(family, MODEL_FAMILIES[family][2]) for family in families}
+    settings = {}
+    for table in training_tables:
+        name, path = sample_namer(table)
+        dir = out_dir if len(training_tables) == 1 else f'{out_dir}/{name}'
+        data_dir = training_data_maker(path, f'{dir}/training_data', test_size, seed)
+        settings[name] = {'dir': dir, 'data_dir': data_dir, 'folds': fold_maker(data_dir, n_folds)}
+    models = {}
+    results = {name: {} for name in settings}
+    stats = {}
+    with ProcessPoolExecutor(threads) as pool:
+        running = {}
+        remaining = {}
+        for name, setting in settings.items():
+            for family in families:
+                out = f"{setting['dir']}/ml_models_75_training/diamond_{family}.sav"
+                models[name, family] = out
+                params = {'stage': 'model', 'family': MODEL_FAMILIES[family][:2], 'grid': grids[family],
+                          'n_folds': n_folds}
+                up_to_date, manifest = stage_cache_checker(
+                    out, [f"{setting['data_dir']}/train_features.npy", setting['folds']], params)
+                if up_to_date:
+                    print(f'The model "{out}" is up to date, moving on...')
+                    continue
+                dir_maker(f"{setting['dir']}/ml_models_75_training")
+                candidates = list(ParameterGrid(grids[family]))
+                remaining[name, family] = {'manifest': manifest, 'candidates': candidates, 'tasks': 0}
+                if len(candidates) == 1:
+                    #there is nothing to choose, the model is fitted right away
+                    running[pool.submit(model_fitter, setting['data_dir'], family, candidates[0], out)] = \
+                        ('fit', name, family, candidates[0])
+                    continue
+                for params in candidates:
+                    results[name][family, json.dumps(params)] = [None] * n_folds
+                    for fold in range(n_folds):
+                        running[pool.submit(fold_scorer, setting['data_dir'], setting['folds'], family, params,
+                                            fold)] = ('fold', name, family, (params, fold))
+                        remaining[name, family]['tasks'] += 1
+        while running:
+            future = next(as_completed(running))
+            kind, name, family, task = running.pop(future)
+            if kind == 'fold':
+                params, fold = task
+                results[name][family, json.dumps(params)][fold] = future.result()
+                remaining[name, family]['tasks'] -= 1
+                if remaining[name, family]['tasks'] == 0:
+                    #the first of the best combinations is chosen, as GridSearchCV does
+                    scores = [np.mean(results[name][family, json.dumps(params)])
+                              for params in remaining[name, family]['candidates']]
+                    best = remaining[name, family]['candidates'][int(np.argmax(scores))]
+                    running[pool.submit(model_fitter, settings[name]['data_dir'], family, best,
+                                        models[name, family])] = ('fit', name, family, best)
+            else:
+                stats[name, family] = dict(future.result(), best_params = task)
+                folds = [scores for (f, params), scores in results[name].items()
+                         if f == family and params == json.dumps(task)]
+                if folds:
+                    stats[name, family]['cv_score'] = np.mean(folds[0])
+                print(f'The model "{models[name, family]}" has been trained')
+    for name, setting in settings.items():
+        dir = setting['dir']
+        with open(f"{setting['data_dir']}/preprocessing.json") as f:
+            preprocessing = json.load(f)
+        trained = {family for table, family in remaining if table == name}
+        if trained:
+            #the scores of the models that were up to date are kept from the previous run
+            cv_out = f'{dir}/model_statistics/cv_results.tsv'
+            cv_results = {key: scores for key, scores in cv_results_loader(cv_out).items() if key[0] not in trained}
+            cv_results.update(results[name])
+            if cv_results:
+                dir_maker(f'{dir}/model_statistics')
+                cv_results_writer(cv_results, cv_out)
+        for family in families:
+            out = models[name, family]
+            if (name, family) not in stats:
+                continue
+            dir_maker(f'{dir}/model_statistics')
+            with atomic_writer(f'{dir}/model_statistics/diamond_{family}.json') as f:
+                json.dump(stats[name, family], f, indent = 1)
+            figure_maker(stats[name, family], preprocessing['columns'], f'{dir}/confusion_matrices', f'diamond_{family}')
+            #the model normalizes its features as they were normalized for training
+            preprocessing_writer(preprocessing, preprocessing_path(out))
+            if flat:
+                from flat_model import model_exporter
+                model_exporter(out)
+            stage_cache_writer(out, remaining[name, family]['manifest'])
+    return models
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Train, cross-validate and test the models on merged feature tables')
+    parser.add_argument('training_tables', nargs = '+',
+                        help = "merged feature tables with a CLASS column, as 'path' or 'name=path'")
+    parser.add_argument('out_dir', help = 'output directory')
+    parser.add_argument('threads', type = int, help = 'number of processes')
+    parser.add_argument('-m', '--models', nargs = '+', default = None, choices = list(MODEL_FAMILIES),
+                        help = 'models to train. Defaults to all models')
+    parser.add_argument('--grid', default = None,
+                        help = 'json file with the grid of parameters of a model, e.g. {"random_forest": '
+                               '{"n_estimators": [101, 501]}}, that replaces the default grid')
+    parser.add_argument('--folds', type = int, default = 5, help = 'number of cross-validation folds')
+    parser.add_argument('--test-size', type = float, default = 0.25, help = 'fraction of the queries used to test')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the split into training and test queries')
+    parser.add_argument('--flat', action = 'store_true', help = 'also export the models to the flat format')
+    args = parser.parse_args()
+    grids = None
+    if args.grid is not None:
+        with open(args.grid) as f:
+            grids = json.load(f)
+    model_trainer(args.training_tables, args.out_dir, args.threads, args.models, grids, args.folds,
+                  args.test_size, args.seed, args.flat)
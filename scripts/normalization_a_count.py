@@ -1,23 +1,21 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-from Bio import SeqIO
+from fasta_index import fasta_lengths
+from feature_table import table_loader, table_writer
 import sys
 
 
-df = pd.read_csv(sys.argv[1], sep = '\t')
+df = table_loader(sys.argv[1])
 
 df = df[df['alignment_count']!=0]
-length = {}
-normalized = []
-for re in SeqIO.parse(sys.argv[2],'fasta'):
-	length[re.id] = len(str(re.seq))
+length = fasta_lengths(sys.argv[2])
 
-for i in df['query']:
-	normalized.append(int((df[df['query'] == i]['alignment_count']))/length[i])
-df['alignment_count']=normalized
-
-df['query'] = df['query'].astype(str)
-
-df.to_csv(sys.argv[3],index=False,sep = '\t')
+df.index = df.index.astype(str)
+#a query without a length would get a missing alignment count, which the models can not predict
+missing = df.index[~df.index.isin(length)]
+if len(missing):
+    raise KeyError(f'{len(missing)} queries of "{sys.argv[1]}" are not in "{sys.argv[2]}", e.g. {list(missing[:10])}')
+#divide by the length of every query at once, instead of filtering the table per query
+df['alignment_count'] = df['alignment_count'] / df.index.map(length)
 
+table_writer(df, sys.argv[3])
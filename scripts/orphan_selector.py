@@ -8,12 +8,15 @@ evalue given in the evalue range
 """
 
 import os
-from pathlib import Path
 import re
-import subprocess as sp
-from general_functions import dir_maker
-from Bio.SeqIO.FastaIO import FastaIterator, as_fasta
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+from bisect import bisect_right
+from contextlib import ExitStack
+from general_functions import dir_maker, file_opener
+from diamond_table import diamond_table_reader, query_group_reader
+from stage_cache import stage_cache_checker, stage_cache_writer, atomic_writer, id_hasher
+from stage_profiler import stage_timer
+from concurrent.futures import ProcessPoolExecutor
 
 def query_selector(diamond_table):
     """This function gets the query sequence which is the first column of the table
@@ -24,11 +27,13 @@ def query_selector(diamond_table):
     Returns:
         list: query ids from the first column
     """
-    query_ids = []
-    with open(diamond_table) as f:
-        for line in f:
-            query_ids.append(line.split('\t')[0])
-    unique_query_ids = list(set(query_ids))
+    unique_query_ids = []
+    with stage_timer('query selection') as counts:
+        #the ids are collected by the reader in order of first appearance
+        for chunk in diamond_table_reader(diamond_table, ['qseqid']):
+            unique_query_ids = chunk['query_ids']
+            counts['rows'] = (counts['rows'] or 0) + len(chunk['qseqid'])
+        counts['queries'] = len(unique_query_ids)
     return unique_query_ids
 
 def diamond_table_comparer(low_eval_table, high_eval_table):
@@ -63,6 +68,89 @@ def diamond_table_comparer(low_eval_table, high_eval_table):
         filtered_ids = {id:None for id in high_eval_ids if id not in low_eval_ids}
         return filtered_ids
 
+def orphan_group_selector(query_groups, eval_cutoff):
+    """This function selects the queries that did not get a hit with an evalue
+    below the cutoff, from a stream of query groups
+
+    Args:
+        query_groups (iterable): tuples of a query id and the columns of its lines,
+        as made by diamond_table.query_group_reader
+        eval_cutoff (float): queries with a hit below this evalue are significant
+
+    Yields:
+        tuple: the query id and the columns of its lines, for the orphan queries only
+    """
+    for query, lines in query_groups:
+        if min(float(columns[10]) for columns in lines) >= eval_cutoff:
+            yield query, lines
+
+def evalue_partitioner(diamond_table, eval_thresholds, out_tables = None):
+    """This function divides the queries of one diamond table into evalue bands by
+    the lowest evalue of their hits, in a single read of the table. Band 0 contains the
+    queries with a hit below the first threshold, band i the queries with their lowest
+    evalue between threshold i - 1 and threshold i and the last band the queries
+    without a hit below the last threshold. The lines of a query should be grouped
+    together, as diamond writes them.
+
+    Args:
+        diamond_table (str): path to the diamond table
+        eval_thresholds (list): the evalue thresholds between the bands
+        out_tables (list): path to the output table of every band, the lines of the
+        queries in that band are written to it. None skips a band. Defaults to None.
+
+    Returns:
+        list: a set of query ids for every band
+    """
+    eval_thresholds = sorted(eval_thresholds)
+    n_bands = len(eval_thresholds) + 1
+    if out_tables is None:
+        out_tables = [None] * n_bands
+    if len(out_tables) != n_bands:
+        raise ValueError(f'{len(eval_thresholds)} evalue thresholds give {n_bands} bands, '
+                         f'but {len(out_tables)} output tables are given')
+    bands = [set() for i in range(n_bands)]
+    with stage_timer('query selection') as counts, ExitStack() as stack:
+        handles = [stack.enter_context(atomic_writer(out)) if out is not None else None for out in out_tables]
+        n_lines = 0
+        with file_opener(diamond_table) as f:
+            for query, lines in query_group_reader(f):
+                min_eval = min(float(columns[10]) for columns in lines)
+                band = bisect_right(eval_thresholds, min_eval)
+                bands[band].add(query)
+                n_lines += len(lines)
+                if handles[band] is not None:
+                    handles[band].writelines('\t'.join(columns) + '\n' for columns in lines)
+        counts['rows'] = n_lines
+        counts['queries'] = sum(len(band) for band in bands)
+    return bands
+
+def orphan_partitioner(diamond_table, sim_fa, eval_cutoff, out_table, out_seq):
+    """This function selects the orphans from a single diamond table: the queries
+    that got hits, but none with an evalue below the cutoff. Their lines and
+    sequences are written to separate files.
+
+    Args:
+        diamond_table (str): path to the diamond table
+        sim_fa (str): path to the fasta file with the query sequences
+        eval_cutoff (float): queries with a hit below this evalue are significant
+        out_table (str): path to the output table of the orphans
+        out_seq (str): path to the output fasta file of the orphans
+
+    Returns:
+        set: the ids of the orphans
+    """
+    params = {'stage': 'orphan_partitioner', 'eval_cutoff': eval_cutoff}
+    up_to_date, manifest = stage_cache_checker(out_table, [diamond_table], params)
+    if up_to_date:
+        print(f'{out_table} is up to date, moving on...')
+        orphans = set(query_selector(out_table))
+    else:
+        significant, orphans = evalue_partitioner(diamond_table, [eval_cutoff], [None, out_table])
+        stage_cache_writer(out_table, manifest)
+        print(f'{len(significant)} queries have a significant hit, {len(orphans)} queries are orphans')
+    seq_selector(sim_fa, out_seq, orphans)
+    return orphans
+
 def seq_selector(in_seq, out_seq, ids):
     """This function gets the sequences corresponding to the ids given
 
@@ -71,15 +159,20 @@ def seq_selector(in_seq, out_seq, ids):
         out_seq (str): path to the output file
         ids (dict): the ids of the sequences that should be selected
     """
-    if os.path.exists(out_seq):
-        print(f'{out_seq} already exists, moving on...')
+    up_to_date, manifest = stage_cache_checker(out_seq, [in_seq], {'stage': 'seq_selector', 'ids': id_hasher(ids)})
+    if up_to_date:
+        print(f'{out_seq} is up to date, moving on...')
     else:
-        with open(in_seq) as handle:
+        #Biopython is only imported when sequences are selected
+        from Bio.SeqIO.FastaIO import FastaIterator, as_fasta
+        with stage_timer('fasta parsing') as counts, file_opener(in_seq) as handle, atomic_writer(out_seq) as handle_out:
+            n_records = 0
             for record in FastaIterator(handle):
+                n_records += 1
                 if record.id in ids:
-                    with open(out_seq, 'a') as handle_out:
-                        handle_out.write(as_fasta(record))
-                    
+                    handle_out.write(as_fasta(record))
+            counts['rows'] = n_records
+        stage_cache_writer(out_seq, manifest)
         print(f'{out_seq} has been made')
 
 def line_query_selector(diamond_table, query_ids, out_table):
@@ -91,20 +184,22 @@ def line_query_selector(diamond_table, query_ids, out_table):
         query_ids (list): query ids that should be selected from the diamond table
         out_table (str): path to the output table
     """
-    if os.path.exists(out_table):
-        print(f'{out_table} already exists, moving on...')
+    params = {'stage': 'line_query_selector', 'ids': id_hasher(query_ids)}
+    up_to_date, manifest = stage_cache_checker(out_table, [diamond_table], params)
+    if up_to_date:
+        print(f'{out_table} is up to date, moving on...')
     else:
-        #get all lines that have the query id
-        lines = []
-        with open(diamond_table) as f:
-            for line in f:
-                query_id = line.split('\t')[0]
-                if query_id in query_ids:
-                    lines.append(line)
-        #write the lines to a file
-        with open(out_table, 'w') as f:
-            for line in lines:
-                f.write(line)
+        #the lines are compared and written as bytes, so they are copied unchanged
+        ids = {id.encode() for id in query_ids}
+        with stage_timer('line selection') as counts, file_opener(diamond_table, 'rb') as handle, \
+                atomic_writer(out_table, 'wb') as f:
+            n_lines = 0
+            for line in handle:
+                n_lines += 1
+                if line.split(b'\t', 1)[0] in ids:
+                    f.write(line)
+            counts['rows'] = n_lines
+        stage_cache_writer(out_table, manifest)
         print(f'{out_table} has been made')
 
 def table_filterer(args):
@@ -124,16 +219,14 @@ def table_filterer(args):
     high_table = args[2]
     out_seq = args[3]
     out_table = args[4]
-    if os.path.exists(out_seq) and os.path.exists(out_table):
-        print(f'"{out_seq}" and "{out_table} already exists, moving on...')
-    else:
-        #get ids that are present in the high_table and not in the low_table
-        ids = diamond_table_comparer(low_table, high_table)
-        print(ids)
-        #write the sequences that are not in the ids to a seperate file
-        seq_selector(sim_fa, out_seq, ids)
-        #filter the ids from the diamond table
-        line_query_selector(high_table, ids, out_table)
+    #get ids that are present in the high_table and not in the low_table
+    ids = diamond_table_comparer(low_table, high_table)
+    print(f'{len(ids)} queries of {high_table} have no hit in {low_table}')
+    #write the sequences that are not in the ids to a seperate file,
+    #both outputs are only made again when their inputs or the ids changed
+    seq_selector(sim_fa, out_seq, ids)
+    #filter the ids from the diamond table
+    line_query_selector(high_table, ids, out_table)
 
 def main(diamond_dir, orphan_seq, eval_range, threads, out_dir):
     """This function selects the sequences that don't have a diamond hit 
@@ -145,27 +238,51 @@ def main(diamond_dir, orphan_seq, eval_range, threads, out_dir):
         eval_range (list): two evalues, sequences will be selected that do
         have a hit a the first value and don't have a hit at the second value
         threads (int): the number of threads you want to use
-        out_dir (str): path to directory containing the sequences with no hit
+        out_dir (str): path to directory containing the sequences with no hit, the
+        outputs of every table are written to a directory named after the table
 
     Returns:
-        str: path to diamond and the corresponding sequences
+        list: tuples of the path to the diamond table and the corresponding sequences of every table
     """
     args_table_filterer = []
+    outputs = []
 
     main_dir_eval1 = f'{diamond_dir}_eval{eval_range[0]}'
     main_dir_eval2 = f'{diamond_dir}_eval{eval_range[1]}'
     for file in os.listdir(f'{main_dir_eval1}'):
         path_file1 = f'{main_dir_eval1}/{file}'
         path_file2 = f'{main_dir_eval2}/{file}'
-        #make directory to put the results into
-        dir_maker(out_dir)
-        out_file_seq = f'{out_dir}/orphan.fa'
-        out_file_table = f'{out_dir}/diamond_orphan.m12'
+        #make a directory per table, so the processes do not write the same outputs
+        out_file_dir = dir_maker(f'{out_dir}/{file}')
+        out_file_seq = f'{out_file_dir}/orphan.fa'
+        out_file_table = f'{out_file_dir}/diamond_orphan.m12'
         args_table_filterer.append([orphan_seq, path_file1, path_file2, out_file_seq, out_file_table])
+        outputs.append((out_file_table, out_file_seq))
     #Remove all the diamond hits from the fasta and write it to another file
-    with ThreadPoolExecutor(threads) as thread:
-            thread.map(table_filterer, args_table_filterer)
-    return out_file_table, out_file_seq
+    #the filtering is cpu bound, so processes are used to avoid the GIL
+    with ProcessPoolExecutor(threads) as pool:
+        list(pool.map(table_filterer, args_table_filterer))
+    return outputs
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'Select the orphans from diamond tables')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    partition = subparsers.add_parser('partition', help = 'select the orphans from a single diamond table')
+    partition.add_argument('diamond_table', help = 'diamond table in the default table format')
+    partition.add_argument('sim_fa', help = 'fasta file with the query sequences')
+    partition.add_argument('out_table', help = 'output table with the lines of the orphans')
+    partition.add_argument('out_seq', help = 'output fasta file with the orphan sequences')
+    partition.add_argument('--eval-cutoff', type = float, default = 0.001,
+                           help = 'queries with a hit below this evalue are significant')
+    compare = subparsers.add_parser('compare', help = 'select the queries with a hit at the high evalue and not at the low evalue')
+    compare.add_argument('diamond_dir', help = "diamond results, in the directories '{diamond_dir}_eval{evalue}'")
+    compare.add_argument('orphan_seq', help = 'fasta file with the query sequences')
+    compare.add_argument('out_dir', help = 'directory to write orphan.fa and diamond_orphan.m12 of every table to, in $out_dir/$table/')
+    compare.add_argument('--eval-range', nargs = 2, required = True, metavar = ('LOW', 'HIGH'),
+                         help = 'the low and high evalue, as in the directory names')
+    compare.add_argument('-t', '--threads', type = int, default = 1, help = 'number of processes')
+    args = parser.parse_args()
+    if args.command == 'partition':
+        orphan_partitioner(args.diamond_table, args.sim_fa, args.eval_cutoff, args.out_table, args.out_seq)
+    elif args.command == 'compare':
+        main(args.diamond_dir, args.orphan_seq, args.eval_range, args.threads, args.out_dir)
\ No newline at end of file
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script runs the whole pipeline, from the DIAMOND search to the
+predictions, as a graph of stages. Every sample and every DIAMOND evalue is an
+independent branch of the graph:
+
+    diamond -> orphans (orphan table and fasta)
+            -> features -> normalized features -> predictions
+
+The stages whose dependencies are done run at the same time, as long as their
+cores fit in the core budget. The features are extracted while the table is
+read, selecting the orphans in memory, so they do not wait for the orphan table.
+Stages whose output is up to date are skipped, see stage_cache.py. The time,
+throughput and memory of every stage are written as a json report with --report,
+see stage_profiler.py.
+"""
+
+import argparse
+import os
+import subprocess as sp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from general_functions import dir_maker, sample_namer
+from stage_cache import stage_cache_checker, stage_cache_writer, atomic_writer
+from stage_profiler import STAGE_STATS, stage_timer, stage_stats_merger, stage_report_writer
+from orphan_selector import orphan_partitioner
+from fasta_index import fasta_lengths
+from feature_table import table_loader, table_writer
+from preprocessing import length_normalizer
+import diamond_feature_extractor
+import run_the_models
+
+DIAMOND_CMD = 'diamond blastp -q {query} -d {database} --ultra-sensitive -o {out} -f 6 -p {threads} -e {evalue}'
+
+def diamond_runner(query, database, out, evalue, threads, diamond_cmd = DIAMOND_CMD):
+    """This function runs a DIAMOND search, unless its table is up to date
+
+    Args:
+        query (str): path to the fasta file with the query sequences
+        database (str): path to the DIAMOND database
+        out (str): path to the output table
+        evalue (str): the evalue cutoff of the search
+        threads (int): the number of threads DIAMOND uses
+        diamond_cmd (str): the command, with the fields {query}, {database}, {out},
+        {threads} and {evalue}. Any command that writes a table in the default DIAMOND
+        format to {out} can be used, e.g. 'cp table.m8 {out}' for testing. Defaults to DIAMOND_CMD.
+
+    Returns:
+        str: path to the output table
+    """
+    params = {'stage': 'diamond', 'cmd': diamond_cmd, 'evalue': evalue}
+    up_to_date, manifest = stage_cache_checker(out, [query, database], params)
+    if up_to_date:
+        print(f'The file "{out}" is up to date, moving on...')
+        return out
+    dir_maker(os.path.dirname(out) or '.')
+    #the table replaces the output only when diamond finished without an error
+    with stage_timer('diamond'), atomic_writer(out) as f:
+        command = diamond_cmd.format(query = query, database = database, out = f.name,
+                                     threads = threads, evalue = evalue)
+        sp.run(command, shell = True, check = True)
+    stage_cache_writer(out, manifest)
+    print(f'The file "{out}" has been made')
+    return out
+
+def prediction_table_maker(features, fasta, out):
+    """This function makes the table the models predict from a feature table: the
+    queries without a hit are removed and the alignment count is divided by the
+    length of the query, as normalization_a_count.py does
+
+    Args:
+        features (str): path to the feature table
+        fasta (str): path to the fasta file of the queries
+        out (str): path to the output table
+
+    Returns:
+        str: path to the output table
+    """
+    up_to_date, manifest = stage_cache_checker(out, [features, fasta], {'stage': 'prediction_table'})
+    if up_to_date:
+        print(f'The file "{out}" is up to date, moving on...')
+        return out
+    df = table_loader(features)
+    df = df[df['alignment_count'] != 0]
+    df.index = df.index.astype(str)
+    table_writer(length_normalizer(df, fasta_lengths(fasta)), out)
+    stage_cache_writer(out, manifest)
+    print(f'The file "{out}" has been made')
+    return out
+
+def timed_task_runner(name, function, args):
+    """This function runs a stage of the graph in a worker process and measures it
+
+    Args:
+        name (str): the name of the stage
+        function (function): the function that runs the stage
+        args (list): the arguments of the function
+
+    Returns:
+        tuple: what the function returned and the statistics measured in the stage
+    """
+    #the worker processes are reused, so only the statistics of this stage are returned
+    STAGE_STATS.clear()
+    with stage_timer(name):
+        result = function(*args)
+    return result, dict(STAGE_STATS)
+
+def task_maker(function, args, deps = (), cores = 1):
+    """This function makes a stage of the graph
+
+    Args:
+        function (function): the function that runs the stage, should be picklable
+        args (list): the arguments of the function
+        deps (iterable): the names of the stages that should be done first. Defaults to ().
+        cores (int): the number of cores the stage uses. Defaults to 1.
+
+    Returns:
+        dict: the stage
+    """
+    return {'function': function, 'args': list(args), 'deps': list(deps), 'cores': cores}
+
+def task_graph_maker(samples, database, out_dir, evalues, eval_cutoff, ml_models = None,
+                     diamond_cmd = DIAMOND_CMD, diamond_threads = 1):
+    """This function makes the stages of every sample and DIAMOND evalue
+
+    Args:
+        samples (list): the samples, as 'name=path' or 'path' to a fasta file
+        database (str): path to the DIAMOND database
+        out_dir (str): path to the output directory, every branch writes to
+        '{out_dir}/{sample}/eval{evalue}'
+        evalues (list): the evalue cutoffs of the DIAMOND searches
+        eval_cutoff (float): queries with a hit below this evalue are not orphans
+        ml_models (list): paths to the models that predict the features. Defaults to None.
+        diamond_cmd (str): the DIAMOND command, see diamond_runner. Defaults to DIAMOND_CMD.
+        diamond_threads (int): the number of threads of every DIAMOND search. Defaults to 1.
+
+    Returns:
+        dict: key: name of the stage; value: the stage
+    """
+    tasks = {}
+    for sample in samples:
+        name, fasta = sample_namer(sample)
+        for evalue in evalues:
+            branch = f'{name}/eval{evalue}'
+            dir = f'{out_dir}/{branch}'
+            table = f'{dir}/diamond.m8'
+            tasks[f'{branch}/diamond'] = task_maker(
+                diamond_runner, [fasta, database, table, evalue, diamond_threads, diamond_cmd],
+                cores = diamond_threads)
+            tasks[f'{branch}/orphans'] = task_maker(
+                orphan_partitioner, [table, fasta, eval_cutoff, f'{dir}/orphan.m8', f'{dir}/orphan.fa'],
+                [f'{branch}/diamond'])
+            #the orphans are selected while the table is read, so the features do not wait for the orphan table
+            tasks[f'{branch}/features'] = task_maker(
+                diamond_feature_extractor.main, [fasta, table, fasta, dir, True, eval_cutoff],
+                [f'{branch}/diamond'])
+            if ml_models:
+                features = f'{dir}/diamond_features/diamond_features.tsv'
+                normalized = f'{dir}/diamond_features/diamond_features_normalized.tsv'
+                tasks[f'{branch}/normalized'] = task_maker(
+                    prediction_table_maker, [features, fasta, normalized], [f'{branch}/features'])
+                tasks[f'{branch}/predictions'] = task_maker(
+                    run_the_models.main, [normalized, ml_models, f'{dir}/predictions.tsv'],
+                    [f'{branch}/normalized'])
+    return tasks
+
+def task_graph_runner(tasks, cores):
+    """This function runs the stages of a graph. A stage is started when the stages
+    it depends on are done and its cores fit in the core budget, stages that use
+    more cores than the budget get the whole budget.
+
+    Args:
+        tasks (dict): key: name of the stage; value: the stage, see task_maker
+        cores (int): the number of cores that can be used at the same time
+
+    Raises:
+        ValueError: when a stage depends on a stage that is not in the graph or
+        the stages depend on each other in a cycle
+
+    Returns:
+        dict: key: name of the stage; value: what the stage returned
+    """
+    for name, task in tasks.items():
+        for dep in task['deps']:
+            if dep not in tasks:
+                raise ValueError(f'The stage "{name}" depends on the unknown stage "{dep}"')
+    pending = dict(tasks)
+    running = {}
+    done = {}
+    free = cores
+    with ProcessPoolExecutor(cores) as pool:
+        while pending or running:
+            for name, task in list(pending.items()):
+                needed = min(task['cores'], cores)
+                if needed <= free and all(dep in done for dep in task['deps']):
+                    print(f'Starting "{name}"')
+                    running[pool.submit(timed_task_runner, name, task['function'], task['args'])] = (name, needed)
+                    free -= needed
+                    del pending[name]
+            if not running:
+                raise ValueError(f'The stages {sorted(pending)} depend on each other in a cycle')
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name, needed = running.pop(future)
+                free += needed
+                #an error in a stage stops the pipeline, the running stages are finished first
+                done[name], stats = future.result()
+                stage_stats_merger(stats)
+                print(f'Finished "{name}"')
+    return done
+
+def main(samples, database, out_dir, evalues, eval_cutoff = 0.001, ml_models = None, cores = None,
+         diamond_cmd = DIAMOND_CMD, diamond_threads = None, report = None):
+    """This function runs the pipeline for every sample and DIAMOND evalue
+
+    Args:
+        samples (list): the samples, as 'name=path' or 'path' to a fasta file
+        database (str): path to the DIAMOND database
+        out_dir (str): path to the output directory
+        evalues (list): the evalue cutoffs of the DIAMOND searches
+        eval_cutoff (float): queries with a hit below this evalue are not orphans. Defaults to 0.001.
+        ml_models (list): paths to the models that predict the features. Defaults to None.
+        cores (int): the core budget. Defaults to None, then all cores are used.
+        diamond_cmd (str): the DIAMOND command, see diamond_runner. Defaults to DIAMOND_CMD.
+        diamond_threads (int): the number of threads of every DIAMOND search. Defaults to None,
+        then every search uses the whole budget.
+        report (str): path to write the json report of the stages to. Defaults to None.
+
+    Returns:
+        dict: key: name of the stage; value: what the stage returned
+    """
+    cores = cores or os.cpu_count()
+    diamond_threads = diamond_threads or cores
+    tasks = task_graph_maker(samples, database, out_dir, evalues, eval_cutoff, ml_models,
+                             diamond_cmd, diamond_threads)
+    done = task_graph_runner(tasks, cores)
+    if report is not None:
+        stage_report_writer(report)
+        print(f'The report of the stages has been written to "{report}"')
+    return done
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run the pipeline from the DIAMOND search to the predictions')
+    parser.add_argument('samples', nargs = '+', help = "fasta files of the samples, as 'path' or 'name=path'")
+    parser.add_argument('-d', '--database', required = True, help = 'DIAMOND database')
+    parser.add_argument('-o', '--out-dir', required = True, help = 'output directory')
+    parser.add_argument('-e', '--evalues', nargs = '+', default = ['10'],
+                        help = 'evalue cutoffs of the DIAMOND searches, every evalue is a separate branch')
+    parser.add_argument('--eval-cutoff', type = float, default = 0.001,
+                        help = 'queries with a hit below this evalue are not orphans')
+    parser.add_argument('-m', '--models', nargs = '+', default = None,
+                        help = 'models that predict the features of every branch')
+    parser.add_argument('-c', '--cores', type = int, default = None,
+                        help = 'number of cores used at the same time. Defaults to all cores')
+    parser.add_argument('--diamond-threads', type = int, default = None,
+                        help = 'number of threads of every DIAMOND search. Defaults to the number of cores')
+    parser.add_argument('--diamond-cmd', default = DIAMOND_CMD,
+                        help = "DIAMOND command with the fields {query}, {database}, {out}, {threads} and {evalue}, "
+                               "e.g. 'cp {database} {out}' to use an existing table for testing")
+    parser.add_argument('--report', default = None,
+                        help = 'json file to write the time, throughput and memory of every stage to')
+    parser.add_argument('--profile', default = None,
+                        help = 'directory to save a cProfile of every stage to')
+    args = parser.parse_args()
+    if args.profile is not None:
+        #the worker processes inherit the environment
+        os.environ['STAGE_PROFILE'] = args.profile
+    main(args.samples, args.database, args.out_dir, args.evalues, args.eval_cutoff, args.models,
+         args.cores, args.diamond_cmd, args.diamond_threads, args.report)
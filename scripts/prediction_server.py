@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script runs a local prediction service that keeps the models
+loaded, so predictions do not pay for starting python, importing the libraries and
+loading the models. The rows of requests that arrive at the same time are predicted
+together in one call per model.
+
+The service listens on localhost and answers json:
+    POST /predict   {"columns": [...], "index": [...], "data": [[...], ...]}, the
+                    features of every query as a row, gets the predictions
+                    {"index": [...], "random_forest": [...], ...}
+    GET /stats      the number of requests, rows and batches, latencies and throughput
+    GET /health     "ok" when the models are loaded
+
+server_predictor sends a dataframe to the service and returns the predictions.
+"""
+
+import argparse
+import json
+import queue
+import threading
+import urllib.request
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from run_the_models import model_loader, batch_predictor, column_stats_loader
+from preprocessing import preprocessing_loader
+from fasta_index import fasta_lengths
+from stage_profiler import stage_report_maker
+
+PORT = 8765
+MAX_BATCH_ROWS = 10000
+MAX_WAIT = 0.005
+#the number of recent request latencies the percentiles are calculated over
+LATENCY_WINDOW = 10000
+#the number of connections that wait to be accepted, many workers connect at once
+REQUEST_QUEUE_SIZE = 128
+
+def server_state_maker(ml_models, stats_file = None, fasta = None, max_batch_rows = MAX_BATCH_ROWS,
+                       max_wait = MAX_WAIT):
+    """This function loads the models and their preprocessing and makes the state of the service
+
+    Args:
+        ml_models (list): paths to the machine learning models
+        stats_file (str): path to column statistics, to normalize the features of the models
+        without a saved preprocessing. Defaults to None, then every model needs a saved preprocessing.
+        fasta (str): path to the fasta file of the queries, for preprocessings that normalize
+        the alignment count. Defaults to None.
+        max_batch_rows (int): the largest number of rows predicted together. Defaults to MAX_BATCH_ROWS.
+        max_wait (float): the seconds a request waits for other requests to be predicted
+        together with. Defaults to MAX_WAIT.
+
+    Raises:
+        ValueError: when a model has no saved preprocessing and no column statistics are given,
+        its predictions would not match those of run_the_models.py
+
+    Returns:
+        dict: the state of the service
+    """
+    for ml_model in ml_models:
+        model_loader(ml_model)
+    preprocessings = {ml_model: preprocessing_loader(ml_model) for ml_model in ml_models}
+    if stats_file is not None:
+        stats = column_stats_loader(stats_file)
+        preprocessings = {ml_model: preprocessing or stats for ml_model, preprocessing in preprocessings.items()}
+    missing = [ml_model for ml_model, preprocessing in preprocessings.items() if not preprocessing]
+    if missing:
+        raise ValueError(f'The models {missing} have no saved preprocessing, give the column statistics of '
+                         'their training features with --stats')
+    return {
+        'ml_models': ml_models, 'preprocessings': preprocessings,
+        'lengths': fasta_lengths(fasta) if fasta is not None else None,
+        'max_batch_rows': max_batch_rows, 'max_wait': max_wait, 'queue': queue.Queue(),
+        'lock': threading.Lock(), 'start': perf_counter(), 'latencies': deque(maxlen = LATENCY_WINDOW),
+        'counters': {'requests': 0, 'rows': 0, 'batches': 0, 'batch_rows': 0,
+                     'errors': 0, 'predict_seconds': 0.0}
+    }
+
+def request_group_predictor(state, group):
+    """This function predicts requests with the same columns in one call per model.
+    When that fails, every request is predicted on its own, so a malformed request
+    only gets its own error and not the other requests of the batch.
+
+    Args:
+        state (dict): the state of the service
+        group (list): the requests, with the features under 'data'
+    """
+    try:
+        data = pd.concat([request['data'] for request in group])
+        predictions = batch_predictor(state['ml_models'], data, max(len(data), 1),
+                                      state['preprocessings'], state['lengths'])
+        row = 0
+        for request in group:
+            request['result'] = predictions.iloc[row:row + len(request['data'])]
+            row += len(request['data'])
+    except Exception as error:
+        if len(group) == 1:
+            group[0]['error'] = f'{type(error).__name__}: {error}'
+            return
+        for request in group:
+            request_group_predictor(state, [request])
+
+def request_batcher(state):
+    """This function predicts the queued requests, the requests that arrive within
+    max_wait of the first one are predicted together. It runs until None is queued.
+
+    Args:
+        state (dict): the state of the service, see server_state_maker
+    """
+    requests = state['queue']
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        batch = [request]
+        n_rows = len(request['data'])
+        deadline = perf_counter() + state['max_wait']
+        while n_rows < state['max_batch_rows']:
+            timeout = deadline - perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                #stop after this batch
+                requests.put(None)
+                break
+            batch.append(request)
+            n_rows += len(request['data'])
+        start = perf_counter()
+        #requests with other columns are not concatenated, that would fill the missing columns with NaN
+        groups = {}
+        for request in batch:
+            groups.setdefault(tuple(request['data'].columns), []).append(request)
+        for group in groups.values():
+            request_group_predictor(state, group)
+        with state['lock']:
+            counters = state['counters']
+            counters['batches'] += 1
+            counters['batch_rows'] += n_rows
+            counters['predict_seconds'] += perf_counter() - start
+        for request in batch:
+            request['done'].set()
+
+def row_predictor(state, data):
+    """This function queues rows to be predicted and waits for their predictions
+
+    Args:
+        state (dict): the state of the service
+        data (pd df): the features, indexed by query
+
+    Raises:
+        ValueError: when the prediction failed
+
+    Returns:
+        pd df: the predictions of every model, indexed by query
+    """
+    request = {'data': data, 'done': threading.Event()}
+    state['queue'].put(request)
+    request['done'].wait()
+    if 'error' in request:
+        raise ValueError(request['error'])
+    return request['result']
+
+def server_stats_maker(state):
+    """This function makes the statistics of the service
+
+    Returns:
+        dict: the counters, the mean batch size, the latency percentiles in milliseconds
+        of the recent requests, the rows per second and the time of the prediction stages
+    """
+    with state['lock']:
+        counters = dict(state['counters'])
+        latencies = np.array(state['latencies']) * 1000
+    uptime = perf_counter() - state['start']
+    stats = dict(counters)
+    stats['uptime'] = uptime
+    stats['mean_batch_rows'] = counters['batch_rows'] / counters['batches'] if counters['batches'] else None
+    stats['rows_per_sec'] = counters['rows'] / uptime
+    stats['rows_per_predict_sec'] = counters['batch_rows'] / counters['predict_seconds'] \
+        if counters['predict_seconds'] > 0 else None
+    if len(latencies):
+        stats['latency_ms'] = {
+            'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())
+        }
+    stats['stages'] = stage_report_maker()['stages']
+    return stats
+
+class PredictionServer(ThreadingHTTPServer):
+    """This class is the http server of the prediction service, every request is
+    answered in its own thread"""
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """This class answers the requests of the prediction service"""
+
+    def json_sender(self, status, content):
+        """This function sends a json answer
+
+        Args:
+            status (int): the http status
+            content: the json content
+        """
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.json_sender(200, server_stats_maker(self.server.state))
+        elif self.path == '/health':
+            self.json_sender(200, 'ok')
+        else:
+            self.json_sender(404, {'error': f'unknown path "{self.path}"'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.json_sender(404, {'error': f'unknown path "{self.path}"'})
+            return
+        state = self.server.state
+        start = perf_counter()
+        try:
+            content = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            data = pd.DataFrame(content['data'], index = content.get('index'), columns = content['columns'],
+                                dtype = np.float64)
+            n_rows = len(data)
+            predictions = row_predictor(state, data)
+            answer = {'index': [str(query) for query in predictions.index]}
+            answer.update({column: predictions[column].tolist() for column in predictions.columns})
+        except Exception as error:
+            with state['lock']:
+                state['counters']['errors'] += 1
+            self.json_sender(400, {'error': f'{type(error).__name__}: {error}'})
+            return
+        with state['lock']:
+            state['counters']['requests'] += 1
+            state['counters']['rows'] += n_rows
+            state['latencies'].append(perf_counter() - start)
+        self.json_sender(200, answer)
+
+    def log_message(self, format, *args):
+        #every request would be printed otherwise
+        pass
+
+def server_predictor(data, url = f'http://127.0.0.1:{PORT}'):
+    """This function gets the predictions of features from a running prediction service
+
+    Args:
+        data (pd df): the features, indexed by query
+        url (str): the address of the service. Defaults to localhost on PORT.
+
+    Returns:
+        pd df: the predictions of every model, indexed by query
+    """
+    #json.dumps writes the floats exactly, DataFrame.to_json rounds them
+    body = json.dumps({'columns': list(data.columns), 'index': [str(query) for query in data.index],
+                       'data': data.to_numpy(dtype = np.float64).tolist()}).encode()
+    request = urllib.request.Request(f'{url}/predict', body, {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as f:
+        answer = json.load(f)
+    index = answer.pop('index')
+    return pd.DataFrame(answer, index = pd.Index(index, name = data.index.name))
+
+def main(ml_models, host = '127.0.0.1', port = PORT, stats_file = None, fasta = None,
+         max_batch_rows = MAX_BATCH_ROWS, max_wait = MAX_WAIT):
+    """This function loads the models and serves predictions until it is interrupted
+
+    Args:
+        ml_models (list): paths to the machine learning models
+        host (str): the address to listen on. Defaults to localhost.
+        port (int): the port to listen on. Defaults to PORT.
+        stats_file (str): path to column statistics for the models without a saved preprocessing,
+        needed when a model has none. Defaults to None.
+        fasta (str): path to the fasta file of the queries, for preprocessings that normalize
+        the alignment count. Defaults to None.
+        max_batch_rows (int): the largest number of rows predicted together. Defaults to MAX_BATCH_ROWS.
+        max_wait (float): the seconds a request waits for other requests. Defaults to MAX_WAIT.
+    """
+    state = server_state_maker(ml_models, stats_file, fasta, max_batch_rows, max_wait)
+    batcher = threading.Thread(target = request_batcher, args = (state,), daemon = True)
+    batcher.start()
+    server = PredictionServer((host, port), PredictionHandler)
+    server.state = state
+    print(f'Serving the predictions of {len(ml_models)} models on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        state['queue'].put(None)
+        batcher.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serve the predictions of models on localhost')
+    parser.add_argument('ml_models', nargs = '+', help = 'one or more machine learning models, pickled or flat')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on. Defaults to localhost')
+    parser.add_argument('--port', type = int, default = PORT, help = f'port to listen on. Defaults to {PORT}')
+    parser.add_argument('--stats', default = None,
+                        help = 'json file with the column mean and std for the models without a saved preprocessing')
+    parser.add_argument('--fasta', default = None,
+                        help = 'fasta file of the queries, for preprocessings that normalize the alignment count')
+    parser.add_argument('--max-batch-rows', type = int, default = MAX_BATCH_ROWS,
+                        help = 'largest number of rows predicted together')
+    parser.add_argument('--max-wait-ms', type = float, default = MAX_WAIT * 1000,
+                        help = 'milliseconds a request waits for other requests to be predicted together with')
+    args = parser.parse_args()
+    main(args.ml_models, args.host, args.port, args.stats, args.fasta, args.max_batch_rows, args.max_wait_ms / 1000)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains the preprocessing of the feature tables
+before training or prediction. The preprocessing is fitted once on the training
+data and saved as json next to the model ('diamond_random_forest.sav' gets
+'diamond_random_forest.preprocessing.json'), so every prediction is normalized
+with the same statistics.
+"""
+
+import argparse
+import json
+from os.path import exists
+import numpy as np
+import pandas as pd
+from fasta_index import fasta_lengths
+from feature_table import table_loader
+
+PREPROCESSING_VERSION = 1
+
+def preprocessing_path(ml_model):
+    """This function gets the path of the preprocessing belonging to a model
+
+    Args:
+        ml_model (str): path to the machine learning model
+
+    Returns:
+        str: path to the preprocessing json file
+    """
+    return ml_model.rsplit('.', 1)[0] + '.preprocessing.json'
+
+def length_normalizer(data, lengths):
+    """This function divides the alignment count of every query by the length
+    of the query sequence, as normalization_a_count.py does
+
+    Args:
+        data (pd df): pandas dataframe containing the features, indexed by query
+        lengths (dict): key: query id; value: the length of the query sequence
+
+    Returns:
+        pd df: the features with the normalized alignment count
+    """
+    data = data.copy()
+    query_lengths = pd.Series(lengths, dtype = np.float64).reindex(data.index.astype(str)).to_numpy()
+    data['alignment_count'] = data['alignment_count'].to_numpy() / query_lengths
+    return data
+
+def preprocessing_fitter(data, lengths = None):
+    """This function fits the preprocessing on the training features: the mean and
+    standard deviation of every column for the z-score and the value that replaces
+    missing features, such as the features of the queries without a hit
+
+    Args:
+        data (pd df): pandas dataframe containing the training features, indexed by query
+        lengths (dict): the length of every query, if given the alignment count is
+        normalized by the length before fitting. Defaults to None.
+
+    Returns:
+        dict: the fitted preprocessing
+    """
+    if lengths is not None:
+        data = length_normalizer(data, lengths)
+    values = data.to_numpy(dtype = np.float64)
+    mean = np.nanmean(values, axis = 0)
+    std = np.nanstd(values, axis = 0)
+    #a constant column would divide by zero
+    std[~(std > 0)] = 1.0
+    return {
+        'version': PREPROCESSING_VERSION, 'columns': list(data.columns), 'mean': mean.tolist(),
+        'std': std.tolist(), 'fill': mean.tolist(), 'length_normalized': lengths is not None
+    }
+
+def preprocessing_transformer(preprocessing, data, lengths = None):
+    """This function applies a fitted preprocessing to features in one vectorized
+    transform. Column statistics without a 'fill' or 'length_normalized' entry, as saved
+    by run_the_models.py, are applied as a plain z-score.
+
+    Args:
+        preprocessing (dict): the fitted preprocessing
+        data (pd df): pandas dataframe containing the features, indexed by query
+        lengths (dict): the length of every query, needed when the preprocessing
+        normalizes the alignment count. Defaults to None.
+
+    Raises:
+        ValueError: when the preprocessing normalizes the alignment count and no lengths are given
+
+    Returns:
+        pd df: the preprocessed features
+    """
+    data = data[preprocessing['columns']]
+    if preprocessing.get('length_normalized', False):
+        if lengths is None:
+            raise ValueError('This preprocessing normalizes the alignment count, the query lengths are needed')
+        data = length_normalizer(data, lengths)
+    values = data.to_numpy(dtype = np.float64)
+    if 'fill' in preprocessing:
+        values = np.where(np.isnan(values), np.array(preprocessing['fill']), values)
+    values = (values - np.array(preprocessing['mean'])) / np.array(preprocessing['std'])
+    return pd.DataFrame(values, index = data.index, columns = data.columns)
+
+def preprocessing_writer(preprocessing, out):
+    """This function saves a fitted preprocessing as json
+
+    Args:
+        preprocessing (dict): the fitted preprocessing
+        out (str): path to the json file
+    """
+    with open(out, 'w') as f:
+        json.dump(preprocessing, f, indent = 1)
+
+def preprocessing_loader(ml_model):
+    """This function loads the preprocessing saved next to a model
+
+    Args:
+        ml_model (str): path to the machine learning model
+
+    Returns:
+        dict: the fitted preprocessing, None when the model has no saved preprocessing
+    """
+    path = preprocessing_path(ml_model)
+    if not exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def main(training_table, ml_models, fasta = None):
+    """This function fits the preprocessing on a training table and saves it next to the models
+
+    Args:
+        training_table (str): path to the feature table the models are trained on, tsv or binary
+        ml_models (list): paths to the machine learning models
+        fasta (str): path to the fasta file of the training queries, if given the
+        alignment count is normalized by the query length. Defaults to None.
+    """
+    data = table_loader(training_table)
+    data = data.drop(columns = ['CLASS'], errors = 'ignore')
+    lengths = fasta_lengths(fasta) if fasta is not None else None
+    preprocessing = preprocessing_fitter(data, lengths)
+    for ml_model in ml_models:
+        preprocessing_writer(preprocessing, preprocessing_path(ml_model))
+        print(f'The preprocessing of "{ml_model}" has been saved to "{preprocessing_path(ml_model)}"')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fit the preprocessing on a training table and save it next to models')
+    parser.add_argument('training_table', help = 'feature table the models are trained on, tsv or binary')
+    parser.add_argument('ml_models', nargs = '+', help = 'the models trained on the table')
+    parser.add_argument('--fasta', default = None,
+                        help = 'fasta file of the training queries, to normalize the alignment count by the length')
+    args = parser.parse_args()
+    main(args.training_table, args.ml_models, args.fasta)
@@ -18,13 +18,7 @@ echo "TAXONS"
 echo "Diamond"
 diamond blastp -q $2 -d /mnt/fast_storage/sims/uhgp-50.dmnd --ultra-sensitive -o $1 -f 6 -p 18 -e 10
 echo "Step 1"
-awk -F"\t" '$11<0.001' $1 |awk '{print $1}' |sort |uniq > significant_genes.txt #diamond.out -> $1
+#split the queries into significant and orphans in one read of the table #diamond.out -> $1
+python $(dirname $0)/orphan_selector.py partition $1 $2 $5 $3 --eval-cutoff 0.001
 echo "Step 2"
-awk -F"\t" '{print $1}'  $1 |sort |uniq > temp
-echo "Step 3"
-###grep -vwf significant_genes.txt temp > query_genes.txt
-python /mnt/fast_storage/sims/table_maker.py $1 $2 significant_genes.txt $5
-echo "Step 4"
-faSomeRecords $2 query_genes.txt $3
-echo "Step 5"
-python /mnt/fast_storage/sims/diamond_feature_extractor_mod.py $2 $5 $3 $dir/
+python $(dirname $0)/diamond_feature_extractor.py $2 $5 $3 $dir/
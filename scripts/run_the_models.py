@@ -1,9 +1,69 @@
 #!/usr/bin/env python3
 import pandas as pd
-import joblib
-from scipy.stats import zscore
-import sys
+import argparse
+import json
 import numpy as np
+from preprocessing import preprocessing_loader, preprocessing_transformer
+from fasta_index import fasta_lengths
+from feature_table import table_chunk_reader
+from stage_cache import atomic_writer
+from stage_profiler import stage_timer, timed_iterator
+from flat_model import flat_model_checker, flat_model_loader, flat_model_predictor
+
+#models that have been loaded in this process, key: path to the model
+MODEL_CACHE = {}
+BATCH_SIZE = 100000
+
+def model_loader(ml_model):
+    """This function loads a machine learning model, every model is only
+    loaded once per process. A flat model exported by flat_model.py is memory
+    mapped and predicted without sklearn.
+
+    Args:
+        ml_model (str): path to the pickled or flat machine learning model
+
+    Returns:
+        the loaded model, a dict for a flat model
+    """
+    if ml_model not in MODEL_CACHE:
+        with stage_timer('model load'):
+            if flat_model_checker(ml_model):
+                MODEL_CACHE[ml_model] = flat_model_loader(ml_model)
+            else:
+                #joblib and sklearn are only imported when a pickled model is used
+                import joblib
+                MODEL_CACHE[ml_model] = joblib.load(ml_model)
+    return MODEL_CACHE[ml_model]
+
+def model_predictor(model, data):
+    """This function makes the predictions of a loaded model
+
+    Args:
+        model: the model loaded by model_loader
+        data (pd df): pandas dataframe containing the features
+
+    Returns:
+        tuple: the predictions and the probability of the last class, None when the
+        model gives no probabilities
+    """
+    if isinstance(model, dict):
+        pred, proba = flat_model_predictor(model, data)
+        return pred, proba[:, -1]
+    pred = model.predict(data)
+    proba = model.predict_proba(data)[:, -1] if hasattr(model, 'predict_proba') else None
+    return pred, proba
+
+def model_namer(ml_model):
+    """This function gets the name of a model from its path,
+    e.g. 'random_forest' for 'models/diamond_random_forest.sav'
+
+    Args:
+        ml_model (str): path to the machine learning model
+
+    Returns:
+        str: the name of the model
+    """
+    return ml_model.rstrip('/').split('/')[-1].split('.')[0].split('_', 1)[-1]
 
 def orphan_classifier(ml_model, data):
     """This function loads the machine learning model and makes predictions
@@ -15,36 +75,182 @@ def orphan_classifier(ml_model, data):
     Returns:
         pred: predictions made by the model
     """
-    loaded_model = joblib.load(ml_model)
-    pred = loaded_model.predict(data)
+    loaded_model = model_loader(ml_model)
+    pred, proba = model_predictor(loaded_model, data)
     return pred
 
-def main():
-    """This function reads the feature tables, normalizes it and makes predictions
+def batch_predictor(ml_models, data, batch_size = BATCH_SIZE, preprocessings = None, lengths = None):
+    """This function makes the predictions of several models on the same features,
+    in batches of rows
+
+    Args:
+        ml_models (list): paths to the machine learning models
+        data (pd df): pandas dataframe containing the features, indexed by query
+        batch_size (int): the number of rows per batch. Defaults to BATCH_SIZE.
+        preprocessings (dict): key: path to the model; value: the preprocessing applied to the
+        features before the model predicts them. Defaults to None, then the features should
+        already be normalized.
+        lengths (dict): the length of every query, for preprocessings that normalize
+        the alignment count. Defaults to None.
+
+    Returns:
+        pd df: the prediction of every model and, when the model gives probabilities,
+        the probability of the last class, indexed by query
+    """
+    if preprocessings is None:
+        preprocessings = {}
+    batches = []
+    for start in range(0, len(data), batch_size):
+        batch = data.iloc[start:start + batch_size]
+        #models that share a preprocessing share the transformed batch
+        transformed = {}
+        predictions = {}
+        for ml_model in ml_models:
+            preprocessing = preprocessings.get(ml_model)
+            if id(preprocessing) not in transformed:
+                with stage_timer('preprocessing', rows = len(batch)):
+                    transformed[id(preprocessing)] = batch if preprocessing is None else \
+                        preprocessing_transformer(preprocessing, batch, lengths)
+            features = transformed[id(preprocessing)]
+            name = model_namer(ml_model)
+            model = model_loader(ml_model)
+            with stage_timer('predict', rows = len(batch)):
+                predictions[name], proba = model_predictor(model, features)
+                if proba is not None:
+                    predictions[f'{name}_probability'] = proba
+        batches.append(pd.DataFrame(predictions, index = batch.index))
+    if not batches:
+        return pd.DataFrame(index = data.index)
+    return pd.concat(batches)
+
+def column_stats_calculator(diamond_file, chunksize = BATCH_SIZE):
+    """This function calculates the mean and standard deviation of every column of
+    a feature table, reading the table in chunks. The statistics of the chunks
+    are combined with the parallel algorithm of Chan et al., missing values are skipped.
 
     Args:
-        diamond_file (str): path to diamond feature table
-        model (str): path to machine learning model
+        diamond_file (str): path to diamond feature table, tsv or binary
+        chunksize (int): the number of rows read at once. Defaults to BATCH_SIZE.
 
     Returns:
-        predictions: predictions made by the model
+        dict: the 'columns' and per column the 'mean' and population 'std'
     """
-    diamond_file = sys.argv[1]
-    model = sys.argv[2]
-    model_name = sys.argv[2].split('/')[-1].split('.')[0].split('_',1)[1]
-    #load features
-    diamond_features = pd.read_table(diamond_file, index_col=0)
-    #sequence_features = pd.read_table(sequence_file, index_col=0)
-    #normalize features (this has to be done manually, to prevent error with nan)
-    diamond_features = diamond_features.apply(zscore, axis = 0)
-    #sequence_features = sequence_features.apply(zscore, axis = 1)
-    #merge features
-    #combined_features = pd.merge(diamond_features, sequence_features, left_index=True, right_index=True)
-    predictions = orphan_classifier(model, diamond_features)
-    print(predictions)
-    np.savetxt(model_name + '_out.txt', predictions)
-    #with open(model_name + '_output.txt', 'w') as f:
-     #   f.write(str(predictions))
+    count, mean, m2 = 0, 0, 0
+    columns = None
+    for chunk in timed_iterator('table parse', table_chunk_reader(diamond_file, chunksize), len):
+        columns = list(chunk.columns)
+        values = chunk.to_numpy(dtype = np.float64)
+        chunk_count = np.sum(~np.isnan(values), axis = 0)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            chunk_mean = np.where(chunk_count > 0, np.nansum(values, axis = 0) / chunk_count, 0)
+            chunk_m2 = np.nansum((values - chunk_mean) ** 2, axis = 0)
+            total = count + chunk_count
+            delta = chunk_mean - mean
+            mean = np.where(total > 0, mean + delta * chunk_count / total, 0)
+            m2 = m2 + chunk_m2 + delta ** 2 * np.where(total > 0, count * chunk_count / total, 0)
+        count = total
+    if columns is None:
+        raise ValueError(f'The feature table "{diamond_file}" is empty')
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        std = np.sqrt(m2 / count)
+    return {'columns': columns, 'mean': np.asarray(mean, dtype = float).tolist(), 'std': std.tolist()}
+
+def column_stats_loader(stats_file):
+    """This function loads column statistics saved as json, e.g. those of the training data
+
+    Args:
+        stats_file (str): path to the json file with the 'columns', 'mean' and 'std'
+
+    Returns:
+        dict: the 'columns' and per column the 'mean' and 'std'
+    """
+    with open(stats_file) as f:
+        return json.load(f)
+
+def column_stats_writer(stats, stats_file):
+    """This function saves column statistics as json
+
+    Args:
+        stats (dict): the 'columns' and per column the 'mean' and 'std'
+        stats_file (str): path to the json file
+    """
+    with open(stats_file, 'w') as f:
+        json.dump(stats, f, indent = 1)
+
+def chunk_predictor(diamond_file, ml_models, out, preprocessings, chunksize = BATCH_SIZE, lengths = None):
+    """This function preprocesses and predicts a feature table one chunk of rows at the
+    time and appends the predictions of every chunk to the output table, so only one
+    chunk is in memory
+
+    Args:
+        diamond_file (str): path to diamond feature table, tsv or binary
+        ml_models (list): paths to machine learning models
+        out (str): path to the output table with the predictions of all models
+        preprocessings (dict): key: path to the model; value: the preprocessing of its features
+        chunksize (int): the number of rows read and predicted at once. Defaults to BATCH_SIZE.
+        lengths (dict): the length of every query, for preprocessings that normalize
+        the alignment count. Defaults to None.
+
+    Returns:
+        int: the number of predicted rows
+    """
+    n_rows = 0
+    with atomic_writer(out) as f:
+        for chunk in timed_iterator('table parse', table_chunk_reader(diamond_file, chunksize), len):
+            predictions = batch_predictor(ml_models, chunk, chunksize, preprocessings, lengths)
+            predictions.to_csv(f, sep = '\t', index_label = 'query', header = n_rows == 0)
+            n_rows += len(predictions)
+    return n_rows
+
+def main(diamond_file, ml_models, out, batch_size = BATCH_SIZE, stats_file = None, save_stats = None, fasta = None):
+    """This function reads the feature tables, normalizes it and makes predictions.
+    A model is normalized with the preprocessing saved next to it. For models without
+    a saved preprocessing the table is read twice in chunks: first to calculate the
+    column statistics for the z-score, unless they are given, and then to normalize and predict.
+
+    Args:
+        diamond_file (str): path to diamond feature table, tsv or binary
+        ml_models (list): paths to machine learning models
+        out (str): path to the output table with the predictions of all models
+        batch_size (int): the number of rows read and predicted at once. Defaults to BATCH_SIZE.
+        stats_file (str): path to stored column statistics, e.g. of the training data.
+        Defaults to None, then they are calculated from the table.
+        save_stats (str): path to save the calculated column statistics to. Defaults to None.
+        fasta (str): path to the fasta file of the queries, needed for preprocessings that
+        normalize the alignment count by the query length. Defaults to None.
+
+    Returns:
+        str: path to the predictions
+    """
+    #get the preprocessing to normalize the features of every model with
+    preprocessings = {ml_model: preprocessing_loader(ml_model) for ml_model in ml_models}
+    if any(preprocessing is None for preprocessing in preprocessings.values()):
+        if stats_file is not None:
+            stats = column_stats_loader(stats_file)
+        else:
+            stats = column_stats_calculator(diamond_file, batch_size)
+            if save_stats is not None:
+                column_stats_writer(stats, save_stats)
+        for ml_model, preprocessing in preprocessings.items():
+            if preprocessing is None:
+                preprocessings[ml_model] = stats
+    lengths = fasta_lengths(fasta) if fasta is not None else None
+    n_rows = chunk_predictor(diamond_file, ml_models, out, preprocessings, batch_size, lengths)
+    print(f'The predictions of {n_rows} queries have been written to "{out}"')
+    return out
+
 if __name__ == "__main__":
-   main()
-	
+    parser = argparse.ArgumentParser(description = 'Make predictions for a diamond feature table')
+    parser.add_argument('diamond_file', help = 'diamond feature table')
+    parser.add_argument('ml_models', nargs = '+', help = 'one or more machine learning models')
+    parser.add_argument('-o', '--out', default = 'predictions.tsv',
+                        help = 'output table with a column per model. Defaults to predictions.tsv')
+    parser.add_argument('--batch-size', type = int, default = BATCH_SIZE,
+                        help = 'number of rows read and predicted at once')
+    parser.add_argument('--stats', default = None,
+                        help = 'json file with the column mean and std to normalize with, e.g. of the training data')
+    parser.add_argument('--save-stats', default = None, help = 'json file to save the calculated column statistics to')
+    parser.add_argument('--fasta', default = None,
+                        help = 'fasta file of the queries, for preprocessings that normalize the alignment count')
+    args = parser.parse_args()
+    main(args.diamond_file, args.ml_models, args.out, args.batch_size, args.stats, args.save_stats, args.fasta)
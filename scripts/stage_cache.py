@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains the functions to skip pipeline stages whose
+output is up to date. Every output gets a manifest '{output}.cache.json' with a
+key made from the content hashes of the inputs and the parameters of the stage.
+A stage is only skipped when the output exists and the key is the same. Outputs
+are written to a temporary file first and renamed when they are complete, so an
+interrupted run never leaves a half written output behind. Outputs ending in
+'.gz' or '.zst' are compressed, see general_functions.file_opener.
+
+This file should not be run on its own as a script
+"""
+
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from os.path import exists
+from general_functions import file_opener, compression_namer
+
+HASH_BLOCK_SIZE = 2 ** 20
+
+def manifest_path(out):
+    """This function gets the path of the manifest of an output
+
+    Args:
+        out (str): path to the output
+
+    Returns:
+        str: path to the manifest
+    """
+    return out.rstrip('/') + '.cache.json'
+
+def manifest_loader(out):
+    """This function loads the manifest of an output
+
+    Args:
+        out (str): path to the output
+
+    Returns:
+        dict: the manifest, None when there is no (readable) manifest
+    """
+    try:
+        with open(manifest_path(out)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def file_hasher(path, known_hashes = None):
+    """This function calculates the content hash of a file. A hash in known_hashes is
+    reused when the size and modification time of the file did not change, so big
+    tables are not read again on every run.
+
+    Args:
+        path (str): path to the file
+        known_hashes (dict): key: path; value: dict with the 'size', 'mtime' and 'hash'
+        of a previous run. Defaults to None.
+
+    Returns:
+        dict: the 'size', 'mtime' and 'hash' of the file
+    """
+    stat = os.stat(path)
+    known = (known_hashes or {}).get(path)
+    if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+        return known
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+
+def id_hasher(ids):
+    """This function calculates a hash of a collection of ids, independent of their order
+
+    Args:
+        ids (iterable): the ids
+
+    Returns:
+        str: the hash
+    """
+    digest = hashlib.blake2b()
+    for id in sorted(ids):
+        digest.update(id.encode() + b'\n')
+    return digest.hexdigest()
+
+def stage_key_maker(inputs, params):
+    """This function makes the key of a stage from its inputs and parameters. The hash
+    of every input is kept with its position, so swapping two inputs changes the key.
+
+    Args:
+        inputs (list): the result of file_hasher of every input, in the order of the inputs of the stage
+        params (dict): the parameters of the stage, should be json serializable
+
+    Returns:
+        str: the key of the stage
+    """
+    content = {'inputs': [[position, value['hash']] for position, value in enumerate(inputs)], 'params': params}
+    return hashlib.blake2b(json.dumps(content, sort_keys = True).encode()).hexdigest()
+
+def stage_cache_checker(out, inputs, params):
+    """This function checks whether the output of a stage is up to date
+
+    Args:
+        out (str): path to the output
+        inputs (list): paths to the inputs of the stage
+        params (dict): the parameters of the stage
+
+    Returns:
+        tuple: whether the output is up to date and the manifest that should be
+        saved with stage_cache_writer once the output is made
+    """
+    previous = manifest_loader(out)
+    known_hashes = previous['inputs'] if previous is not None else None
+    hashes = {path: file_hasher(path, known_hashes) for path in inputs}
+    #the same file can be given as two inputs, e.g. the same fasta file for the queries and all sequences
+    manifest = {'key': stage_key_maker([hashes[path] for path in inputs], params), 'inputs': hashes, 'params': params}
+    up_to_date = exists(out) and previous is not None and previous['key'] == manifest['key']
+    return up_to_date, manifest
+
+def stage_cache_writer(out, manifest):
+    """This function saves the manifest of an output that has been made
+
+    Args:
+        out (str): path to the output
+        manifest (dict): the manifest made by stage_cache_checker
+    """
+    with atomic_writer(manifest_path(out)) as f:
+        json.dump(manifest, f, indent = 1)
+
+@contextmanager
+def atomic_writer(out, mode = 'w'):
+    """This function opens a temporary file next to the output, which replaces the
+    output when the writing is finished without an error. The file is compressed
+    when the output ends in '.gz', '.bgz' or '.zst'.
+
+    Args:
+        out (str): path to the output
+        mode (str): the mode to open the file in, 'w' or 'wb'. Defaults to 'w'.
+
+    Yields:
+        file: the opened temporary file
+    """
+    dir, name = os.path.split(out)
+    temp = os.path.join(dir, f'.{name}.tmp{os.getpid()}')
+    try:
+        with file_opener(temp, mode, compression_namer(out)) as f:
+            yield f
+        os.replace(temp, out)
+    finally:
+        if exists(temp):
+            os.remove(temp)
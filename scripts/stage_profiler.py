@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Description = this script contains the functions to measure the stages of the
+pipeline. Every stage adds its wall time, cpu time, number of rows and queries and
+the peak memory of the process to the statistics of its name, and the statistics
+of a run are written as a json report:
+
+    STAGE_REPORT=report.json python diamond_feature_extractor.py ...
+
+When STAGE_PROFILE is set to a directory, every outermost stage is also profiled
+with cProfile and its statistics are saved as '{directory}/{stage}.{pid}.prof',
+which can be read with pstats or snakeviz.
+
+This file should not be run on its own as a script
+"""
+
+import atexit
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+#key: name of the stage; value: the statistics of the stage in this process
+STAGE_STATS = {}
+#the stages that are running, the profiler only runs for the outermost one
+RUNNING_STAGES = []
+#stages can run in several threads at once, e.g. the requests of prediction_server.py
+STAGE_LOCK = threading.Lock()
+START_TIME = time.time()
+
+def peak_rss():
+    """This function gets the peak resident memory of this process and of its
+    finished child processes, such as DIAMOND
+
+    Returns:
+        tuple: the peak memory of the process and of its children in MB
+    """
+    #linux reports the maximum resident set size in kB
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+def stage_stats_adder(stage, wall, cpu, rows = None, queries = None):
+    """This function adds a measurement to the statistics of a stage
+
+    Args:
+        stage (str): the name of the stage
+        wall (float): the wall time in seconds
+        cpu (float): the cpu time in seconds
+        rows (int): the number of processed rows. Defaults to None.
+        queries (int): the number of processed queries. Defaults to None.
+    """
+    peak = peak_rss()
+    with STAGE_LOCK:
+        stats = STAGE_STATS.setdefault(stage, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'queries': 0})
+        stats['calls'] += 1
+        stats['wall'] += wall
+        stats['cpu'] += cpu
+        stats['rows'] += rows or 0
+        stats['queries'] += queries or 0
+        stats['peak_rss_mb'], stats['peak_rss_children_mb'] = peak
+
+def stage_stats_merger(stats, prefix = ''):
+    """This function adds the statistics measured in another process, e.g. a
+    stage of pipeline.py, to the statistics of this process
+
+    Args:
+        stats (dict): key: name of the stage; value: its statistics
+        prefix (str): prefix for the names of the stages. Defaults to ''.
+    """
+    with STAGE_LOCK:
+        for stage, other in stats.items():
+            own = STAGE_STATS.setdefault(prefix + stage, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'queries': 0})
+            for key in ('calls', 'wall', 'cpu', 'rows', 'queries'):
+                own[key] += other[key]
+            for key in ('peak_rss_mb', 'peak_rss_children_mb'):
+                own[key] = max(own.get(key, 0), other.get(key, 0))
+
+@contextmanager
+def stage_timer(stage, rows = None, queries = None):
+    """This function measures the code in its with block as a stage. The number of
+    rows and queries can also be set in the yielded dict when they are only known
+    at the end of the stage.
+
+    Args:
+        stage (str): the name of the stage
+        rows (int): the number of processed rows. Defaults to None.
+        queries (int): the number of processed queries. Defaults to None.
+
+    Yields:
+        dict: with the 'rows' and 'queries' of the stage
+    """
+    counts = {'rows': rows, 'queries': queries}
+    profile_dir = os.environ.get('STAGE_PROFILE')
+    with STAGE_LOCK:
+        profiler = cProfile.Profile() if profile_dir and not RUNNING_STAGES else None
+        RUNNING_STAGES.append(stage)
+    if profiler is not None:
+        profiler.enable()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield counts
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        with STAGE_LOCK:
+            RUNNING_STAGES.remove(stage)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok = True)
+            profiler.dump_stats(f"{profile_dir}/{stage.replace('/', '_').replace(' ', '_')}.{os.getpid()}.prof")
+        stage_stats_adder(stage, wall, cpu, counts['rows'], counts['queries'])
+
+def timed_iterator(stage, iterable, rows = None):
+    """This function measures the time spent getting the items of an iterable as a
+    stage, e.g. the parsing of the chunks of a table. The time spent on the items by
+    the caller is not counted.
+
+    Args:
+        stage (str): the name of the stage
+        iterable (iterable): the iterable
+        rows (function): gets the number of rows of an item. Defaults to None.
+
+    Yields:
+        the items of the iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        stage_stats_adder(stage, wall, cpu, rows(item) if rows is not None else None)
+        yield item
+
+def stage_report_maker():
+    """This function makes the report of the stages that ran in this process
+
+    Returns:
+        dict: the command, the total wall and cpu time, the peak memory and the statistics
+        of every stage with the rows and queries per second
+    """
+    stages = {}
+    with STAGE_LOCK:
+        stage_stats = {stage: dict(stats) for stage, stats in STAGE_STATS.items()}
+    for stage, stats in stage_stats.items():
+        stats['rows_per_sec'] = stats['rows'] / stats['wall'] if stats['wall'] > 0 else None
+        stats['queries_per_sec'] = stats['queries'] / stats['wall'] if stats['wall'] > 0 else None
+        stages[stage] = stats
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak, peak_children = peak_rss()
+    return {
+        'command': sys.argv, 'pid': os.getpid(), 'start': START_TIME, 'wall': time.time() - START_TIME,
+        'cpu': usage.ru_utime + usage.ru_stime, 'peak_rss_mb': peak, 'peak_rss_children_mb': peak_children,
+        'stages': stages
+    }
+
+def stage_report_writer(out):
+    """This function writes the report of the stages that ran in this process as json
+
+    Args:
+        out (str): path to the json file
+    """
+    with open(out, 'w') as f:
+        json.dump(stage_report_maker(), f, indent = 1)
+
+def exit_report_writer():
+    """This function writes the report to the path in STAGE_REPORT when the
+    process exits, if any stage ran
+    """
+    out = os.environ.get('STAGE_REPORT')
+    if out and STAGE_STATS:
+        stage_report_writer(out)
+
+atexit.register(exit_report_writer)